@@ -0,0 +1,65 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Adaptor allocation over a season pass sized booking list.
+
+Books random half hour and hour long airings over 14 days on 4 adaptors,
+with random priorities, and times allocateAdaptors.
+
+run with: python -m benchmarks.bench_allocator [nrecordings ...]
+"""
+import random
+import sys
+import time
+
+from tvrecorder.allocator import allocateAdaptors
+
+
+def makeBookings(n, days=14, seed=1):
+    rand = random.Random(seed)
+    return [
+        {
+            "programid": f"EP{x:08d}",
+            "stationid": str(rand.randrange(10000, 10100)),
+            "airdate": rand.randrange(0, days * 86400),
+            "duration": rand.choice([1800, 3600]),
+            "title": f"Programme {x}",
+            "channel": "BBC ONE",
+            "priority": rand.randrange(5),
+            "frontpadding": 120,
+            "endpadding": 900,
+        }
+        for x in range(n)
+    ]
+
+
+def main():
+    counts = [int(x) for x in sys.argv[1:]] or [1000, 5000, 20000]
+    for n in counts:
+        recs = makeBookings(n)
+        start = time.perf_counter()
+        booked, clashes = allocateAdaptors(recs, 4)
+        took = time.perf_counter() - start
+        print(
+            f"{n:>6} recordings: {len(booked):>6} booked, {len(clashes):>6} clash, "
+            f"{took * 1000:.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
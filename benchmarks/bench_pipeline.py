@@ -0,0 +1,80 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""End to end update run, schedules and programs, through the stub SD
+server with a fixed latency per request, stages run in turn against the
+pipeline.
+
+One request is in flight at a time and responses are streamed, so in turn
+the run waits on the network, then parsing, then the database.
+
+run with: python -m benchmarks.bench_pipeline [channels] [days] [latency ms]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from sqlalchemy.orm import Session
+
+from tvrecorder.config import Configuration
+from tvrecorder.db import createTables, makeDBEngine
+from tvrecorder.models import Channel
+from tvrecorder.sdapi import SDApi
+from tvrecorder.wrangler import schedules, updateChannels
+
+from tests.sdfixture import SDFixture
+
+
+def run(label, threaded, nchans, ndays, latency):
+    with tempfile.TemporaryDirectory() as tmpd:
+        cf = Configuration(appname="tvrecorderbench")
+        cf.set("dbtype", "sqlite")
+        cf.set("dbpath", os.path.join(tmpd, "bench.db"))
+        eng = makeDBEngine(cf)
+        createTables(eng)
+        fix = SDFixture(channels=nchans, days=ndays, latency=latency)
+        counts = fix.counts()
+        with fix.server() as srv:
+            sd = SDApi(url=srv.url, workers=1, stream=True)
+            updateChannels(fix.lineup(), eng)
+            with Session(eng) as session, session.begin():
+                session.query(Channel).update({"getdata": 1})
+            start = time.perf_counter()
+            schedules(sd, eng, threaded=threaded)
+            took = time.perf_counter() - start
+            sd.close()
+        eng.dispose()
+    print(
+        f"{label:>9}: {counts['schedules']} schedules, {counts['programs']} programs "
+        f"in {took:.2f}s"
+    )
+    return took
+
+
+def main():
+    nchans = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    ndays = int(sys.argv[2]) if len(sys.argv) > 2 else 7
+    latency = (int(sys.argv[3]) if len(sys.argv) > 3 else 300) / 1000
+    serial = run("serial", False, nchans, ndays, latency)
+    piped = run("pipelined", True, nchans, ndays, latency)
+    print(f"  speedup: {serial / piped:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
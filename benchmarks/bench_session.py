@@ -0,0 +1,74 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Per-request latency of SDApi with and without connection re-use.
+
+run with: python -m benchmarks.bench_session
+"""
+import os
+import subprocess
+import tempfile
+import time
+
+from tvrecorder.sdapi import SDApi
+
+from tests.stubserver import StubServer
+
+NREQ = 500
+
+
+def makeCert(tmpd):
+    """Self-signed certificate for 127.0.0.1, so TLS handshakes are measured."""
+    pem = os.path.join(tmpd, "stub.pem")
+    cmd = ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes"]
+    cmd += ["-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1"]
+    cmd += ["-keyout", pem, "-out", pem, "-days", "1"]
+    subprocess.run(cmd, check=True, capture_output=True)
+    return pem
+
+
+def timeRequests(srv, keepalive, certfile=None):
+    sd = SDApi(url=srv.url, keepalive=keepalive)
+    if certfile is not None:
+        sd.session.trust_env = False
+        sd.session.verify = certfile
+    start = time.perf_counter()
+    for _ in range(NREQ):
+        sd.available()
+    elapsed = time.perf_counter() - start
+    sd.close()
+    return elapsed
+
+
+def main():
+    payload = [{"type": "COUNTRIES", "description": "x" * 200}]
+    with tempfile.TemporaryDirectory() as tmpd:
+        for certfile in (None, makeCert(tmpd)):
+            for keepalive in (False, True):
+                with StubServer({"available": payload}, certfile=certfile) as srv:
+                    elapsed = timeRequests(srv, keepalive, certfile)
+                    label = "pooled keep-alive" if keepalive else "new connection"
+                    print(
+                        f"{srv.scheme:>5} {label:>17}: {NREQ} requests in "
+                        f"{elapsed:.3f}s, {elapsed / NREQ * 1000:.3f} ms/request, "
+                        f"{srv.connections} connections"
+                    )
+
+
+if __name__ == "__main__":
+    main()
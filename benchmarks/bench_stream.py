@@ -0,0 +1,90 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Peak memory of getPrograms over a synthetic 10k programme payload,
+whole response parsing against streamed parsing.
+
+run with: python -m benchmarks.bench_stream [nprograms]
+"""
+import json
+import sys
+import time
+import tracemalloc
+
+from tvrecorder.sdapi import SDApi
+
+from tests.stubserver import StubServer
+
+
+def makePayload(nprogs):
+    progs = []
+    for x in range(nprogs):
+        progs.append(
+            {
+                "programID": f"EP{x:010d}",
+                "md5": f"{x:032x}",
+                "titles": [{"title120": f"Programme number {x}"}],
+                "descriptions": {
+                    "description100": [{"description": "A short description. " * 4}],
+                    "description1000": [{"description": "A long description. " * 40}],
+                },
+                "cast": [
+                    {
+                        "personId": str(p),
+                        "nameId": str(p),
+                        "name": f"Actor {p}",
+                        "role": "Actor",
+                        "billingOrder": f"{p % 30:02d}",
+                    }
+                    for p in range(x % 1000, x % 1000 + 30)
+                ],
+            }
+        )
+    return json.dumps(progs).encode()
+
+
+def measure(srv, progids, stream):
+    sd = SDApi(url=srv.url, stream=stream)
+    sd.apiToken()
+    tracemalloc.start()
+    start = time.perf_counter()
+    count = sum(1 for _ in sd.getPrograms(progids))
+    took = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    sd.close()
+    return count, peak, took
+
+
+def main():
+    nprogs = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    payload = makePayload(nprogs)
+    progids = [f"EP{x:010d}" for x in range(nprogs)]
+    print(f"payload: {nprogs} programmes, {len(payload) / 1e6:.1f} MB")
+    with StubServer({"programs": payload}) as srv:
+        for stream in (False, True):
+            count, peak, took = measure(srv, progids, stream)
+            label = "streamed" if stream else "res.json()"
+            print(
+                f"{label:>10}: {count} programmes in {took:.2f}s, "
+                f"peak traced memory {peak / 1e6:.1f} MB"
+            )
+
+
+if __name__ == "__main__":
+    main()
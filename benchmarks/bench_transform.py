@@ -0,0 +1,83 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Programme JSON to rows, scaling over worker processes.
+
+Times transformPrograms alone over the synthetic programmes, then a full
+storePrograms into SQLite, for each worker count. 0 workers transforms in
+the pipeline's own thread.
+
+run with: python -m benchmarks.bench_transform [nprograms] [workers ...]
+"""
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import sys
+import tempfile
+import time
+
+from tvrecorder.config import Configuration
+from tvrecorder.db import createTables, makeDBEngine
+from tvrecorder.sdapi import chunks
+from tvrecorder.transform import transformPrograms
+from tvrecorder.wrangler import storePrograms
+
+from benchmarks.bench_stream import makePayload
+
+
+def timeTransform(progs, workers):
+    xchunks = list(chunks(progs, 250))
+    start = time.perf_counter()
+    if workers == 0:
+        [transformPrograms(xl) for xl in xchunks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(transformPrograms, xchunks))
+    return time.perf_counter() - start
+
+
+def timeStore(progs, workers):
+    with tempfile.TemporaryDirectory() as tmpd:
+        cf = Configuration(appname="tvrecorderbench")
+        cf.set("dbtype", "sqlite")
+        cf.set("dbpath", os.path.join(tmpd, "bench.db"))
+        eng = makeDBEngine(cf)
+        createTables(eng)
+        start = time.perf_counter()
+        storePrograms(chunks(progs, 500), eng, workers=workers)
+        took = time.perf_counter() - start
+        eng.dispose()
+    return took
+
+
+def main():
+    nprogs = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    counts = [int(x) for x in sys.argv[2:]] or [0, 1, 2, 4]
+    progs = json.loads(makePayload(nprogs))
+    print(f"{nprogs} programmes, {os.cpu_count()} cpus")
+    for workers in counts:
+        xform = timeTransform(progs, workers)
+        store = timeStore(progs, workers)
+        print(
+            f"{workers:>2} workers: transform {nprogs / xform:>9.0f} programmes/s, "
+            f"store {nprogs / store:>7.0f} programmes/s ({store:.2f}s)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Transport stream inspection speed.
+
+Writes a synthetic multiplex of the given size, with a few continuity
+errors, and times TSInspector over it, against a plain packet at a time
+loop through mpegts.ContinuityCounter. The file is read once first, so
+both run from the page cache, this is the inspector's ceiling rather
+than the disk's.
+
+run with: python -m benchmarks.bench_tsinspect [megabytes]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from tvrecorder.mpegts import PACKETSIZE, ContinuityCounter, packetPid
+from tvrecorder.tsinspect import TSInspector
+
+from tests.tsfixture import TSFixture
+
+SERVICES = {4287: [101, 102, 103], 4351: [201, 202], 8261: [301, 302], 8325: [401]}
+
+
+def makeFile(path, megabytes):
+    fix = TSFixture(SERVICES)
+    chunk = fix.stream(50000, ccerrors=0.0001)
+    with open(path, "wb") as xfile:
+        for _ in range(max(1, megabytes * 1000000 // len(chunk))):
+            xfile.write(chunk)
+    return os.path.getsize(path)
+
+
+def packetLoop(path):
+    cc = ContinuityCounter()
+    pids = {}
+    with open(path, "rb") as xfile:
+        while True:
+            buf = xfile.read(PACKETSIZE * 10000)
+            if not buf:
+                break
+            for off in range(0, len(buf) - PACKETSIZE + 1, PACKETSIZE):
+                pid = packetPid(buf, off)
+                pids[pid] = pids.get(pid, 0) + 1
+                cc.check(buf, off)
+    return cc.errors
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    with tempfile.TemporaryDirectory() as tmpd:
+        path = os.path.join(tmpd, "bench.ts")
+        size = makeFile(path, megabytes)
+        with open(path, "rb") as xfile:
+            while xfile.read(1 << 24):
+                pass
+        start = time.perf_counter()
+        summary = TSInspector().inspect(path)
+        took = time.perf_counter() - start
+        print(
+            f"inspector:   {size / 1e6:.0f}MB in {took:.2f}s, {size / took / 1e6:.0f}MB/s, "
+            f"{summary['ccerrors']} continuity errors"
+        )
+        start = time.perf_counter()
+        errors = packetLoop(path)
+        took = time.perf_counter() - start
+        print(
+            f"packet loop: {size / 1e6:.0f}MB in {took:.2f}s, {size / took / 1e6:.0f}MB/s, "
+            f"{errors} continuity errors"
+        )
+
+
+if __name__ == "__main__":
+    main()
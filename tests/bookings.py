@@ -0,0 +1,35 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Recording bookings, as pendingRecordings returns them, for the
+scheduler, allocator and capture tests."""
+
+
+def booking(title, airdate, duration=1800, **kwargs):
+    rec = {
+        "programid": f"EP{title}",
+        "stationid": "1001",
+        "airdate": airdate,
+        "duration": duration,
+        "title": title,
+        "channel": "BBC ONE",
+        "frontpadding": 120,
+        "endpadding": 900,
+    }
+    rec.update(kwargs)
+    return rec
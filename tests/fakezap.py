@@ -0,0 +1,73 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Runs the capture commands against a fake dvbv5-zap and a fifo in place
+of the DVR device, to check how they behave when they are terminated."""
+import os
+import signal
+import subprocess
+import sys
+import time
+
+
+def fakeZap(tmp_path):
+    """A dvbv5-zap on the PATH that writes its pid and waits to be
+    terminated."""
+    zap = tmp_path / "bin" / "dvbv5-zap"
+    zap.parent.mkdir()
+    zap.write_text(f"#!/bin/sh\necho $$ > {tmp_path / 'zap.pid'}\nexec sleep 60\n")
+    zap.chmod(0o755)
+    env = dict(os.environ, PATH=f"{zap.parent}{os.pathsep}{os.environ['PATH']}")
+    return env, tmp_path / "zap.pid"
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def terminatedCapture(tmp_path, module, args, data):
+    """Runs the module's main with the DVR device replaced by a fifo fed
+    data, terminates it, returns the zap's pid."""
+    env, pidfile = fakeZap(tmp_path)
+    dvr = tmp_path / "dvr0"
+    os.mkfifo(dvr)
+    code = f"import sys; from tvrecorder import {module} as mod; "
+    code += "mod.DVRPATH = sys.argv.pop(1); mod.main()"
+    proc = subprocess.Popen([sys.executable, "-c", code, str(dvr)] + args, env=env)
+    try:
+        with open(dvr, "wb") as xfile:
+            xfile.write(data)
+            xfile.flush()
+            deadline = time.time() + 10
+            while not pidfile.exists() and time.time() < deadline:
+                time.sleep(0.05)
+            time.sleep(0.5)
+            proc.send_signal(signal.SIGTERM)
+            proc.wait(10)
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+    pid = int(pidfile.read_text())
+    deadline = time.time() + 5
+    while alive(pid) and time.time() < deadline:
+        time.sleep(0.05)
+    return pid
@@ -0,0 +1,315 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Synthetic Schedules Direct data, for tests and benchmarks.
+
+SDFixture generates a lineup of channels, a schedule per channel per day
+and the programmes they air, shaped like the 20141201 API's responses.
+routes() serves them through the StubServer:
+
+    fix = SDFixture(channels=50, days=14)
+    with StubServer(fix.routes()) as srv:
+        sd = SDApi(url=srv.url)
+
+or stand alone, for pointing tvrecorder at:
+
+    python -m tests.sdfixture [--channels 50] [--days 14] [--port 8080]
+"""
+import argparse
+import hashlib
+import json
+import random
+import time
+
+from tests.stubserver import StubServer
+
+GENRES = ["Drama", "Comedy", "News", "Documentary", "Sport", "Children", "Film"]
+ROLES = ["Director", "Producer", "Writer", "Executive Producer"]
+
+
+def contentMd5(obj):
+    return hashlib.md5(json.dumps(obj, sort_keys=True).encode()).hexdigest()
+
+
+def isoTime(ts):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(ts))
+
+
+class SDFixture:
+    def __init__(
+        self,
+        channels=20,
+        days=7,
+        start=None,
+        slot=1800,
+        cast=8,
+        crew=3,
+        repeats=0.3,
+        people=5000,
+        lineup="GBR-1000193-DEFAULT",
+        latency=0,
+        seed=1,
+    ):
+        """Generate the data.
+
+        Args:
+            channels: int: stations in the lineup
+            days: int: days of schedules per station
+            start: int: epoch of the first day, default: midnight UTC today
+            slot: int: seconds per programme, airings are 1 to 3 slots long
+            cast, crew: int: the most cast and crew members per programme
+            repeats: float: fraction of airings that repeat an earlier one
+            people: int: size of the pool that cast and crew are drawn from
+            lineup: str: the lineup code
+            latency: float: seconds each schedules/programs request takes
+            seed: int: the same seed always generates the same data
+        """
+        self.rand = random.Random(seed)
+        now = int(time.time())
+        self.start = now - now % 86400 if start is None else start
+        self.days = days
+        self.slot = slot
+        self.ncast = cast
+        self.ncrew = crew
+        self.people = people
+        self.lineupcode = lineup
+        self.latency = latency
+        self.modified = isoTime(self.start - 3600)
+        self.stations = [self.makeStation(x) for x in range(channels)]
+        self.programs = {}
+        self.progids = []
+        self.schedules = {}
+        for station in self.stations:
+            for day in range(days):
+                sched = self.makeSchedule(station["stationID"], day, repeats)
+                self.schedules[
+                    (station["stationID"], sched["metadata"]["startDate"])
+                ] = sched
+
+    def makeStation(self, n):
+        sid = str(10000 + n * 7)
+        return {
+            "stationID": sid,
+            "name": f"Channel {n + 1}",
+            "callsign": f"CH{n + 1}",
+            "broadcastLanguage": ["en"],
+            "descriptionLanguage": ["en"],
+            "logo": {"URL": f"https://example.invalid/logos/{sid}.png"},
+        }
+
+    def person(self, role):
+        pid = self.rand.randrange(self.people)
+        return {
+            "personId": str(20000000 + pid),
+            "nameId": str(30000000 + pid),
+            "name": f"Person {pid}",
+            "role": role,
+        }
+
+    def makeProgram(self, n):
+        progid = f"EP{n:08d}{self.rand.randrange(10000):04d}"
+        title = f"Programme {n}"
+        cast = []
+        for x in range(self.rand.randint(0, self.ncast)):
+            member = self.person("Actor")
+            member["characterName"] = f"Character {x}"
+            member["billingOrder"] = f"{x + 1:02d}"
+            cast.append(member)
+        crew = []
+        for x in range(self.rand.randint(0, self.ncrew)):
+            member = self.person(self.rand.choice(ROLES))
+            member["billingOrder"] = f"{x + 1:02d}"
+            crew.append(member)
+        prog = {
+            "programID": progid,
+            "titles": [{"title120": title}],
+            "descriptions": {
+                "description100": [
+                    {"descriptionLanguage": "en", "description": f"{title}, in short."}
+                ],
+                "description1000": [
+                    {
+                        "descriptionLanguage": "en",
+                        "description": f"{title}, at length. " * 12,
+                    }
+                ],
+            },
+            "originalAirDate": time.strftime(
+                "%Y-%m-%d", time.gmtime(self.start - self.rand.randrange(10**8))
+            ),
+            "genres": self.rand.sample(GENRES, 2),
+            "episodeTitle150": f"Episode {n % 20 + 1}",
+            "metadata": [{"Gracenote": {"season": n % 7 + 1, "episode": n % 20 + 1}}],
+            "cast": cast,
+            "crew": crew,
+            "showType": "Series",
+            "hasImageArtwork": False,
+        }
+        prog["md5"] = contentMd5(prog)[:22]
+        return prog
+
+    def makeSchedule(self, stationid, day, repeats):
+        dstart = self.start + day * 86400
+        airings = []
+        when = dstart
+        while when < dstart + 86400:
+            if self.progids and self.rand.random() < repeats:
+                prog = self.programs[self.rand.choice(self.progids)]
+            else:
+                prog = self.makeProgram(len(self.progids))
+                self.programs[prog["programID"]] = prog
+                self.progids.append(prog["programID"])
+            # the day's last airing ends at midnight
+            duration = min(self.slot * self.rand.randint(1, 3), dstart + 86400 - when)
+            airings.append(
+                {
+                    "programID": prog["programID"],
+                    "airDateTime": isoTime(when),
+                    "duration": duration,
+                    "md5": prog["md5"],
+                    "audioProperties": ["stereo"],
+                }
+            )
+            when += duration
+        sched = {"stationID": stationid, "programs": airings}
+        sched["metadata"] = {
+            "modified": self.modified,
+            "md5": contentMd5(sched)[:22],
+            "startDate": time.strftime("%Y-%m-%d", time.gmtime(dstart)),
+        }
+        return sched
+
+    def touch(self, fraction, seed=2):
+        """Changes the md5 of a fraction of the schedules, as a later run
+        would find them, returns the number changed."""
+        rand = random.Random(seed)
+        keys = rand.sample(sorted(self.schedules), int(len(self.schedules) * fraction))
+        for key in keys:
+            meta = self.schedules[key]["metadata"]
+            meta["md5"] = contentMd5([meta["md5"], seed])[:22]
+            meta["modified"] = isoTime(int(time.time()))
+        return len(keys)
+
+    def status(self, body=None):
+        now = isoTime(int(time.time()))
+        return {
+            "account": {"expires": isoTime(self.start + 86400 * 365), "maxLineups": 4},
+            "lineups": [
+                {
+                    "lineup": self.lineupcode,
+                    "modified": self.modified,
+                    "uri": f"/20141201/lineups/{self.lineupcode}",
+                }
+            ],
+            "lastDataUpdate": self.modified,
+            "notifications": [],
+            "systemStatus": [
+                {"date": now, "status": "Online", "message": "No known issues."}
+            ],
+            "serverID": "stub",
+            "datetime": now,
+            "code": 0,
+        }
+
+    def lineup(self, body=None):
+        return {
+            "map": [
+                {"stationID": station["stationID"], "channel": str(n + 1)}
+                for n, station in enumerate(self.stations)
+            ],
+            "stations": self.stations,
+            "metadata": {
+                "lineup": self.lineupcode,
+                "modified": self.modified,
+                "transport": "DVB-T",
+            },
+        }
+
+    def scheduleMd5s(self, body):
+        time.sleep(self.latency)
+        wanted = {str(x["stationID"]) for x in body}
+        op = {}
+        for (sid, xdate), sched in self.schedules.items():
+            if sid in wanted:
+                meta = sched["metadata"]
+                op.setdefault(sid, {})[xdate] = {
+                    "code": 0,
+                    "message": "OK",
+                    "lastModified": meta["modified"],
+                    "md5": meta["md5"],
+                }
+        return op
+
+    def getSchedules(self, body):
+        time.sleep(self.latency)
+        op = []
+        for chan in body:
+            for xdate in chan["date"]:
+                sched = self.schedules.get((chan["stationID"], xdate))
+                if sched is not None:
+                    op.append(sched)
+        return op
+
+    def getPrograms(self, body):
+        time.sleep(self.latency)
+        return [self.programs[progid] for progid in body if progid in self.programs]
+
+    def routes(self):
+        """The StubServer routes that serve this data."""
+        return {
+            "status": self.status,
+            f"lineups/{self.lineupcode}": self.lineup,
+            "schedules/md5": self.scheduleMd5s,
+            "schedules": self.getSchedules,
+            "programs": self.getPrograms,
+        }
+
+    def server(self, **kwargs):
+        return StubServer(self.routes(), **kwargs)
+
+    def counts(self):
+        airings = sum(len(x["programs"]) for x in self.schedules.values())
+        return {
+            "stations": len(self.stations),
+            "schedules": len(self.schedules),
+            "airings": airings,
+            "programs": len(self.programs),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--port", type=int, default=0)
+    args = parser.parse_args()
+    fix = SDFixture(
+        channels=args.channels, days=args.days, latency=args.latency, seed=args.seed
+    )
+    srv = fix.server(port=args.port)
+    print(f"serving {fix.counts()} on {srv.url}", flush=True)
+    try:
+        srv.serve_forever(poll_interval=0.5)
+    except KeyboardInterrupt:
+        srv.server_close()
+
+
+if __name__ == "__main__":
+    main()
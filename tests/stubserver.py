@@ -0,0 +1,161 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Local stand-in for the Schedules Direct API, for tests and benchmarks."""
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import gzip
+import json
+import socket
+import ssl
+import threading
+
+
+def tokenResponse(body):
+    now = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    return {"code": 0, "message": "OK", "token": "stubtoken", "datetime": now}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.respond(self, "GET")
+
+    def do_POST(self):
+        self.server.respond(self, "POST")
+
+    def do_PUT(self):
+        self.server.respond(self, "PUT")
+
+
+class StubServer(ThreadingHTTPServer):
+    """Serve canned JSON responses on localhost.
+
+    routes maps a route (without leading slash) to either a JSON-able
+    payload or a callable taking the decoded request body and returning one.
+
+    faults maps a route to a list of failures to inject, one per request
+    until the list is used up: an HTTP status code, a (status, headers)
+    tuple, "reset" to drop the connection without answering, or "truncate"
+    to drop it half way through the body.
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, routes=None, certfile=None, compress=True, faults=None, port=0):
+        super().__init__(("127.0.0.1", port), StubHandler)
+        self.compress = compress
+        self.scheme = "http"
+        if certfile is not None:
+            ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            ctx.load_cert_chain(certfile)
+            self.socket = ctx.wrap_socket(self.socket, server_side=True)
+            self.scheme = "https"
+        self.routes = {"token": tokenResponse}
+        self.routes.update(routes or {})
+        self.faults = {route: list(xl) for route, xl in (faults or {}).items()}
+        self.connections = 0
+        self.requests = []
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"{self.scheme}://127.0.0.1:{self.server_address[1]}"
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections += 1
+        super().process_request(request, client_address)
+
+    def readBody(self, handler):
+        length = int(handler.headers.get("Content-Length", 0))
+        raw = handler.rfile.read(length) if length else b""
+        return json.loads(raw) if raw else None
+
+    def respond(self, handler, method):
+        route = handler.path.lstrip("/").split("?")[0]
+        body = self.readBody(handler)
+        with self.lock:
+            self.requests.append((method, route, dict(handler.headers)))
+            xfaults = self.faults.get(route)
+            fault = xfaults.pop(0) if xfaults else None
+        if fault is not None and fault != "truncate":
+            self.inject(handler, fault)
+            return
+        payload = self.routes.get(route)
+        if payload is None:
+            self.send(handler, 404, {"code": 404, "message": f"no route {route}"})
+            return
+        if callable(payload):
+            payload = payload(body)
+        self.send(handler, 200, payload, truncate=fault == "truncate")
+
+    def inject(self, handler, fault):
+        if fault == "reset":
+            handler.close_connection = True
+            handler.connection.shutdown(socket.SHUT_RDWR)
+            return
+        status, headers = fault if isinstance(fault, tuple) else (fault, None)
+        self.send(handler, status, {"code": status, "message": "fault"}, headers)
+
+    def send(self, handler, status, payload, headers=None, truncate=False):
+        # pre-encoded payloads are sent as they are
+        data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        headers = dict(headers or {})
+        if self.compress and "gzip" in handler.headers.get("Accept-Encoding", ""):
+            data = gzip.compress(data, compresslevel=6)
+            headers["Content-Encoding"] = "gzip"
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(data)))
+        if handler.headers.get("Connection", "").lower() == "close":
+            handler.send_header("Connection", "close")
+        for key, val in headers.items():
+            handler.send_header(key, val)
+        handler.end_headers()
+        if truncate:
+            handler.wfile.write(data[: len(data) // 2])
+            handler.wfile.flush()
+            handler.close_connection = True
+            handler.connection.shutdown(socket.SHUT_RDWR)
+            return
+        handler.wfile.write(data)
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+        )
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,137 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+import random
+import time
+
+from tvrecorder.allocator import allocateAdaptors
+from tvrecorder.scheduler import recordingEnd, recordingStart
+
+from tests.bookings import booking
+
+
+def titles(recs):
+    return sorted(x["title"] for x in recs)
+
+
+def assertValid(booked, adaptors):
+    byadaptor = {}
+    for rec in booked:
+        assert 0 <= rec["adaptor"] < adaptors
+        byadaptor.setdefault(rec["adaptor"], []).append(rec)
+    for recs in byadaptor.values():
+        recs.sort(key=recordingStart)
+        for a, b in zip(recs, recs[1:]):
+            assert recordingEnd(a) <= recordingStart(b)
+
+
+def test_padding_makes_back_to_back_airings_overlap():
+    recs = [booking("a", 0), booking("b", 1800), booking("c", 7200)]
+    booked, clashes = allocateAdaptors(recs, 2)
+    assert clashes == []
+    assert [x["adaptor"] for x in booked] == [0, 1, 0]
+    assertValid(booked, 2)
+
+
+def test_clash_drops_the_latest_ending():
+    recs = [booking("a", 0), booking("long", 60, 7200), booking("c", 120)]
+    booked, clashes = allocateAdaptors(recs, 2)
+    assert titles(booked) == ["a", "c"]
+    assert len(clashes) == 1
+    assert clashes[0]["recording"]["title"] == "long"
+    assert titles(clashes[0]["with"]) == ["a", "c"]
+
+
+def test_clash_drops_the_lowest_priority():
+    recs = [
+        booking("a", 0, priority=5),
+        booking("b", 60, priority=1),
+        booking("c", 120, 7200, priority=3),
+    ]
+    booked, clashes = allocateAdaptors(recs, 2)
+    assert titles(booked) == ["a", "c"]
+    assert [x["recording"]["title"] for x in clashes] == ["b"]
+    # the new arrival loses when it has the lowest priority
+    booked, clashes = allocateAdaptors(recs, 1)
+    assert titles(booked) == ["a"]
+    assert titles(x["recording"] for x in clashes) == ["b", "c"]
+
+
+def test_recording_in_progress_keeps_its_adaptor():
+    recs = [
+        booking("a", 0, priority=9),
+        booking("now", 60, 7200, status="recording", adaptor=1),
+        booking("c", 120, priority=9),
+    ]
+    booked, clashes = allocateAdaptors(recs, 2)
+    assert titles(booked) == ["a", "now"]
+    assert [x["adaptor"] for x in booked] == [0, 1]
+    assert [x["recording"]["title"] for x in clashes] == ["c"]
+    # the caller's dicts are left alone
+    assert "adaptor" not in recs[0]
+
+
+def test_pending_recording_sorting_first_leaves_a_running_adaptor():
+    recs = [
+        booking("early", 0, priority=9),
+        booking("now", 600, status="recording", adaptor=0),
+    ]
+    booked, clashes = allocateAdaptors(recs, 2)
+    assert clashes == []
+    assert [(x["title"], x["adaptor"]) for x in booked] == [("early", 1), ("now", 0)]
+    # with one adaptor the running recording keeps it
+    booked, clashes = allocateAdaptors(recs, 1)
+    assert [(x["title"], x["adaptor"]) for x in booked] == [("now", 0)]
+    assert [x["recording"]["title"] for x in clashes] == ["early"]
+
+
+def test_random_loads():
+    rand = random.Random(1)
+    for _ in range(50):
+        recs = [
+            booking(str(x), rand.randrange(0, 86400), rand.randrange(600, 7200))
+            for x in range(40)
+        ]
+        booked, clashes = allocateAdaptors(recs, 3)
+        assertValid(booked, 3)
+        assert len(booked) + len(clashes) == len(recs)
+        # enough adaptors for the most on air at once and nothing clashes
+        edges = sorted(
+            [(recordingStart(x), 1) for x in recs]
+            + [(recordingEnd(x), -1) for x in recs]
+        )
+        most = onair = 0
+        for _, step in sorted(edges, key=lambda x: (x[0], x[1])):
+            onair += step
+            most = max(most, onair)
+        booked, clashes = allocateAdaptors(recs, most)
+        assert clashes == []
+        assertValid(booked, most)
+
+
+def test_season_pass_load():
+    rand = random.Random(2)
+    recs = [
+        booking(str(x), rand.randrange(0, 14 * 86400), rand.choice([1800, 3600]))
+        for x in range(5000)
+    ]
+    start = time.perf_counter()
+    booked, clashes = allocateAdaptors(recs, 4)
+    assert time.perf_counter() - start < 1
+    assert len(booked) + len(clashes) == 5000
+    assertValid(booked, 4)
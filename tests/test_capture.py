@@ -0,0 +1,151 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import threading
+
+from tvrecorder.capture import CaptureWriter, captureStream
+from tvrecorder.mpegts import PACKETSIZE
+from tvrecorder.scheduler import RecordingScheduler
+
+from tests.bookings import booking
+from tests.fakezap import alive, terminatedCapture
+from tests.tsfixture import TSFixture
+
+SERVICES = {4287: [101, 102]}
+
+
+def pipeFrom(data):
+    """A pipe with data written to it by a thread."""
+    rfd, wfd = os.pipe()
+
+    def writer():
+        with os.fdopen(wfd, "wb") as xfile:
+            xfile.write(data)
+
+    thread = threading.Thread(target=writer, daemon=True)
+    thread.start()
+    return rfd, thread
+
+
+def test_writer_buffers_and_preallocates(tmp_path):
+    path = tmp_path / "out.ts"
+    data = os.urandom(100000)
+    writer = CaptureWriter(path, size=1000000, bufsize=1, syncbytes=20000)
+    # the buffer is at least a page
+    assert writer.bufsize % 4096 == 0
+    for off in range(0, len(data), 777):
+        writer.write(data[off : off + 777])
+    assert writer.tell() == len(data)
+    if writer.preallocated:
+        assert path.stat().st_size == 1000000
+    writer.close()
+    assert path.read_bytes() == data
+    assert writer.writes == -(-len(data) // writer.bufsize)
+    assert writer.syncs >= 1
+
+
+def test_capture_counts_dropped_packets(tmp_path):
+    fix = TSFixture(SERVICES)
+    data = fix.stream(20000, ccerrors=0.01)
+    rfd, thread = pipeFrom(data)
+    path = tmp_path / "out.ts"
+    try:
+        with CaptureWriter(path, size=len(data) * 2) as writer:
+            stats = captureStream(rfd, writer)
+    finally:
+        thread.join()
+        os.close(rfd)
+    assert path.read_bytes() == data
+    assert stats["packets"] == 20000
+    assert stats["bytes"] == len(data)
+    assert fix.ccerrors > 0
+    assert stats["ccerrors"] == stats["dropped"] == fix.ccerrors
+    assert stats["resyncs"] == 0
+
+
+def test_capture_keeps_whole_packets(tmp_path):
+    fix = TSFixture(SERVICES)
+    data = fix.stream(1000)
+    cut = 500 * PACKETSIZE
+    rfd, thread = pipeFrom(data[:cut] + b"junk" + data[cut:] + b"\x47\x00")
+    path = tmp_path / "out.ts"
+    try:
+        with CaptureWriter(path) as writer:
+            stats = captureStream(rfd, writer)
+    finally:
+        thread.join()
+        os.close(rfd)
+    assert path.read_bytes() == data
+    assert stats["resyncs"] == 1
+    assert stats["dropped"] == 0
+
+
+def test_capture_skips_a_stray_sync_byte(tmp_path):
+    fix = TSFixture(SERVICES)
+    data = fix.stream(1000)
+    cut = 500 * PACKETSIZE
+    rfd, thread = pipeFrom(data[:cut] + b"ju\x47nk" + data[cut:])
+    path = tmp_path / "out.ts"
+    try:
+        with CaptureWriter(path) as writer:
+            stats = captureStream(rfd, writer)
+    finally:
+        thread.join()
+        os.close(rfd)
+    assert path.read_bytes() == data
+    assert stats["packets"] == 1000
+    assert stats["resyncs"] == 1
+
+
+def test_capture_stops_after_length(tmp_path):
+    rfd, wfd = os.pipe()
+    ticks = iter(range(100))
+    try:
+        with CaptureWriter(tmp_path / "out.ts") as writer:
+            stats = captureStream(rfd, writer, length=3, clock=lambda: next(ticks))
+    finally:
+        os.close(rfd)
+        os.close(wfd)
+    assert stats["packets"] == 0
+    assert next(ticks) < 10
+
+
+def test_scheduler_capture_command(tmp_path):
+    sched = RecordingScheduler(basedir=str(tmp_path), capture=True)
+    cmd = sched.zapCommand(booking("x", 1000, adaptor=1), 880, 2820)
+    assert cmd[1:] == [
+        "-m",
+        "tvrecorder.capture",
+        "-a",
+        "1",
+        "-t",
+        "2820",
+        "BBC ONE",
+        cmd[-1],
+    ]
+    assert cmd[-1].startswith(str(tmp_path / "x"))
+
+
+def test_terminated_capture_closes_its_file(tmp_path):
+    data = TSFixture(SERVICES).stream(1000)
+    path = tmp_path / "out.ts"
+    args = ["-t", "60", "BBC ONE", str(path)]
+    pid = terminatedCapture(tmp_path, "capture", args, data)
+    assert not alive(pid)
+    assert path.read_bytes() == data
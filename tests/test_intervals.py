@@ -0,0 +1,63 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+from tvrecorder.intervals import IntervalIndex
+
+
+def makeIndex(intervals):
+    idx = IntervalIndex()
+    for start, duration, item in intervals:
+        idx.add(start, duration, item)
+    return idx
+
+
+def labels(found):
+    return sorted(x[2] for x in found)
+
+
+def test_edge_touching_does_not_overlap():
+    idx = makeIndex([(0, 100, "a"), (200, 100, "b")])
+    assert idx.overlaps(100, 200) == []
+    assert labels(idx.overlaps(99, 201)) == ["a", "b"]
+
+
+def test_contained():
+    idx = makeIndex([(0, 1000, "long"), (2000, 10, "short")])
+    assert labels(idx.overlaps(400, 500)) == ["long"]
+    assert labels(idx.overlaps(1990, 2100)) == ["short"]
+
+
+def test_spanning():
+    idx = makeIndex([(x * 100, 100, f"p{x}") for x in range(10)])
+    assert labels(idx.overlaps(150, 450)) == ["p1", "p2", "p3", "p4"]
+    assert len(idx.overlaps(-50, 5000)) == 10
+
+
+def test_long_interval_found_from_far_start():
+    # the long interval starts well before the short ones
+    idx = makeIndex([(0, 10000, "film")] + [(x * 10, 10, x) for x in range(1, 50)])
+    found = idx.overlaps(9990, 9995)
+    assert [x[2] for x in found] == ["film"]
+
+
+def test_remove():
+    idx = makeIndex([(0, 100, "a"), (0, 50, "b"), (100, 100, "c")])
+    assert idx.remove(0, "b")
+    assert not idx.remove(0, "b")
+    assert labels(idx.overlaps(0, 100)) == ["a"]
+    assert len(idx) == 2
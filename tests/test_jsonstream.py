@@ -0,0 +1,56 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+import json
+
+import pytest
+
+from tvrecorder.jsonstream import iterJsonArray
+
+
+def split(data, size):
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+def test_any_chunk_boundary():
+    xlist = [
+        {"title": 'brackets ] [ and "quotes", commas', "cast": [1, 2, {"x": None}]},
+        12,
+        3.25,
+        "text",
+        [],
+        {},
+        "caf\u00e9 \u00a3",
+    ]
+    data = json.dumps(xlist, ensure_ascii=False).encode()
+    for size in range(1, len(data) + 1):
+        assert list(iterJsonArray(split(data, size))) == xlist
+
+
+def test_empty_array():
+    assert list(iterJsonArray([b" [", b" ] "])) == []
+
+
+def test_not_an_array():
+    with pytest.raises(Exception):
+        list(iterJsonArray([b'{"code": 1001}']))
+
+
+def test_truncated():
+    with pytest.raises(Exception):
+        list(iterJsonArray([b'[{"a": 1}, {"b"']))
@@ -0,0 +1,130 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+import pytest
+from sqlalchemy import inspect, text
+from sqlalchemy.orm import Session
+
+from tvrecorder import db
+from tvrecorder.config import Configuration
+from tvrecorder.db import createIndexes, createTables, getEngine, makeDBEngine, upsert
+from tvrecorder.models import Schedule
+from tvrecorder.wrangler import chanQuery, nowQuery, spanQuery
+
+
+def queryPlan(eng, sql):
+    with eng.connect() as conn:
+        rows = conn.execute(text(f"EXPLAIN QUERY PLAN {sql}")).fetchall()
+    return " ".join(row[-1] for row in rows)
+
+
+def ormPlan(eng, query):
+    """The plan of the SQL an ORM query sends."""
+    kwargs = {"literal_binds": True}
+    return queryPlan(eng, str(query.statement.compile(eng, compile_kwargs=kwargs)))
+
+
+def test_whats_on_now_range_scans_airdate(eng):
+    with Session(eng) as session:
+        plan = ormPlan(eng, nowQuery(session, 100000))
+    assert "ix_schedule_airdate (airdate>? AND airdate<?)" in plan
+
+
+def test_chan_progs_range_scans_station_airdate(eng):
+    with Session(eng) as session:
+        plan = ormPlan(eng, chanQuery(session, "1", 100000))
+    assert (
+        "ix_schedule_stationid_airdate (stationid=? AND airdate>? AND airdate<?)"
+        in plan
+    )
+
+
+def test_bulk_schedule_range_scans_station_airdate(eng):
+    with Session(eng) as session:
+        plan = ormPlan(eng, spanQuery(session, "1", 100000, 200000))
+    assert (
+        "ix_schedule_stationid_airdate (stationid=? AND airdate>? AND airdate<?)"
+        in plan
+    )
+
+
+def test_personmap_programid_index_used(eng):
+    sql = "SELECT * FROM personmap WHERE programid = 'EP1'"
+    assert "ix_personmap_programid" in queryPlan(eng, sql)
+
+
+def test_create_indexes_on_existing_database(eng):
+    with eng.begin() as conn:
+        conn.execute(text("DROP INDEX ix_schedule_airdate"))
+        conn.execute(text("DROP INDEX ix_personmap_programid"))
+    assert sorted(createIndexes(eng)) == [
+        "ix_personmap_programid",
+        "ix_schedule_airdate",
+    ]
+    names = {ix["name"] for ix in inspect(eng).get_indexes("schedule")}
+    assert "ix_schedule_airdate" in names
+    assert createIndexes(eng) == []
+
+
+def test_sqlite_engine(tmp_path):
+    cf = Configuration(appname="tvrecordertest")
+    cf.set("dbtype", "sqlite")
+    cf.set("dbpath", str(tmp_path / "tv.db"))
+    eng = makeDBEngine(cf)
+    createTables(eng)
+    with eng.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert conn.execute(text("PRAGMA synchronous")).scalar() == 1
+    rows = [
+        {"programid": "EP1", "stationid": "1", "airdate": 0, "duration": 60, "md5": "a"}
+    ]
+    for md5 in ("a", "b"):
+        rows[0]["md5"] = md5
+        with Session(eng) as session, session.begin():
+            upsert(session, Schedule, rows)
+    with Session(eng) as session:
+        assert [x.md5 for x in session.query(Schedule)] == ["b"]
+    eng.dispose()
+
+
+@pytest.fixture
+def engines():
+    """The getEngine cache, its engines are disposed and it is emptied
+    afterwards so they do not leak into other tests."""
+    yield db.engines
+    with db.enginelock:
+        for eng in db.engines.values():
+            eng.dispose()
+        db.engines.clear()
+
+
+def test_engine_is_shared_and_counted(tmp_path, engines):
+    cf = Configuration(appname="tvrecordertest")
+    cf.set("dbtype", "sqlite")
+    cf.set("dbpath", str(tmp_path / "tv.db"))
+    eng = getEngine(cf)
+    assert getEngine(cf) is eng
+    assert list(engines.values()) == [eng]
+    createTables(eng)
+    for _ in range(3):
+        with Session(eng) as session:
+            session.query(Schedule).count()
+    stats = eng.poolstats.summary()
+    assert stats["checkouts"] >= 3
+    assert stats["checkedout"] == 0
+    assert stats["connects"] >= 1
@@ -0,0 +1,242 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+import configparser
+import io
+import os
+import threading
+import time
+
+from tvrecorder.mpegts import PACKETSIZE, packetPid
+from tvrecorder.multiplex import (
+    ServiceDemux,
+    captureServices,
+    groupByMultiplex,
+    multiplexCommand,
+    multiplexKey,
+    serviceId,
+)
+from tvrecorder.scheduler import RecordingScheduler
+
+from tests.fakezap import alive, terminatedCapture
+from tests.bookings import booking
+from tests.tsfixture import TSFixture, packet, patSection
+
+ZAP = """
+[BBC ONE East E]
+	SERVICE_ID = 4287
+	VIDEO_PID = 101
+	AUDIO_PID = 102
+	FREQUENCY = 490000000
+	DELIVERY_SYSTEM = DVBT
+
+[BBC TWO]
+	SERVICE_ID = 4351
+	VIDEO_PID = 201
+	AUDIO_PID = 202
+	FREQUENCY = 490000000
+	DELIVERY_SYSTEM = DVBT
+
+[ITV1]
+	SERVICE_ID = 8261
+	FREQUENCY = 514000000
+	DELIVERY_SYSTEM = DVBT
+"""
+
+SERVICES = {4287: [101, 102], 4351: [201, 202], 8261: [301]}
+
+
+def zapConf():
+    zap = configparser.ConfigParser()
+    zap.read_string(ZAP)
+    return zap
+
+
+def pids(data):
+    return {packetPid(data, off) for off in range(0, len(data), PACKETSIZE)}
+
+
+def test_zap_conf():
+    zap = zapConf()
+    assert multiplexKey(zap, "BBC ONE East E") == multiplexKey(zap, "BBC TWO")
+    assert multiplexKey(zap, "ITV1") != multiplexKey(zap, "BBC TWO")
+    assert multiplexKey(zap, "Nowhere") is None
+    assert serviceId(zap, "BBC TWO") == 4351
+
+
+def test_group_overlapping_on_a_multiplex():
+    recs = [
+        booking("one", 0, channel="BBC ONE East E"),
+        booking("two", 600, channel="BBC TWO", priority=4),
+        booking("itv", 600, channel="ITV1"),
+        booking("later", 10000, channel="BBC TWO"),
+        booking("unknown", 0, channel="Nowhere"),
+    ]
+    units = groupByMultiplex(recs, zapConf())
+    assert [x["title"] for x in units] == [
+        "one + two",
+        "unknown",
+        "itv",
+        "later",
+    ]
+    group = units[0]
+    assert [x["serviceid"] for x in group["members"]] == [4287, 4351]
+    assert group["airdate"] == -120
+    assert group["duration"] == 600 + 1800 + 900 + 120
+    assert group["frontpadding"] == group["endpadding"] == 0
+    assert group["priority"] == 4
+    assert "members" not in units[2]
+
+
+def test_demux_by_service():
+    fix = TSFixture(SERVICES)
+    data = fix.stream(5000)
+    sinks = {4287: io.BytesIO(), 4351: io.BytesIO()}
+    demux = ServiceDemux(sinks)
+    for sid, sink in sinks.items():
+        demux.sinks[sid].append(sink)
+    # feed in pieces that split packets
+    for off in range(0, len(data), 1000):
+        demux.feed(data[off : off + 1000])
+    assert demux.packets == 5000
+    assert demux.resyncs == 0
+    one, two = sinks[4287].getvalue(), sinks[4351].getvalue()
+    assert pids(one) == {0, fix.pmtpids[4287], 101, 102}
+    assert pids(two) == {0, fix.pmtpids[4351], 201, 202}
+    # nothing after the service's first PMT is lost
+    offs = range(0, len(data), PACKETSIZE)
+    first = next(x for x in offs if packetPid(data, x) == fix.pmtpids[4287])
+    sent = [data[x : x + PACKETSIZE] for x in offs if x > first]
+    sent = [x for x in sent if packetPid(x) in (101, 102)]
+    got = [one[x : x + PACKETSIZE] for x in range(0, len(one), PACKETSIZE)]
+    assert [x for x in got if packetPid(x) in (101, 102)] == sent
+
+
+def test_demux_resyncs():
+    fix = TSFixture(SERVICES)
+    data = fix.stream(200)
+    sink = io.BytesIO()
+    demux = ServiceDemux([4351])
+    demux.sinks[4351].append(sink)
+    demux.feed(data[:1000] + b"\x00\x01\x02" + data[1000:])
+    assert demux.resyncs >= 1
+    assert len(sink.getvalue()) % PACKETSIZE == 0
+    assert pids(sink.getvalue()) <= {0, fix.pmtpids[4351], 201, 202}
+
+
+def test_demux_skips_a_stray_sync_byte():
+    fix = TSFixture(SERVICES)
+    data = fix.stream(200)
+    sink = io.BytesIO()
+    demux = ServiceDemux([4351])
+    demux.sinks[4351].append(sink)
+    cut = 100 * PACKETSIZE
+    # fed a byte at a time so the check of the next sync byte waits for it
+    for xbyte in data[:cut] + b"ju\x47nk" + data[cut:]:
+        demux.feed(bytes([xbyte]))
+    assert demux.packets == 200
+    assert demux.resyncs == 1
+    assert set(sink.getvalue()[::PACKETSIZE]) == {0x47}
+
+
+def test_demux_survives_corrupt_tables():
+    fix = TSFixture(SERVICES)
+    data = fix.stream(400)
+    # an adaptation field that fills the packet, yet says there is a payload
+    padded = bytes([0x47, 0x40, 0x00, 0x30, 183]) + b"\xff" * 183
+    pmtpid = fix.pmtpids[4287]
+    badpmt = bytes([0x47, 0x40 | (pmtpid >> 8), pmtpid & 0xFF, 0x30, 183])
+    badpmt += b"\xff" * 183
+    pointer = packet(0, 0, b"\xff" * 20, True)
+    # a damaged PAT that would move the service's PMT
+    tei = bytearray(packet(0, 0, b"\x00" + patSection({4287: 0x1FF0}), True))
+    tei[1] |= 0x80
+    sink = io.BytesIO()
+    demux = ServiceDemux([4287])
+    demux.sinks[4287].append(sink)
+    half = 200 * PACKETSIZE
+    # each corrupt packet ends a feed, so nothing follows it in the buffer
+    for xbytes in (data[:half], padded, pointer, badpmt, data[half:], bytes(tei)):
+        demux.feed(xbytes)
+    assert demux.packets == 404
+    assert demux.pmtpids == {4287: pmtpid}
+    assert demux.streams[4287] == {101, 102}
+    assert {101, 102} <= pids(sink.getvalue())
+
+
+def test_capture_services_from_a_pipe(tmp_path):
+    fix = TSFixture(SERVICES)
+    data = fix.stream(20000)
+    rfd, wfd = os.pipe()
+
+    def writer():
+        with os.fdopen(wfd, "wb") as xfile:
+            xfile.write(data)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    one, two, never = tmp_path / "one.ts", tmp_path / "two.ts", tmp_path / "never.ts"
+    records = [
+        (4287, 0, 100, str(one)),
+        (4351, 0, 100, str(two)),
+        (8261, 50, 100, str(never)),
+    ]
+    try:
+        written = captureServices(rfd, records, clock=lambda: 10)
+    finally:
+        thread.join()
+        os.close(rfd)
+    assert written == {str(one): one.stat().st_size, str(two): two.stat().st_size}
+    assert pids(one.read_bytes()) == {0, fix.pmtpids[4287], 101, 102}
+    assert pids(two.read_bytes()) == {0, fix.pmtpids[4351], 201, 202}
+    assert not never.exists()
+
+
+def test_terminated_multiplex_closes_its_files(tmp_path):
+    data = TSFixture(SERVICES).stream(2000)
+    now = int(time.time())
+    one, two = tmp_path / "one.ts", tmp_path / "two.ts"
+    args = ["-t", "60", "-s", "4287", str(now - 10), str(now + 60), str(one)]
+    args += ["-s", "4351", str(now - 10), str(now + 60), str(two), "BBC ONE"]
+    pid = terminatedCapture(tmp_path, "multiplex", args, data)
+    assert not alive(pid)
+    # flushed and cut to the whole packets written
+    for path in (one, two):
+        data = path.read_bytes()
+        assert 0 < len(data) < 2000 * PACKETSIZE
+        assert len(data) % PACKETSIZE == 0
+        assert set(data[::PACKETSIZE]) == {0x47}
+
+
+def test_group_command(tmp_path):
+    recs = [
+        booking("one", 1000, channel="BBC ONE East E"),
+        booking("two", 1600, channel="BBC TWO"),
+    ]
+    group = groupByMultiplex(recs, zapConf())[0]
+    group["adaptor"] = 2
+    sched = RecordingScheduler(basedir=str(tmp_path))
+    cmd = sched.zapCommand(group, 1000, 3000)
+    assert cmd[1:5] == ["-m", "tvrecorder.multiplex", "-a", "2"]
+    sids = [cmd[i + 1] for i, x in enumerate(cmd) if x == "-s"]
+    assert sids == ["4287", "4351"]
+    assert cmd[-1] == "BBC ONE East E"
+    # a late start names the file from when the recording began
+    cmd = multiplexCommand(group, 1000, 3000, basedir=str(tmp_path))
+    first = cmd.index("-s")
+    assert cmd[first + 2 : first + 4] == ["1000", str(1000 + 1800 + 900)]
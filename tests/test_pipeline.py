@@ -0,0 +1,83 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+import time
+
+import pytest
+
+from tvrecorder.pipeline import Pipeline
+
+
+def test_stages_in_order():
+    stages = [("double", lambda x: x * 2), ("odd", lambda x: x if x % 4 else None)]
+    for threaded in (True, False):
+        pipe = Pipeline(range(10), stages, maxsize=2)
+        assert pipe.run(threaded=threaded) == [2, 6, 10, 14, 18]
+        stats = pipe.summary()
+        assert stats["fetch"]["items"] == 10
+        assert stats["double"]["items"] == 10
+        assert stats["odd"]["items"] == 10
+
+
+def test_queues_are_bounded():
+    def slow(x):
+        time.sleep(0.002)
+        return x
+
+    pipe = Pipeline(range(50), [("slow", slow)], maxsize=3)
+    assert len(pipe.run()) == 50
+    stats = pipe.summary()["slow"]
+    assert 0 < stats["maxdepth"] <= 3
+    assert stats["avgdepth"] > 1
+
+
+def test_stages_overlap():
+    def fetch():
+        for x in range(10):
+            time.sleep(0.01)
+            yield x
+
+    def write(x):
+        time.sleep(0.01)
+        return x
+
+    took = []
+    for threaded in (False, True):
+        start = time.perf_counter()
+        Pipeline(fetch(), [("write", write)]).run(threaded=threaded)
+        took.append(time.perf_counter() - start)
+    assert took[1] < took[0] * 0.75
+
+
+def test_failure_stops_the_pipeline():
+    fetched = []
+
+    def source():
+        for x in range(1000):
+            fetched.append(x)
+            yield x
+
+    def write(x):
+        if x == 5:
+            raise ValueError("bad row")
+        return x
+
+    pipe = Pipeline(source(), [("write", write)], maxsize=2)
+    with pytest.raises(ValueError):
+        pipe.run()
+    assert len(fetched) < 1000
@@ -0,0 +1,141 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+import time
+
+import pytest
+
+from tvrecorder.retry import RetryPolicy, TokenBucket
+from tvrecorder.sdapi import SDApi
+
+from tests.stubserver import StubServer
+
+PROGS = [{"programID": "EP1", "md5": "a"}]
+
+
+@pytest.fixture
+def waits(monkeypatch):
+    xwaits = []
+    monkeypatch.setattr("tvrecorder.sdapi.time.sleep", xwaits.append)
+    return xwaits
+
+
+def routeCount(srv, route):
+    return len([req for req in srv.requests if req[1] == route])
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_server_errors_are_retried(waits, stream):
+    faults = {"programs": [503, 502, 500]}
+    with StubServer({"programs": PROGS}, faults=faults) as srv:
+        sd = SDApi(url=srv.url, stream=stream)
+        assert list(sd.getPrograms(["EP1"])) == PROGS
+        sd.close()
+    assert routeCount(srv, "programs") == 4
+    assert sd.retried == 3
+    # full jitter keeps each wait below the exponential cap
+    assert all(0 <= wait <= 0.5 * 2**n for n, wait in enumerate(waits))
+
+
+def test_connection_reset_is_retried(waits):
+    with StubServer({"available": []}, faults={"available": ["reset"]}) as srv:
+        sd = SDApi(url=srv.url)
+        assert sd.available() == []
+        sd.close()
+    assert routeCount(srv, "available") == 2
+
+
+def test_dropped_stream_is_resent(waits):
+    progs = [
+        {"programID": f"EP{x}", "md5": "m", "desc": str(x) * 500} for x in range(50)
+    ]
+    faults = {"programs": ["truncate"]}
+    with StubServer({"programs": progs}, faults=faults) as srv:
+        sd = SDApi(url=srv.url, stream=True)
+        assert list(sd.getPrograms([x["programID"] for x in progs])) == progs
+        sd.close()
+    assert routeCount(srv, "programs") == 2
+    assert sd.retried == 1
+
+
+def test_retry_after_is_honoured(waits):
+    faults = {"programs": [(429, {"Retry-After": "7"})]}
+    with StubServer({"programs": PROGS}, faults=faults) as srv:
+        sd = SDApi(url=srv.url)
+        assert sd.getPrograms(["EP1"]) == PROGS
+        sd.close()
+    assert waits == [7]
+
+
+def test_gives_up_after_max_attempts(waits):
+    with StubServer({"programs": PROGS}, faults={"programs": [503] * 10}) as srv:
+        sd = SDApi(url=srv.url, retries=3)
+        assert sd.getPrograms(["EP1"]) is None
+        sd.close()
+    assert routeCount(srv, "programs") == 3
+
+
+def test_changes_are_not_repeated(waits):
+    faults = {"lineups/GBR-TEST": [500], "lineups/GBR-SLOW": [429]}
+    with StubServer(
+        {"lineups/GBR-TEST": {}, "lineups/GBR-SLOW": {}}, faults=faults
+    ) as srv:
+        sd = SDApi(url=srv.url)
+        assert sd.apiPost("lineups/GBR-TEST", {}).status_code == 500
+        # too many requests means the server did nothing
+        assert sd.apiPost("lineups/GBR-SLOW", {}).status_code == 200
+        sd.close()
+    assert routeCount(srv, "lineups/GBR-TEST") == 1
+    assert routeCount(srv, "lineups/GBR-SLOW") == 2
+
+
+def test_retry_after_date():
+    policy = RetryPolicy(maxretryafter=60)
+    assert policy.retryAfter("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert policy.retryAfter("Fri, 31 Dec 9999 23:59:59 GMT") == 60
+    assert policy.retryAfter("soon") == 0
+
+
+def test_token_bucket():
+    now = [0.0]
+    slept = []
+
+    def sleep(secs):
+        slept.append(round(secs, 6))
+        now[0] += secs
+
+    bucket = TokenBucket(10, burst=2, clock=lambda: now[0], sleep=sleep)
+    for _ in range(4):
+        bucket.acquire()
+    assert slept == [0.1, 0.1]
+    now[0] += 10
+    bucket.acquire()
+    bucket.acquire()
+    assert len(slept) == 2
+
+
+def test_rate_limited_requests():
+    with StubServer({"available": []}) as srv:
+        sd = SDApi(url=srv.url, rate=50, burst=1)
+        start = time.monotonic()
+        for _ in range(5):
+            sd.available()
+        took = time.monotonic() - start
+        sd.close()
+    assert sd.limiter.waited > 0
+    assert took >= 0.08
@@ -0,0 +1,202 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+import sys
+import threading
+import time
+
+from sqlalchemy.orm import Session
+
+from tvrecorder.models import Recording
+from tvrecorder.scheduler import RecordingScheduler, recordingKey
+from tvrecorder.wrangler import pendingRecordings, setRecordingStatus
+
+from tests.bookings import booking
+
+
+class FakeClock:
+    def __init__(self, now=0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class StubRecorder:
+    """Records what would have been recorded, the process it starts exits
+    with rc."""
+
+    def __init__(self, rc=0, secs=0):
+        self.calls = []
+        self.rc = rc
+        self.secs = secs
+
+    def __call__(self, rec, start, length):
+        self.calls.append((rec["title"], start, length))
+        code = f"import sys, time; time.sleep({self.secs}); sys.exit({self.rc})"
+        return [sys.executable, "-c", code]
+
+
+def test_wakes_when_the_next_recording_is_due():
+    clock = FakeClock(10000)
+    stub = StubRecorder()
+    sched = RecordingScheduler(command=stub, clock=clock)
+    assert sched.step() is None
+    sched.add(booking("b", 20000))
+    sched.add(booking("a", 15000))
+    sched.add(booking("c", 20000, frontpadding=0))
+    assert sched.step() == 15000 - 120 - 10000
+    clock.now = 15000 - 120
+    assert sched.step() == 20000 - 120 - clock.now
+    assert stub.calls == [("a", 14880, 1800 + 120 + 900)]
+    clock.now = 20000
+    assert sched.step() is None
+    assert [x[0] for x in stub.calls] == ["a", "b", "c"]
+    assert sched.waitIdle(10)
+    assert [rc for _, rc in sched.finished] == [0, 0, 0]
+
+
+def test_late_and_missed_recordings():
+    clock = FakeClock(10000 + 600)
+    stub = StubRecorder()
+    changes = []
+    kwargs = {
+        "command": stub,
+        "clock": clock,
+        "onchange": lambda r, s: changes.append((r["title"], s)),
+    }
+    sched = RecordingScheduler(**kwargs)
+    sched.add(booking("late", 10000))
+    sched.add(booking("gone", 5000))
+    sched.step()
+    # started ten minutes into the programme, it still ends on time
+    assert stub.calls == [("late", 10600, 1800 + 900 - 600)]
+    assert sched.waitIdle(10)
+    assert sorted(changes) == [
+        ("gone", "missed"),
+        ("late", "done"),
+        ("late", "recording"),
+    ]
+
+
+def test_cancel_and_replace():
+    clock = FakeClock(0)
+    stub = StubRecorder()
+    sched = RecordingScheduler(command=stub, clock=clock)
+    a, b, c = booking("a", 1000), booking("b", 2000), booking("c", 3000)
+    [sched.add(x) for x in (a, b, c)]
+    assert sched.cancel(recordingKey(a))
+    assert not sched.cancel(recordingKey(a))
+    # the cancelled entry does not set the wake up time
+    assert sched.step() == 2000 - 120
+    # rebooking with more padding moves it
+    sched.add(booking("b", 2000, frontpadding=600))
+    assert sched.step() == 2000 - 600
+    sched.replace([c])
+    assert len(sched) == 1
+    clock.now = 5000
+    sched.step()
+    assert stub.calls == [("c", 5000, 3000 + 1800 + 900 - 5000)]
+    sched.waitIdle(10)
+
+
+def test_replace_during_a_step_wakes_the_scheduler():
+    stub = StubRecorder()
+    now = int(time.time())
+    replacing = []
+
+    def clock():
+        # a reload that lands while the empty heap is being looked at
+        if not replacing:
+            due = [booking("due", now + 120, frontpadding=120)]
+            replacing.append(threading.Thread(target=sched.replace, args=(due,)))
+            replacing[0].start()
+            time.sleep(0.05)
+        return time.time()
+
+    sched = RecordingScheduler(command=stub, clock=clock)
+    thread = threading.Thread(target=sched.run, daemon=True)
+    thread.start()
+    deadline = time.time() + 5
+    while not stub.calls and time.time() < deadline:
+        time.sleep(0.01)
+    assert [x[0] for x in stub.calls] == ["due"]
+    sched.stop()
+    thread.join(5)
+    assert not thread.is_alive()
+
+
+def test_nothing_starts_after_stop():
+    stub = StubRecorder()
+    sched = RecordingScheduler(command=stub, clock=FakeClock(1000))
+    sched.add(booking("x", 1000))
+    sched.stop()
+    assert sched.step() is None
+    assert stub.calls == []
+    assert len(sched) == 1
+
+
+def test_failed_recording():
+    changes = []
+    kwargs = {
+        "command": StubRecorder(rc=3),
+        "clock": FakeClock(1000),
+        "onchange": lambda r, s: changes.append(s),
+    }
+    sched = RecordingScheduler(**kwargs)
+    sched.add(booking("x", 1000))
+    sched.step()
+    assert sched.waitIdle(10)
+    assert changes == ["recording", "failed"]
+    assert sched.finished[0][1] == 3
+
+
+def test_idle_with_hundreds_queued():
+    stub = StubRecorder(secs=0.2)
+    sched = RecordingScheduler(command=stub)
+    now = int(time.time())
+    for x in range(500):
+        sched.add(booking(f"p{x}", now + 3600 + x * 60))
+    thread = threading.Thread(target=sched.run, daemon=True)
+    thread.start()
+    start = time.process_time()
+    time.sleep(0.3)
+    assert sched.wakeups <= 2
+    # a booking that is due now wakes the scheduler at once
+    sched.add(booking("now", now + 120, frontpadding=120))
+    deadline = time.time() + 5
+    while not stub.calls and time.time() < deadline:
+        time.sleep(0.01)
+    assert stub.calls[0][0] == "now"
+    assert len(sched.running) == 1
+    sched.stop()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert time.process_time() - start < 0.5
+    assert len(sched) == 500
+
+
+def test_pending_recordings(eng):
+    with Session(eng) as session, session.begin():
+        session.add(Recording(**booking("old", 1000)))
+        session.add(Recording(**booking("new", 100000)))
+        session.add(Recording(**booking("done", 100000, programid="EPd")))
+    setRecordingStatus(eng, booking("done", 100000, programid="EPd"), "done")
+    recs = pendingRecordings(eng, now=50000)
+    assert [x["title"] for x in recs] == ["new"]
+    assert recs[0]["status"] == "pending"
@@ -0,0 +1,119 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+import json
+
+from tvrecorder.sdapi import SDApi, routeName
+
+from tests.stubserver import StubServer
+
+
+def test_session_reuses_connection():
+    with StubServer({"available": [{"type": "COUNTRIES"}]}) as srv:
+        sd = SDApi(url=srv.url)
+        for _ in range(5):
+            resp = sd.available()
+        sd.close()
+        assert resp == [{"type": "COUNTRIES"}]
+        assert srv.connections == 1
+
+
+def test_session_without_keepalive():
+    with StubServer({"available": []}) as srv:
+        sd = SDApi(url=srv.url, keepalive=False)
+        for _ in range(3):
+            sd.available()
+        sd.close()
+        assert srv.connections == 3
+
+
+def test_token_shared_with_session():
+    status = {"date": "2022-07-01T00:00:00Z", "status": "Online", "message": "OK"}
+    with StubServer({"status": {"systemStatus": [status]}}) as srv:
+        sd = SDApi(url=srv.url)
+        sd.apiOnline()
+        sd.close()
+        assert sd.online
+        assert srv.requests[0][1] == "token"
+        assert srv.requests[1][2]["token"] == "stubtoken"
+        assert srv.connections == 1
+
+
+def test_program_batches_are_chunked():
+    def programs(body):
+        return [{"programID": progid, "md5": "x"} for progid in body]
+
+    progids = [f"EP{x:08d}" for x in range(1234)]
+    with StubServer({"programs": programs}) as srv:
+        sd = SDApi(url=srv.url, workers=3)
+        batches = list(sd.programBatches(progids, chunksize=100))
+        sd.close()
+    assert len(batches) == 13
+    assert max(len(batch) for batch in batches) == 100
+    got = sorted(prog["programID"] for batch in batches for prog in batch)
+    assert got == progids
+    posts = [req for req in srv.requests if req[1] == "programs"]
+    assert len(posts) == 13
+    assert all(req[2]["token"] == "stubtoken" for req in posts)
+
+
+def test_schedule_batches_are_capped():
+    def schedules(body):
+        return [{"stationID": chan["stationID"], "programs": []} for chan in body]
+
+    chans = [{"stationID": str(x), "date": ["2022-07-01"]} for x in range(20)]
+    with StubServer({"schedules": schedules}) as srv:
+        sd = SDApi(url=srv.url)
+        batches = list(sd.scheduleBatches(chans, chunksize=8))
+        sd.close()
+    assert sorted(len(batch) for batch in batches) == [4, 8, 8]
+
+
+def test_streamed_programs():
+    progs = [{"programID": f"EP{x}", "md5": "m", "cast": ["x"] * x} for x in range(50)]
+    with StubServer({"programs": progs}) as srv:
+        sd = SDApi(url=srv.url, stream=True)
+        got = sd.getPrograms([x["programID"] for x in progs])
+        assert not isinstance(got, list)
+        assert list(got) == progs
+        sd.close()
+
+
+def test_transfer_is_compressed_and_counted():
+    progs = [
+        {"programID": f"EP{x}", "md5": "m", "desc": "words " * 50} for x in range(40)
+    ]
+    for stream in (False, True):
+        with StubServer({"programs": progs}) as srv:
+            sd = SDApi(url=srv.url, stream=stream)
+            assert list(sd.getPrograms(["EP1"])) == progs
+            totals = sd.transferSummary()
+            sd.close()
+        assert "gzip" in srv.requests[-1][2]["Accept-Encoding"]
+        stats = sd.transfer["programs"]
+        assert stats["requests"] == 1
+        assert stats["decoded"] == len(json.dumps(progs))
+        assert 0 < stats["wire"] < stats["decoded"] / 10
+        assert totals["requests"] == 2
+        assert "token" in sd.transfer
+
+
+def test_route_names():
+    assert routeName("schedules/md5") == "schedules/md5"
+    assert routeName("lineups/GBR-1000193-DEFAULT") == "lineups"
+    assert routeName("lineups/preview/GBR-1000193-DEFAULT") == "lineups/preview"
@@ -0,0 +1,159 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+from datetime import datetime, timezone
+import os
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+
+from tvrecorder.db import createTables
+from tvrecorder.models import Channel, Program, Schedule, Schedulemd5
+from tvrecorder.sdapi import SDApi
+from tvrecorder.sdcache import SDCache
+from tvrecorder.wrangler import rebuildFromCache, schedules, updateChannels
+
+from tests.stubserver import StubServer
+from tests.test_wrangler import makeProgram
+
+
+def test_put_get(tmp_path):
+    cache = SDCache(tmp_path)
+    assert cache.get("programs", "abc") is None
+    cache.put("programs", "abc", {"programID": "EP1", "md5": "abc"})
+    assert cache.has("programs", "abc")
+    assert cache.get("programs", "abc") == {"programID": "EP1", "md5": "abc"}
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert list(cache.items("programs")) == [{"programID": "EP1", "md5": "abc"}]
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    cache = SDCache(tmp_path, maxsize=10**9)
+    for x in range(10):
+        cache.put("programs", f"md5{x:02d}", {"desc": os.urandom(200).hex()})
+        os.utime(cache.path("programs", f"md5{x:02d}"), (x, x))
+    # reading the oldest makes it the most recently used
+    cache.get("programs", "md500")
+    cache.maxsize = cache.diskSize() // 2
+    with cache.lock:
+        cache.evict()
+    assert cache.diskSize() <= cache.maxsize
+    assert cache.has("programs", "md500")
+    assert not cache.has("programs", "md501")
+    assert cache.has("programs", "md509")
+
+
+def test_cached_programs_are_not_downloaded(tmp_path):
+    fetched = []
+
+    def programs(body):
+        fetched.extend(body)
+        return [makeProgram(progid, f"m{progid}") for progid in body]
+
+    md5s = {f"EP{x}": f"mEP{x}" for x in range(10)}
+    with StubServer({"programs": programs}) as srv:
+        sd = SDApi(url=srv.url, cache=SDCache(tmp_path))
+        first = [p for batch in sd.programBatches(list(md5s), md5s=md5s) for p in batch]
+        fetched.clear()
+        md5s["EP10"] = "mEP10"
+        again = [p for batch in sd.programBatches(list(md5s), md5s=md5s) for p in batch]
+        sd.close()
+    assert fetched == ["EP10"]
+    assert len(first) == 10
+    assert sorted(p["programID"] for p in again) == sorted(md5s)
+
+
+def test_rebuild_from_cache(eng, tmp_path):
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    lineup = {
+        "map": [{"stationID": "1001", "channel": "1"}],
+        "stations": [{"stationID": "1001", "name": "One", "callsign": "ONE"}],
+        "metadata": {"lineup": "GBR-TEST", "modified": "2022-07-01T00:00:00Z"},
+    }
+    airings = [
+        {
+            "programID": f"EP{x}",
+            "md5": f"p{x}",
+            "airDateTime": f"{today}T{x:02d}:00:00Z",
+            "duration": 3600,
+        }
+        for x in range(4)
+    ]
+
+    def md5s(body):
+        day = {"md5": "s1", "lastModified": f"{today}T00:00:00Z"}
+        return {chan["stationID"]: {today: day} for chan in body}
+
+    def scheds(body):
+        meta = {"startDate": today, "md5": "s1", "modified": f"{today}T00:00:00Z"}
+        return [
+            {"stationID": chan["stationID"], "programs": airings, "metadata": meta}
+            for chan in body
+        ]
+
+    def programs(body):
+        return [makeProgram(progid, f"p{progid[2:]}") for progid in body]
+
+    routes = {
+        "lineups/GBR-TEST": lineup,
+        "schedules/md5": md5s,
+        "schedules": scheds,
+        "programs": programs,
+    }
+    with StubServer(routes) as srv:
+        sd = SDApi(url=srv.url, cache=SDCache(tmp_path))
+        updateChannels(sd.getLineup("GBR-TEST"), eng)
+        with Session(eng) as session, session.begin():
+            session.query(Channel).update({"getdata": 1})
+        schedules(sd, eng)
+        sd.close()
+
+    fresh = create_engine(
+        "sqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    createTables(fresh)
+    sd = SDApi(url="http://127.0.0.1:9", cache=SDCache(tmp_path))
+    assert rebuildFromCache(sd, fresh) == (1, 4)
+    with Session(fresh) as session:
+        assert session.query(Channel).count() == 1
+        assert session.query(Schedule).count() == 4
+        assert session.query(Program).count() == 4
+        assert session.query(Schedulemd5).one().md5 == "s1"
+    fresh.dispose()
+
+
+def test_unreadable_cache_entries_are_downloaded(tmp_path):
+    fetched = []
+
+    def programs(body):
+        fetched.extend(body)
+        return [makeProgram(progid, f"m{progid}") for progid in body]
+
+    md5s = {f"EP{x}": f"mEP{x}" for x in range(5)}
+    with StubServer({"programs": programs}) as srv:
+        sd = SDApi(url=srv.url, cache=SDCache(tmp_path))
+        [p for batch in sd.programBatches(list(md5s), md5s=md5s) for p in batch]
+        fetched.clear()
+        sd.cache.path("programs", "mEP3").write_bytes(b"not gzip")
+        again = [p for batch in sd.programBatches(list(md5s), md5s=md5s) for p in batch]
+        sd.close()
+    assert fetched == ["EP3"]
+    assert sorted(p["programID"] for p in again) == sorted(md5s)
@@ -0,0 +1,74 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+import calendar
+import time
+
+from sqlalchemy.orm import Session
+
+from tvrecorder.models import Channel, Program, Schedule, Schedulemd5
+from tvrecorder.sdapi import SDApi
+from tvrecorder.wrangler import schedules, updateChannels
+
+from tests.sdfixture import SDFixture
+
+
+def airTime(airing):
+    return calendar.timegm(time.strptime(airing["airDateTime"], "%Y-%m-%dT%H:%M:%SZ"))
+
+
+def test_fixture_is_repeatable():
+    one = SDFixture(channels=3, days=2, start=0, seed=7)
+    two = SDFixture(channels=3, days=2, start=0, seed=7)
+    assert one.schedules == two.schedules
+    assert one.programs == two.programs
+    counts = one.counts()
+    assert counts["schedules"] == 6
+    assert counts["programs"] < counts["airings"]
+    # each day is filled from midnight to midnight
+    for sched in one.schedules.values():
+        first = airTime(sched["programs"][0])
+        assert first % 86400 == 0
+        last = sched["programs"][-1]
+        assert airTime(last) + last["duration"] == first + 86400
+
+
+def test_update_run_against_the_fixture(eng):
+    fix = SDFixture(channels=4, days=3)
+    with fix.server() as srv:
+        sd = SDApi(url=srv.url)
+        sd.apiOnline()
+        assert sd.online
+        lineup = sd.lineups[0]["lineup"]
+        updateChannels(sd.getLineup(lineup), eng)
+        with Session(eng) as session, session.begin():
+            session.query(Channel).update({"getdata": 1})
+        assert schedules(sd, eng)
+        # a later run only fetches the schedules that changed
+        assert fix.touch(0.25) == 3
+        before = len(srv.requests)
+        assert schedules(sd, eng)
+        sd.close()
+    bodies = [req for req in srv.requests[before:] if req[1] == "schedules"]
+    assert len(bodies) == 1
+    counts = fix.counts()
+    with Session(eng) as session:
+        assert session.query(Channel).count() == counts["stations"]
+        assert session.query(Schedulemd5).count() == counts["schedules"] + 3
+        assert session.query(Schedule).count() == counts["airings"]
+        assert session.query(Program).count() == counts["programs"]
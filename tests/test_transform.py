@@ -0,0 +1,125 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+from sqlalchemy.orm import Session
+
+from tvrecorder.models import Person, Personmap, Program
+from tvrecorder.transform import creditRows, programRow, transformPrograms
+from tvrecorder import wrangler
+from tvrecorder.wrangler import storePrograms
+
+from tests.test_wrangler import makeProgram
+
+
+def castProgram(progid, md5, people):
+    prog = makeProgram(progid, md5)
+    prog["cast"] = [
+        {"personId": str(p), "nameId": str(p + 1000), "name": f"actor {p}", "role": "x"}
+        for p in people
+    ]
+    return prog
+
+
+def test_program_row():
+    prog = makeProgram("EP1", "m")
+    prog["episodeTitle150"] = "Pilot"
+    prog["descriptions"]["description1000"] = [{"description": "long"}]
+    prog["metadata"] = [{"Gracenote": {"season": 2, "episode": 5}}]
+    assert programRow(prog) == (
+        "EP1",
+        "m",
+        "Title EP1",
+        "2022-07-01",
+        "Pilot",
+        "short",
+        "long",
+        2,
+        5,
+    )
+
+
+def test_credit_rows():
+    prog = castProgram("EP1", "m", [1, 2, 1])
+    persons, maps = creditRows(prog)
+    assert len(persons) == 3
+    assert maps == [(1, "EP1", "x", "0"), (2, "EP1", "x", "0")]
+    programs, persons, maps = transformPrograms([prog, castProgram("EP2", "m", [2, 3])])
+    assert [x[0] for x in programs] == ["EP1", "EP2"]
+    assert sorted(x[0] for x in persons) == [1, 2, 3]
+    assert len(maps) == 4
+
+
+def storedRows(eng):
+    with Session(eng) as session:
+        return (
+            sorted((x.programid, x.md5, x.title) for x in session.query(Program)),
+            sorted(x.personid for x in session.query(Person)),
+            sorted((x.personid, x.programid) for x in session.query(Personmap)),
+        )
+
+
+def test_worker_processes_store_the_same_rows(eng):
+    batches = [
+        [castProgram(f"EP{b}{x}", "m", range(x, x + 5)) for x in range(120)]
+        for b in range(3)
+    ]
+    results = []
+    for workers in (0, 2):
+        for model in (Personmap, Person, Program):
+            with Session(eng) as session, session.begin():
+                session.query(model).delete()
+        assert storePrograms(batches, eng, workers=workers) == 360
+        results.append(storedRows(eng))
+    assert results[0] == results[1]
+    assert len(results[0][0]) == 360
+    assert len(results[0][1]) == 124
+
+
+def test_changed_program_is_replaced(eng):
+    storePrograms([[castProgram("EP1", "old", [1])]], eng)
+    storePrograms([[castProgram("EP1", "old", [1]), makeProgram("EP2", "a")]], eng)
+    new = castProgram("EP1", "new", [1, 2])
+    new["titles"] = [{"title120": "Renamed"}]
+    storePrograms([[new]], eng)
+    programs, persons, maps = storedRows(eng)
+    assert programs == [("EP1", "new", "Renamed"), ("EP2", "a", "Title EP2")]
+    assert persons == [1, 2]
+    assert maps == [(1, "EP1"), (2, "EP1")]
+
+
+def test_streamed_batch_is_not_read_up_front(eng, monkeypatch):
+    read = [0]
+    seen = []
+
+    def stream():
+        # a streamed response, programmes parsed one at a time
+        for x in range(20000):
+            read[0] += 1
+            yield makeProgram(f"EP{x}", "m")
+
+    store = wrangler.storeProgramRows
+
+    def storeProgramRows(rows, persons, session):
+        seen.append(read[0])
+        return store(rows, persons, session)
+
+    monkeypatch.setattr(wrangler, "storeProgramRows", storeProgramRows)
+    assert storePrograms([stream()], eng, chunksize=100) == 20000
+    # at most the queues' worth of chunks are read ahead of the writer
+    assert seen[0] < 5000
+    assert len(seen) == 200
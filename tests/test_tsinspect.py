@@ -0,0 +1,138 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+import json
+import os
+import sys
+
+from tvrecorder.capture import CaptureWriter, captureStream
+from tvrecorder.mpegts import PACKETSIZE, packetPid
+from tvrecorder.scheduler import RecordingScheduler
+from tvrecorder.tsinspect import TSInspector, healthPath, inspectRecording
+
+from tests.bookings import booking
+from tests.tsfixture import PCRTICKS, TSFixture, packet
+
+SERVICES = {4287: [101, 102], 4351: [201, 202]}
+
+
+def recording(tmp_path, data, name="rec.ts"):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return path
+
+
+def test_clean_recording(tmp_path):
+    fix = TSFixture(SERVICES)
+    path = recording(tmp_path, fix.stream(10000))
+    summary = inspectRecording(path)
+    assert summary["healthy"]
+    assert summary["packets"] == 10000
+    assert summary["pids"] == {str(k): v for k, v in fix.pidcounts.items()}
+    assert summary["duration"] > 0.9 * 10000 * PCRTICKS / 27e6
+    with open(healthPath(path)) as xfile:
+        assert json.load(xfile) == summary
+    assert healthPath(path).name == "rec.health.json"
+
+
+def test_continuity_errors_and_pcr_gaps(tmp_path):
+    fix = TSFixture(SERVICES)
+    data = fix.stream(20000, ccerrors=0.005, pcrgap=(5000, 27_000_000))
+    # a small window, so errors straddle the windows
+    summary = TSInspector(window=PACKETSIZE * 333).inspect(recording(tmp_path, data))
+    assert fix.ccerrors > 0
+    assert summary["ccerrors"] == summary["lost"] == fix.ccerrors
+    # both services' PCRs jump by a second
+    assert summary["pcrgaps"] == 2
+    assert summary["maxpcrgap"] >= 1
+    assert not summary["healthy"]
+
+
+def test_inspector_and_capture_agree(tmp_path):
+    fix = TSFixture(SERVICES)
+    data = fix.stream(5000, ccerrors=0.005)
+    pkts = [
+        bytearray(data[x : x + PACKETSIZE]) for x in range(0, len(data), PACKETSIZE)
+    ]
+    payload = [x for x in pkts if packetPid(x) in (101, 202)]
+    # damaged packets, whose counters do not count
+    for pkt in payload[100::400]:
+        pkt[1] |= 0x80
+    # repeated packets
+    for pkt in payload[150::400]:
+        pkts.insert(pkts.index(pkt), bytearray(pkt))
+    # a discontinuity on each PID, its counter jumps without loss
+    for pid in (101, 202):
+        pkt = bytearray(packet(pid, 9, b"\x00" * 100))
+        pkt[5] = 0x80
+        pkts.insert(len(pkts) // 2, pkt)
+    path = recording(tmp_path, b"".join(pkts))
+    summary = TSInspector(window=PACKETSIZE * 333).inspect(path)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        with CaptureWriter(tmp_path / "copy.ts") as writer:
+            stats = captureStream(fd, writer)
+    finally:
+        os.close(fd)
+    assert summary["transporterrors"] == stats["transporterrors"] > 0
+    assert summary["ccerrors"] == stats["ccerrors"] > fix.ccerrors
+    assert summary["lost"] == stats["dropped"]
+
+
+def test_lost_sync(tmp_path):
+    fix = TSFixture(SERVICES)
+    data = fix.stream(3000)
+    cut = 1000 * PACKETSIZE
+    damaged = b"\x00\x47\x00" + data[:cut] + b"junk\x47" + data[cut:] + b"\x47\x00"
+    summary = TSInspector(window=PACKETSIZE * 100).inspect(recording(tmp_path, damaged))
+    assert summary["packets"] == 3000
+    assert summary["resyncs"] == 1
+    assert summary["skipped"] == 3 + 5 + 2
+    assert summary["ccerrors"] == 0
+
+
+def test_transport_errors(tmp_path):
+    fix = TSFixture(SERVICES)
+    data = bytearray(fix.stream(1000))
+    for n in (10, 20, 30):
+        data[n * PACKETSIZE + 1] |= 0x80
+    summary = TSInspector().inspect(recording(tmp_path, bytes(data)))
+    assert summary["transporterrors"] == 3
+    assert not summary["healthy"]
+
+
+def test_empty_file(tmp_path):
+    summary = TSInspector().inspect(recording(tmp_path, b""))
+    assert summary["packets"] == 0
+
+
+def test_scheduler_postprocess(tmp_path):
+    seen = []
+    kwargs = {
+        "command": lambda rec, start, length: [sys.executable, "-c", "pass"],
+        "clock": lambda: 1000,
+        "basedir": str(tmp_path),
+        "postprocess": lambda rec, paths: seen.append(paths),
+    }
+    sched = RecordingScheduler(**kwargs)
+    sched.add(booking("x", 1000))
+    sched.step()
+    for watcher in sched.watchers:
+        watcher.join(10)
+    assert len(seen) == 1
+    assert seen[0][0].parent == tmp_path / "x"
@@ -0,0 +1,482 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+from datetime import datetime, timezone
+import random
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from tvrecorder.models import (
+    Channel,
+    Person,
+    Personmap,
+    Program,
+    Schedule,
+    Schedulemd5,
+    Updaterun,
+)
+from tvrecorder.sdapi import SDApi
+from tvrecorder.wrangler import (
+    addSchedule,
+    bulkSchedule,
+    chanProgs,
+    cleanSchedule,
+    finishRun,
+    missingPrograms,
+    runProgress,
+    schedules,
+    schedulesMd5,
+    startRun,
+    updatePrograms,
+    whatsOnNow,
+)
+
+from tests.stubserver import StubServer
+
+
+def makeProgram(progid, md5):
+    return {
+        "programID": progid,
+        "md5": md5,
+        "titles": [{"title120": f"Title {progid}"}],
+        "descriptions": {"description100": [{"description": "short"}]},
+        "originalAirDate": "2022-07-01",
+    }
+
+
+def addChannels(eng, stationids):
+    with Session(eng) as session, session.begin():
+        for sid in stationids:
+            session.add(Channel(stationid=sid, name=f"chan {sid}", getdata=1))
+
+
+def test_missing_programs(eng):
+    with Session(eng) as session, session.begin():
+        session.add(Program(programid="EP1", md5="a", title="one"))
+        session.add(Program(programid="EP2", md5="b", title="two"))
+    wanted = {"EP1": "a", "EP2": "changed", "EP3": "c"}
+    assert sorted(missingPrograms(eng, wanted)) == ["EP2", "EP3"]
+
+
+def test_programs_fetched_once_per_run(eng):
+    stations = ["1001", "1002", "1003"]
+    addChannels(eng, stations)
+    # the same two programmes air on every station
+    airings = [
+        {"programID": "EP1", "md5": "p1", "airDateTime": "2022-07-01T18:00:00Z"},
+        {"programID": "EP2", "md5": "p2", "airDateTime": "2022-07-01T18:30:00Z"},
+    ]
+    for airing in airings:
+        airing["duration"] = 1800
+
+    def md5s(body):
+        return {
+            chan["stationID"]: {
+                "2022-07-01": {
+                    "md5": f"s{chan['stationID']}",
+                    "lastModified": "2022-06-30T00:00:00Z",
+                }
+            }
+            for chan in body
+        }
+
+    def scheds(body):
+        return [
+            {
+                "stationID": chan["stationID"],
+                "programs": airings,
+                "metadata": {"startDate": "2022-07-01"},
+            }
+            for chan in body
+        ]
+
+    fetched = []
+
+    def programs(body):
+        fetched.extend(body)
+        return [makeProgram(progid, f"p{progid[2:]}") for progid in body]
+
+    routes = {"schedules/md5": md5s, "schedules": scheds, "programs": programs}
+    with StubServer(routes) as srv:
+        sd = SDApi(url=srv.url)
+        schedules(sd, eng)
+        sd.close()
+    assert sorted(fetched) == ["EP1", "EP2"]
+    with Session(eng) as session:
+        assert session.query(Schedule).count() == 6
+        assert session.query(Program).count() == 2
+
+
+class FakeSD:
+    def getTimeStamp(self, dt):
+        return SDApi.getTimeStamp(self, dt)
+
+
+def scheduleRows(eng):
+    with Session(eng) as session:
+        rows = session.query(Schedule).order_by(Schedule.airdate).all()
+        return [(x.programid, x.airdate, x.duration, x.md5) for x in rows]
+
+
+def test_bulk_schedule_matches_row_by_row(eng):
+    addChannels(eng, ["1001"])
+    sd = FakeSD()
+    old = {
+        "stationID": "1001",
+        "programs": [
+            {"programID": "EP1", "airDateTime": "2022-07-01T18:00:00Z"},
+            {"programID": "EP2", "airDateTime": "2022-07-01T19:00:00Z"},
+            {"programID": "EP3", "airDateTime": "2022-07-01T20:00:00Z"},
+            {"programID": "EP4", "airDateTime": "2022-07-01T21:00:00Z"},
+        ],
+    }
+    new = {
+        "stationID": "1001",
+        "programs": [
+            {"programID": "EP1", "airDateTime": "2022-07-01T18:00:00Z"},
+            {"programID": "EP5", "airDateTime": "2022-07-01T19:00:00Z"},
+            {"programID": "EP6", "airDateTime": "2022-07-01T20:30:00Z"},
+        ],
+    }
+    for prog in old["programs"]:
+        prog.update({"duration": 3600, "md5": "old"})
+    for prog in new["programs"]:
+        prog.update({"duration": 1800, "md5": "new"})
+    results = []
+    for bulk in (False, True):
+        with Session(eng) as session, session.begin():
+            session.query(Schedule).delete()
+        addSchedule(sd, old, eng, bulk=bulk)
+        addSchedule(sd, new, eng, bulk=bulk)
+        results.append(scheduleRows(eng))
+    assert results[0] == results[1]
+    assert [x[0] for x in results[1]] == ["EP1", "EP5", "EP6", "EP4"]
+    assert results[1][0][2:] == (1800, "new")
+
+
+def loopDoomed(existing, airings):
+    """The overlap check bulkSchedule made before it used an IntervalIndex,
+    every existing row against every airing."""
+    newkeys = {(x["programid"], x["airdate"]) for x in airings}
+    doomed = set()
+    for row in existing:
+        if (row["programid"], row["airdate"]) in newkeys:
+            continue
+        for x in airings:
+            if (
+                x["airdate"] < row["airdate"] + row["duration"]
+                and x["airdate"] + x["duration"] > row["airdate"]
+            ):
+                doomed.add((row["programid"], row["airdate"]))
+                break
+    return doomed
+
+
+def test_bulk_schedule_deletes_what_the_loop_did(eng):
+    rand = random.Random(1)
+
+    def airing(n, tag):
+        when = rand.randrange(0, 86400, 300)
+        return {
+            "programid": f"EP{tag}{n}",
+            "stationid": "1001",
+            "airdate": when,
+            "duration": rand.choice([300, 1800, 3600, 7200]),
+            "md5": tag,
+        }
+
+    for _ in range(10):
+        with Session(eng) as session, session.begin():
+            session.query(Schedule).delete()
+        existing = {}
+        for n in range(200):
+            row = airing(n, "old")
+            existing[(row["programid"], row["stationid"], row["airdate"])] = row
+        existing = list(existing.values())
+        airings = [airing(n, "new") for n in range(100)]
+        # some airings are unchanged
+        airings += rand.sample(existing, 20)
+        with Session(eng) as session, session.begin():
+            session.add_all(Schedule(**x) for x in existing)
+        doomed = loopDoomed(existing, airings)
+        with Session(eng) as session, session.begin():
+            bulkSchedule("1001", airings, session)
+        gone = {
+            x["airdate"] for x in existing if (x["programid"], x["airdate"]) in doomed
+        }
+        expected = {
+            (x["programid"], x["airdate"]) for x in existing if x["airdate"] not in gone
+        }
+        expected |= {(x["programid"], x["airdate"]) for x in airings}
+        assert len(doomed) > 0
+        assert {x[:2] for x in scheduleRows(eng)} == expected
+
+
+def test_credits_are_batched(eng):
+    cast = [
+        {"personId": str(100 + x), "nameId": str(x), "name": f"actor {x}", "role": "x"}
+        for x in range(30)
+    ]
+    crew = [{"personId": "100", "nameId": "0", "name": "actor 0", "role": "Director"}]
+
+    def programs(body):
+        progs = [makeProgram(progid, "m1") for progid in body]
+        for prog in progs:
+            prog["cast"] = cast
+            prog["crew"] = crew
+        return progs
+
+    statements = []
+
+    @event.listens_for(eng, "before_cursor_execute")
+    def countStatements(conn, cursor, statement, *args):
+        statements.append(statement.split()[0:3])
+
+    with StubServer({"programs": programs}) as srv:
+        sd = SDApi(url=srv.url)
+        updatePrograms(sd, ["EP1", "EP2", "EP3"], eng)
+        sd.close()
+    assert statements.count(["INSERT", "INTO", "person"]) == 1
+    assert statements.count(["INSERT", "INTO", "personmap"]) == 1
+    with Session(eng) as session:
+        assert session.query(Person).count() == 30
+        assert session.query(Personmap).count() == 90
+
+
+def test_clean_schedule(eng):
+    now = int(time.time())
+    old = now - 86400 * 10
+    with Session(eng) as session, session.begin():
+        for x in range(48):
+            session.add(
+                Schedule(programid="EPOLD", stationid="1", airdate=old + x * 1800)
+            )
+        session.add(
+            Schedule(programid="EPNEW", stationid="1", airdate=now, duration=60)
+        )
+        for progid in ("EPOLD", "EPNEW"):
+            session.add(Program(programid=progid, md5="m", title=progid))
+            session.add(Personmap(personid=1, programid=progid))
+        session.add(Schedulemd5(md5="a", stationid="1", datets=old - 86400))
+        session.add(Schedulemd5(md5="b", stationid="1", datets=now - 86400))
+    assert cleanSchedule(eng, days=7, chunk=3600) == 48
+    with Session(eng) as session:
+        assert [x.programid for x in session.query(Schedule)] == ["EPNEW"]
+        assert [x.programid for x in session.query(Program)] == ["EPNEW"]
+        assert [x.programid for x in session.query(Personmap)] == ["EPNEW"]
+        assert [x.md5 for x in session.query(Schedulemd5)] == ["b"]
+
+
+def test_schedules_md5(eng):
+    addChannels(eng, ["1001", "1002"])
+    with Session(eng) as session, session.begin():
+        session.add(Schedulemd5(md5="known", stationid="1001", datets=0))
+    mod = "2022-06-30T00:00:00Z"
+
+    def md5s(body):
+        return {
+            "1001": {
+                "2022-07-01": {"md5": "known", "lastModified": mod},
+                "2022-07-02": {"md5": "new1", "lastModified": mod},
+            },
+            "1002": {"2022-07-01": {"md5": "new2", "lastModified": mod}},
+        }
+
+    with StubServer({"schedules/md5": md5s}) as srv:
+        sd = SDApi(url=srv.url)
+        first = schedulesMd5(sd, eng)
+        second = schedulesMd5(sd, eng)
+        sd.close()
+    assert first == {"1001": ["2022-07-02"], "1002": ["2022-07-01"]}
+    assert second == {}
+    with Session(eng) as session:
+        assert session.query(Schedulemd5).count() == 3
+
+
+def addListings(eng, now):
+    with Session(eng) as session, session.begin():
+        for chan in range(20):
+            sid = str(2000 + chan)
+            session.add(Channel(stationid=sid, name=f"chan {chan}", getdata=2))
+            for x in range(4):
+                progid = f"EP{chan:03d}{x}"
+                session.add(Program(programid=progid, md5="m", title=progid))
+                start = now - 900 + x * 1800
+                session.add(
+                    Schedule(
+                        programid=progid, stationid=sid, airdate=start, duration=1800
+                    )
+                )
+
+
+def countQueries(eng):
+    statements = []
+
+    @event.listens_for(eng, "before_cursor_execute")
+    def countStatements(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    return statements
+
+
+def test_whats_on_now_is_one_query(eng):
+    now = int(time.time())
+    addListings(eng, now)
+    statements = countQueries(eng)
+    scheds = whatsOnNow(eng, now=now, limit=40)
+    assert len(statements) == 1
+    assert len(scheds) == 40
+    first = scheds[0]
+    assert first["dprog"]["title"] == first["programid"]
+    assert first["dchan"]["name"].startswith("chan ")
+    assert first["airdate"] == now - 900
+
+
+def test_chan_progs_is_one_query(eng):
+    now = int(time.time())
+    addListings(eng, now)
+    statements = countQueries(eng)
+    scheds = chanProgs(eng, "2003", now=now)
+    assert len(statements) == 1
+    assert [x["programid"] for x in scheds] == [f"EP003{x}" for x in range(4)]
+    assert all(x["dchan"]["name"] == "chan 3" for x in scheds)
+
+
+def test_long_airing_is_on_now(eng):
+    now = int(time.time())
+    with Session(eng) as session, session.begin():
+        session.add(Channel(stationid="3000", name="films", getdata=2))
+        session.add(Program(programid="MV1", md5="m", title="long"))
+        session.add(
+            Schedule(
+                programid="MV1", stationid="3000", airdate=now - 72000, duration=75600
+            )
+        )
+    assert [x["programid"] for x in chanProgs(eng, "3000", now=now)] == ["MV1"]
+    assert [x["programid"] for x in whatsOnNow(eng, now=now)] == ["MV1"]
+
+
+def journalRoutes(fetched):
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    mod = f"{today}T00:00:00Z"
+
+    def md5s(body):
+        return {
+            chan["stationID"]: {
+                today: {"md5": f"s{chan['stationID']}", "lastModified": mod}
+            }
+            for chan in body
+        }
+
+    def scheds(body):
+        return [
+            {
+                "stationID": chan["stationID"],
+                "programs": [
+                    {
+                        "programID": f"EP{chan['stationID']}{x}",
+                        "md5": "p",
+                        "airDateTime": f"{today}T1{x}:00:00Z",
+                        "duration": 3600,
+                    }
+                    for x in range(3)
+                ],
+                "metadata": {"startDate": today, "md5": f"s{chan['stationID']}"},
+            }
+            for chan in body
+        ]
+
+    def programs(body):
+        fetched.extend(body)
+        return [makeProgram(progid, "p") for progid in body]
+
+    return {"schedules/md5": md5s, "schedules": scheds, "programs": programs}
+
+
+def test_md5s_wait_for_their_schedules(eng, monkeypatch):
+    monkeypatch.setattr("tvrecorder.sdapi.time.sleep", lambda secs: None)
+    addChannels(eng, ["1001", "1002"])
+    routes = journalRoutes([])
+    with StubServer(routes, faults={"schedules": [503] * 4}) as srv:
+        sd = SDApi(url=srv.url, retries=2)
+        # the schedules never arrive, so their days are not marked current
+        schedules(sd, eng)
+        sd.close()
+    with Session(eng) as session:
+        assert session.query(Schedulemd5).count() == 0
+        assert session.query(Schedule).count() == 0
+    with StubServer(routes) as srv:
+        sd = SDApi(url=srv.url)
+        assert schedules(sd, eng)
+        sd.close()
+    with Session(eng) as session:
+        assert session.query(Schedulemd5).count() == 2
+        assert session.query(Schedule).count() == 6
+
+
+def test_interrupted_run_is_resumed(eng, monkeypatch):
+    monkeypatch.setattr("tvrecorder.sdapi.time.sleep", lambda secs: None)
+    addChannels(eng, ["1001", "1002"])
+    fetched = []
+    routes = journalRoutes(fetched)
+    runid, resumed = startRun(eng)
+    assert not resumed
+    with StubServer(routes, faults={"programs": [500] * 5}) as srv:
+        sd = SDApi(url=srv.url, retries=1)
+        assert not schedules(sd, eng, runid=runid)
+        sd.close()
+    assert startRun(eng) == (runid, True)
+    assert runProgress(eng, runid) == {"schedule": (2, 6)}
+    with StubServer(routes) as srv:
+        sd = SDApi(url=srv.url)
+        assert schedules(sd, eng, runid=runid)
+        sd.close()
+    # the schedules were not downloaded again, their programs were
+    assert [req[1] for req in srv.requests].count("schedules") == 0
+    assert sorted(fetched) == [f"EP{s}{x}" for s in (1001, 1002) for x in range(3)]
+    assert runProgress(eng, runid)["programs"] == (1, 6)
+    finishRun(eng, runid)
+    nextid, resumed = startRun(eng)
+    assert nextid != runid and not resumed
+    with Session(eng) as session:
+        assert session.query(Program).count() == 6
+        assert session.query(Updaterun).filter_by(runid=runid).one().finished > 0
+
+
+def test_schedule_error_object_is_skipped(eng):
+    addChannels(eng, ["1001", "1002"])
+    routes = journalRoutes([])
+    scheds = routes["schedules"]
+
+    def withError(body):
+        out = scheds(body)
+        out[0] = {"stationID": out[0]["stationID"], "code": 7100}
+        out[0]["response"] = "SCHEDULE_QUEUED"
+        return out
+
+    routes["schedules"] = withError
+    with StubServer(routes) as srv:
+        sd = SDApi(url=srv.url)
+        schedules(sd, eng)
+        sd.close()
+    with Session(eng) as session:
+        assert session.query(Schedulemd5).count() == 1
+        assert session.query(Schedule).count() == 3
+        assert session.query(Program).count() == 3
@@ -0,0 +1,174 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Synthetic MPEG transport streams, for tests and benchmarks.
+
+TSFixture makes a multiplex of services, each with a PMT and elementary
+streams, the first stream carrying the service's PCR. The PAT and PMTs
+are repeated every table packets. Every payload byte of a packet is the
+low byte of its PID, so where a packet came from can be checked after
+demultiplexing.
+
+    fix = TSFixture({4287: [101, 102], 4351: [201, 202]})
+    data = fix.stream(10000)
+"""
+import random
+
+from tvrecorder.mpegts import PACKETSIZE, PATPID, SYNCBYTE
+
+# 27MHz PCR ticks per packet at 24Mbit/s
+PCRTICKS = 27_000_000 * PACKETSIZE * 8 // 24_000_000
+
+
+def crc32mpeg(data):
+    crc = 0xFFFFFFFF
+    for byte in data:
+        crc ^= byte << 24
+        for _ in range(8):
+            crc = (crc << 1) ^ 0x104C11DB7 if crc & 0x80000000 else crc << 1
+    return crc & 0xFFFFFFFF
+
+
+def section(tableid, tableext, body):
+    """A long form table section, with its CRC."""
+    length = 5 + len(body) + 4
+    head = bytes(
+        [tableid, 0xB0 | (length >> 8), length & 0xFF, tableext >> 8, tableext & 0xFF]
+    )
+    xsect = head + bytes([0xC1, 0, 0]) + body
+    return xsect + crc32mpeg(xsect).to_bytes(4, "big")
+
+
+def patSection(pmtpids, tsid=1):
+    body = b"".join(
+        bytes([sid >> 8, sid & 0xFF, 0xE0 | (pid >> 8), pid & 0xFF])
+        for sid, pid in sorted(pmtpids.items())
+    )
+    return section(0x00, tsid, body)
+
+
+def pmtSection(sid, pcrpid, pids):
+    body = bytes([0xE0 | (pcrpid >> 8), pcrpid & 0xFF, 0xF0, 0])
+    for n, pid in enumerate(pids):
+        stype = 0x1B if n == 0 else 0x03
+        body += bytes([stype, 0xE0 | (pid >> 8), pid & 0xFF, 0xF0, 0])
+    return section(0x02, sid, body)
+
+
+def packet(pid, cc, payload=None, pusi=False, pcr=None):
+    """A 188 byte packet, payload is padded out with an adaptation field,
+    or the packet filled with the low byte of pid if it is None."""
+    adapt = b""
+    if pcr is not None:
+        base, ext = pcr // 300, pcr % 300
+        adapt = bytes([0x10]) + ((base << 15) | (0x3F << 9) | ext).to_bytes(6, "big")
+    if payload is None:
+        payload = bytes([pid & 0xFF]) * (
+            PACKETSIZE - 4 - (len(adapt) + 1 if adapt else 0)
+        )
+    room = PACKETSIZE - 4 - len(payload)
+    if room > 0:
+        if not adapt:
+            adapt = b"\x00" if room > 1 else b""
+        adapt += b"\xff" * (room - 1 - len(adapt))
+        field = bytes([len(adapt)]) + adapt
+    else:
+        field = b""
+    control = 0x30 if field else 0x10
+    head = bytes(
+        [
+            SYNCBYTE,
+            (0x40 if pusi else 0) | (pid >> 8),
+            pid & 0xFF,
+            control | (cc & 0x0F),
+        ]
+    )
+    return head + field + payload
+
+
+class TSFixture:
+    def __init__(self, services, pmtbase=0x100, table=40, seed=1):
+        """Describe the multiplex.
+
+        Args:
+            services: dict of service id: list of elementary stream PIDs
+            pmtbase: int: the PMT PIDs are numbered up from this
+            table: int: packets between repeats of the PAT and PMTs
+            seed: int: the same seed always makes the same stream
+        """
+        self.services = services
+        self.pmtpids = {sid: pmtbase + n for n, sid in enumerate(sorted(services))}
+        self.table = table
+        self.rand = random.Random(seed)
+        self.pids = [pid for pids in services.values() for pid in pids]
+        self.pcrpids = {pids[0] for pids in services.values()}
+        self.cc = {}
+        self.pcr = 0
+        self.count = 0
+        self.ccerrors = 0
+        self.pcrcount = 0
+        self.pidcounts = {}
+
+    def next(self, pid, skip=False):
+        cc = self.cc.get(pid, -1) + (2 if skip else 1)
+        self.cc[pid] = cc % 16
+        self.pidcounts[pid] = self.pidcounts.get(pid, 0) + 1
+        return self.cc[pid]
+
+    def tables(self):
+        pkts = [
+            packet(PATPID, self.next(PATPID), b"\x00" + patSection(self.pmtpids), True)
+        ]
+        for sid, pids in sorted(self.services.items()):
+            pid = self.pmtpids[sid]
+            xsect = pmtSection(sid, pids[0], pids)
+            pkts.append(packet(pid, self.next(pid), b"\x00" + xsect, True))
+        return pkts
+
+    def packets(self, n, ccerrors=0, pcrevery=20, pcrgap=None):
+        """Yields n packets.
+
+        Args:
+            ccerrors: float: chance that a packet's continuity counter
+                      skips one, as if the packet before it was lost
+            pcrevery: int: the PCR PIDs carry a PCR every this many packets
+            pcrgap: (index, ticks) the PCR jumps by ticks at packet index
+        """
+        while n > 0:
+            if self.count % self.table == 0:
+                pkts = self.tables()
+            else:
+                pid = self.rand.choice(self.pids)
+                if pcrgap is not None and self.count >= pcrgap[0]:
+                    self.pcr += pcrgap[1]
+                    pcrgap = None
+                pcr = None
+                if pid in self.pcrpids and self.pidcounts.get(pid, 0) % pcrevery == 0:
+                    pcr = self.pcr
+                    self.pcrcount += 1
+                skip = pid in self.cc and self.rand.random() < ccerrors
+                self.ccerrors += skip
+                pkts = [packet(pid, self.next(pid, skip), pcr=pcr)]
+            for pkt in pkts[:n]:
+                self.count += 1
+                self.pcr += PCRTICKS
+                n -= 1
+                yield pkt
+
+    def stream(self, n, **kwargs):
+        return b"".join(self.packets(n, **kwargs))
@@ -0,0 +1,121 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Tuner adaptor allocation for tvrecorder.
+
+The padded recordings are intervals, giving each an adaptor so that no
+two overlapping recordings share one is colouring an interval graph. A
+sweep in start time order that hands each recording the first free
+adaptor never needs more adaptors than the most recordings on air at
+once, so it is optimal, and runs in O(n log n).
+
+When every adaptor is busy a recording has to be dropped: the one with
+the lowest priority, and of those the one that ends last, which leaves
+the adaptors free soonest. Recordings already in progress are never
+dropped.
+"""
+import heapq
+import sys
+
+from ccaerrors import errorNotify
+
+from tvrecorder.scheduler import recordingStart, recordingEnd
+
+
+def recordingPriority(rec):
+    if rec.get("status") == "recording":
+        return float("inf")
+    return rec.get("priority") or 0
+
+
+def allocateAdaptors(recs, adaptors=4):
+    """Gives each recording an adaptor.
+
+    A recording in progress keeps the adaptor it has.
+
+    Args:
+        recs: list of recording dicts
+        adaptors: int: the number of adaptors, numbered from 0
+    returns: (booked, clashes) booked is a list of copies of the recordings
+             that can be made, each with its "adaptor" set, in start time
+             order. clashes is a list of {"recording": rec, "with": [recs]}
+             dicts, one for each recording that cannot be made, with the
+             booked recordings holding the adaptors when it would start.
+    """
+    try:
+        order = sorted(range(len(recs)), key=lambda i: recordingStart(recs[i]))
+        free = set(range(adaptors))
+        # (end, i) of the recordings holding adaptors, earliest end first
+        ending = []
+        # (priority, -end, i) the recording to drop first on top
+        dropping = []
+        held = {}
+        assigned = {}
+
+        def hold(i, adaptor):
+            rec = recs[i]
+            held[i] = assigned[i] = adaptor
+            heapq.heappush(ending, (recordingEnd(rec), i))
+            heapq.heappush(dropping, (recordingPriority(rec), -recordingEnd(rec), i))
+
+        clashes = []
+        # a recording in progress holds the adaptor its process is tuned
+        # with from the outset, a pending one that sorts before it cannot
+        # take it
+        for i in order:
+            rec = recs[i]
+            if rec.get("status") == "recording" and rec.get("adaptor") in free:
+                free.discard(rec["adaptor"])
+                hold(i, rec["adaptor"])
+        for i in order:
+            if i in held:
+                continue
+            rec = recs[i]
+            start = recordingStart(rec)
+            while ending and ending[0][0] <= start:
+                j = heapq.heappop(ending)[1]
+                if j in held:
+                    free.add(held.pop(j))
+            if not free:
+                # lazily skip the entries of recordings that have ended
+                while dropping and dropping[0][2] not in held:
+                    heapq.heappop(dropping)
+                if not dropping:
+                    clashes.append({"recording": rec, "with": []})
+                    continue
+                prio, negend, j = dropping[0]
+                if (prio, negend) >= (recordingPriority(rec), -recordingEnd(rec)):
+                    clashes.append({"recording": rec, "with": [recs[x] for x in held]})
+                    continue
+                heapq.heappop(dropping)
+                free.add(held.pop(j))
+                del assigned[j]
+                rivals = [recs[x] for x in held] + [rec]
+                clashes.append({"recording": recs[j], "with": rivals})
+            adaptor = min(free)
+            free.discard(adaptor)
+            hold(i, adaptor)
+        booked = []
+        for i in order:
+            if i in assigned:
+                rec = dict(recs[i])
+                rec["adaptor"] = assigned[i]
+                booked.append(rec)
+        return booked, clashes
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
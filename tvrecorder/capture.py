@@ -0,0 +1,301 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""In process capture of the DVR stream for tvrecorder.
+
+Rather than leave the file to dvbv5-zap -o, dvbv5-zap -r keeps the tuner
+tuned and the stream is read from the DVR device here. CaptureWriter
+collects it in a large page aligned buffer and writes it out a whole
+buffer at a time, into a file preallocated for the length of the
+recording, with an fdatasync every so often. Several recordings to one
+spinning disk then write in a few large sequential pieces each rather
+than in many small interleaved ones, and the page cache does not fill
+with dirty pages that are flushed all at once.
+"""
+import argparse
+import mmap
+import os
+import select
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from ccaerrors import errorNotify, errorRaise
+import ccalogging
+
+from tvrecorder.mpegts import PACKETSIZE, SYNCBYTE, ContinuityCounter, findSync
+from tvrecorder.tvr import ZAPCONF, recordingPath
+
+log = ccalogging.log
+
+# bytes per second to preallocate for, a high definition service
+BYTERATE = 1_250_000
+
+# the DVR device of an adaptor
+DVRPATH = "/dev/dvb/adapter{}/dvr0"
+
+
+class CaptureWriter:
+    def __init__(
+        self,
+        path,
+        size=0,
+        bufsize=4 * 1024 * 1024,
+        syncbytes=64 * 1024 * 1024,
+    ):
+        """Open path for writing.
+
+        Args:
+            path: str: the file to write
+            size: int: bytes to preallocate, the file is truncated to what
+                  was written when it is closed
+            bufsize: int: bytes written at a time, rounded up to a whole
+                     number of pages
+            syncbytes: int: fdatasync after about this many bytes, 0 never
+        """
+        self.path = str(path)
+        self.bufsize = -(-bufsize // mmap.PAGESIZE) * mmap.PAGESIZE
+        self.syncbytes = syncbytes
+        # an anonymous map is page aligned
+        self.buf = mmap.mmap(-1, self.bufsize)
+        self.fill = 0
+        self.bytes = 0
+        self.written = 0
+        self.unsynced = 0
+        self.writes = 0
+        self.syncs = 0
+        self.started = time.monotonic()
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.preallocated = self.preallocate(size)
+
+    def preallocate(self, size):
+        if size <= 0 or not hasattr(os, "posix_fallocate"):
+            return 0
+        try:
+            os.posix_fallocate(self.fd, 0, size)
+            return size
+        except OSError as e:
+            log.warning(f"cannot preallocate {size} bytes for {self.path}: {e}")
+            return 0
+
+    def write(self, data):
+        view = memoryview(data)
+        size = len(view)
+        while len(view) > 0:
+            n = min(len(view), self.bufsize - self.fill)
+            self.buf[self.fill : self.fill + n] = view[:n]
+            self.fill += n
+            view = view[n:]
+            if self.fill == self.bufsize:
+                self.flush()
+        self.bytes += size
+        return size
+
+    def tell(self):
+        return self.bytes
+
+    def flush(self):
+        """Writes out the buffer, and syncs if enough is unsynced."""
+        view = memoryview(self.buf)[: self.fill]
+        try:
+            while len(view) > 0:
+                n = os.write(self.fd, view)
+                view = view[n:]
+                self.written += n
+                self.unsynced += n
+                self.writes += 1
+        finally:
+            view.release()
+        self.fill = 0
+        if self.syncbytes and self.unsynced >= self.syncbytes:
+            self.sync()
+
+    def sync(self):
+        os.fdatasync(self.fd)
+        self.unsynced = 0
+        self.syncs += 1
+
+    def close(self):
+        if self.fd is None:
+            return
+        try:
+            self.flush()
+            if self.preallocated > self.written:
+                os.ftruncate(self.fd, self.written)
+            self.sync()
+        finally:
+            os.close(self.fd)
+            self.fd = None
+            self.buf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def stats(self):
+        secs = time.monotonic() - self.started
+        return {
+            "bytes": self.bytes,
+            "writes": self.writes,
+            "syncs": self.syncs,
+            "seconds": round(secs, 3),
+            "mbps": round(self.bytes * 8 / secs / 1e6, 2) if secs > 0 else 0,
+        }
+
+
+def captureStream(fd, writer, length=None, clock=time.monotonic, stop=None):
+    """Copies the transport stream from fd to writer, whole packets only,
+    until fd ends, length seconds have passed, or stop() returns True.
+
+    returns: dict of the writer's stats with the packets read, the packets
+             lost according to the continuity counters, the continuity
+             errors and the times sync with the packets was lost
+    """
+    try:
+        cc = ContinuityCounter()
+        packets = resyncs = 0
+        rest = b""
+        # rest starts with a sync byte that has not been confirmed yet
+        hunting = False
+        chunk = PACKETSIZE * 1024
+        end = None if length is None else clock() + length
+        while True:
+            if end is not None and clock() >= end:
+                break
+            if stop is not None and stop():
+                break
+            if not select.select([fd], [], [], 1)[0]:
+                continue
+            data = os.read(fd, chunk)
+            if not data:
+                break
+            buf = rest + data if rest else data
+            size = len(buf)
+            off = 0
+            if hunting:
+                off = findSync(buf, 0, size)
+                hunting = off + PACKETSIZE >= size
+            start = off
+            last = size - PACKETSIZE
+            while not hunting and off <= last:
+                if buf[off] != SYNCBYTE:
+                    # write what was in sync, then skip to the next sync byte
+                    # followed by another, a candidate too near the end of
+                    # buf to check waits in rest for more data
+                    writer.write(memoryview(buf)[start:off])
+                    resyncs += 1
+                    off = start = findSync(buf, off + 1, size)
+                    hunting = off + PACKETSIZE >= size
+                    continue
+                cc.check(buf, off)
+                packets += 1
+                off += PACKETSIZE
+            writer.write(memoryview(buf)[start:off])
+            rest = bytes(buf[off:])
+        stats = writer.stats()
+        stats.update(
+            {
+                "packets": packets,
+                "dropped": cc.lost,
+                "ccerrors": cc.errors,
+                "transporterrors": cc.transporterrors,
+                "resyncs": resyncs,
+            }
+        )
+        return stats
+    except Exception as e:
+        errorRaise(sys.exc_info()[2], e)
+
+
+def captureCommand(
+    title,
+    channel="BBC TWO",
+    start=0,
+    length=3600,
+    adaptor=0,
+    basedir="/run/media/chris/seagate4/TV/tv/",
+):
+    """The capture mode equivalent of tvr.buildRecordCommand."""
+    try:
+        fqfn = recordingPath(title, channel, start, basedir)
+        cmd = [sys.executable, "-m", "tvrecorder.capture", "-a", str(adaptor)]
+        cmd += ["-t", str(int(length)), channel, str(fqfn)]
+        return cmd
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+
+
+def stopOnTerm():
+    """Makes SIGTERM ask the capture to stop rather than kill the process,
+    so its files are closed and its dvbv5-zap terminated on the way out,
+    returns the function that says when to stop."""
+    try:
+        stopping = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *args: stopping.set())
+        return stopping.is_set
+    except Exception as e:
+        errorRaise(sys.exc_info()[2], e)
+
+
+def captureRecord(channel, path, length, adaptor=0, conf=ZAPCONF, stop=None):
+    """Tunes adaptor to channel for length seconds and captures it to
+    path, until stop() returns True, returns the capture stats, or None if
+    it failed."""
+    try:
+        cmd = ["dvbv5-zap", "-c", conf, "-a", str(adaptor), "-p", "-r"]
+        cmd += ["-t", str(int(length)), channel]
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+        fd = None
+        try:
+            fd = os.open(DVRPATH.format(adaptor), os.O_RDONLY)
+            with CaptureWriter(path, size=int(length) * BYTERATE) as writer:
+                done = lambda: proc.poll() is not None or (stop and stop())
+                stats = captureStream(fd, writer, length, stop=done)
+        finally:
+            if fd is not None:
+                os.close(fd)
+            if proc.poll() is None:
+                proc.terminate()
+            proc.wait()
+        log.info(f"{path}: {stats}")
+        return stats
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="capture a channel to a file")
+    parser.add_argument("-a", "--adaptor", type=int, default=0)
+    parser.add_argument("-c", "--conf", default=ZAPCONF)
+    parser.add_argument("-t", "--length", type=int, required=True)
+    parser.add_argument("channel")
+    parser.add_argument("path")
+    args = parser.parse_args()
+    stop = stopOnTerm()
+    stats = captureRecord(
+        args.channel, args.path, args.length, args.adaptor, args.conf, stop=stop
+    )
+    sys.exit(0 if stats and stats["bytes"] > 0 else 1)
+
+
+if __name__ == "__main__":
+    main()
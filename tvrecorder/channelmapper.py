@@ -17,8 +17,6 @@
 #     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
 #
 """Channel mapper for tvrecorder."""
-import configparser
-import os
 import sys
 
 from ccaerrors import errorNotify, errorExit
@@ -26,7 +24,8 @@ import ccalogging
 
 from tvrecorder import __version__, __appname__
 from tvrecorder.config import Configuration
-from tvrecorder.db import makeDBEngine
+from tvrecorder.db import getEngine
+from tvrecorder.multiplex import readZapConf
 from tvrecorder.wrangler import mapToDVB
 
 ccalogging.setLogFile("/home/chris/channelmapper.out")
@@ -37,11 +36,8 @@ log = ccalogging.log
 def begin(appname, debug=False):
     try:
         cf = Configuration(appname=appname)
-        mysqleng = makeDBEngine(cf, echo=debug)
-        zap = configparser.ConfigParser()
-        home = os.path.expanduser("~/")
-        tzap = os.path.join(home, ".tzap", "dvb_channel.conf")
-        zap.read(tzap)
+        mysqleng = getEngine(cf, echo=debug)
+        zap = readZapConf()
         return (cf, mysqleng, zap)
     except Exception as e:
         errorExit(sys.exc_info()[2], e)
@@ -17,14 +17,23 @@
 #     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
 #
 """db module for tvrecorder"""
+import os
 import sys
+import threading
+import time
 
-from ccaerrors import errorNotify, errorExit
-from sqlalchemy import create_engine
+from ccaerrors import errorNotify, errorExit, errorRaise
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.pool import QueuePool
 
 from tvrecorder.config import Configuration
 from tvrecorder.models import Base
 
+# process wide engines, keyed by database url, see getEngine
+engines = {}
+enginelock = threading.Lock()
+
 
 def makeDBCreds(cf):
     try:
@@ -40,12 +49,167 @@ def makeDBCreds(cf):
         errorExit(sys.exc_info()[2], e)
 
 
-def makeDBEngine(cf, echo=False):
+def sqlitePath(cf):
+    try:
+        dbpath = cf.get("dbpath", "~/.local/share/tvrecorder/tvrecorder.db")
+        return os.path.expanduser(dbpath)
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+
+
+def makeDBURL(cf):
+    """Returns the connection url for the database chosen by the "dbtype"
+    setting.
+
+    dbtype: mysql (the default) or sqlite
+    """
     try:
+        if cf.get("dbtype", "mysql") == "sqlite":
+            return f"sqlite:///{sqlitePath(cf)}"
         creds = makeDBCreds(cf)
         connstr = f'mysql+pymysql://{creds["dbuser"]}:{creds["dbpass"]}'
         connstr += f'@{creds["dbhost"]}/{creds["dbdb"]}'
-        return create_engine(connstr, echo=echo)
+        return connstr
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+
+
+def makeDBEngine(cf, echo=False):
+    """Returns a new engine for the configured database.
+
+    MySQL pool settings:
+        dbpoolsize: connections kept in the pool, default 5
+        dbmaxoverflow: extra connections allowed under load, default 10
+        dbpreping: test connections before use, default True
+        dbpoolrecycle: seconds before a connection is replaced, default 3600
+    """
+    try:
+        if cf.get("dbtype", "mysql") == "sqlite":
+            return makeSQLiteEngine(cf, echo=echo)
+        kwargs = {
+            "echo": echo,
+            "pool_size": int(cf.get("dbpoolsize", 5)),
+            "max_overflow": int(cf.get("dbmaxoverflow", 10)),
+            "pool_pre_ping": bool(cf.get("dbpreping", True)),
+            "pool_recycle": int(cf.get("dbpoolrecycle", 3600)),
+        }
+        return create_engine(makeDBURL(cf), **kwargs)
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+
+
+def getEngine(cf, echo=False):
+    """Returns the process wide engine for the configured database, it is
+    only created on first use."""
+    try:
+        url = makeDBURL(cf)
+        with enginelock:
+            if url not in engines:
+                eng = makeDBEngine(cf, echo=echo)
+                eng.poolstats = PoolStats(eng)
+                engines[url] = eng
+            return engines[url]
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+
+
+class PoolStats:
+    """Counts connection pool activity for an engine, for monitoring."""
+
+    def __init__(self, eng):
+        try:
+            self.eng = eng
+            self.lock = threading.Lock()
+            self.connects = 0
+            self.checkouts = 0
+            self.checkins = 0
+            self.invalidated = 0
+            self.held = 0.0
+            self.maxheld = 0.0
+            event.listen(eng, "connect", self.onConnect)
+            event.listen(eng, "checkout", self.onCheckout)
+            event.listen(eng, "checkin", self.onCheckin)
+            event.listen(eng, "invalidate", self.onInvalidate)
+        except Exception as e:
+            errorNotify(sys.exc_info()[2], e)
+
+    def onConnect(self, dbapiconn, record):
+        with self.lock:
+            self.connects += 1
+
+    def onCheckout(self, dbapiconn, record, proxy):
+        record.info["checkedout"] = time.perf_counter()
+        with self.lock:
+            self.checkouts += 1
+
+    def onCheckin(self, dbapiconn, record):
+        start = record.info.pop("checkedout", None)
+        with self.lock:
+            self.checkins += 1
+            if start is not None:
+                took = time.perf_counter() - start
+                self.held += took
+                self.maxheld = max(self.maxheld, took)
+
+    def onInvalidate(self, dbapiconn, record, exception):
+        with self.lock:
+            self.invalidated += 1
+
+    def summary(self):
+        """Returns the counters and the current pool status as a dict."""
+        try:
+            with self.lock:
+                avg = self.held / self.checkins if self.checkins else 0.0
+                return {
+                    "connects": self.connects,
+                    "checkouts": self.checkouts,
+                    "checkedout": self.checkouts - self.checkins,
+                    "invalidated": self.invalidated,
+                    "avgheldms": round(avg * 1000, 3),
+                    "maxheldms": round(self.maxheld * 1000, 3),
+                    "pool": self.eng.pool.status(),
+                }
+        except Exception as e:
+            errorNotify(sys.exc_info()[2], e)
+
+
+def makeSQLiteEngine(cf, echo=False):
+    """Embedded database in WAL mode, so the gui can read while the
+    updater writes.
+
+    settings: dbpath: the database file
+              dbpoolsize, dbmaxoverflow: as for MySQL
+              dbmmapsize: bytes of the file to memory map, default 256MB
+              dbcachesize: page cache in KiB, default 64MB
+    """
+    try:
+        os.makedirs(os.path.dirname(sqlitePath(cf)), exist_ok=True)
+        pragmas = {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "mmap_size": int(cf.get("dbmmapsize", 256 * 1024 * 1024)),
+            "cache_size": -int(cf.get("dbcachesize", 64 * 1024)),
+            "temp_store": "MEMORY",
+        }
+        # pooled rather than the NullPool default for sqlite files, so the
+        # connections (and their pragmas) are re-used
+        kwargs = {
+            "echo": echo,
+            "connect_args": {"timeout": 30, "check_same_thread": False},
+            "poolclass": QueuePool,
+            "pool_size": int(cf.get("dbpoolsize", 5)),
+            "max_overflow": int(cf.get("dbmaxoverflow", 10)),
+        }
+        eng = create_engine(makeDBURL(cf), **kwargs)
+
+        @event.listens_for(eng, "connect")
+        def setPragmas(dbapiconn, record):
+            cursor = dbapiconn.cursor()
+            for key, val in pragmas.items():
+                cursor.execute(f"PRAGMA {key}={val}")
+            cursor.close()
+
+        return eng
     except Exception as e:
         errorNotify(sys.exc_info()[2], e)
 
@@ -57,7 +221,58 @@ def createTables(engine):
         errorNotify(sys.exc_info()[2], e)
 
 
+def createIndexes(engine):
+    """Adds any indexes declared in models.py that an existing database
+    does not have yet, returns the names of the indexes created."""
+    try:
+        created = []
+        insp = inspect(engine)
+        tables = insp.get_table_names()
+        for table in Base.metadata.sorted_tables:
+            if table.name not in tables:
+                continue
+            have = {ix["name"] for ix in insp.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in have:
+                    index.create(engine)
+                    created.append(index.name)
+        return created
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+
+
+def upsert(session, model, rows):
+    """Insert rows, updating the non primary key columns of rows that exist.
+
+    rows is a list of dicts keyed by column name, they are sent to the
+    database in one executemany statement.
+    """
+    try:
+        if len(rows) == 0:
+            return
+        table = model.__table__
+        keys = [c.name for c in table.primary_key.columns]
+        cols = [c.name for c in table.columns if c.name not in keys]
+        dialect = session.get_bind().dialect.name
+        if dialect == "mysql":
+            stmt = mysql.insert(table)
+            stmt = stmt.on_duplicate_key_update({c: stmt.inserted[c] for c in cols})
+        elif dialect == "sqlite":
+            stmt = sqlite.insert(table)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=keys, set_={c: stmt.excluded[c] for c in cols}
+            )
+        else:
+            [session.merge(model(**row)) for row in rows]
+            return
+        session.execute(stmt, rows)
+    except Exception as e:
+        errorRaise(sys.exc_info()[2], e)
+
+
 if __name__ == "__main__":
     cf = Configuration(appname="tvrecorder")
-    mysqleng = makeDBEngine(cf)
+    mysqleng = getEngine(cf)
     createTables(mysqleng)
+    for name in createIndexes(mysqleng):
+        print(f"created index {name}")
@@ -0,0 +1,82 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Interval index module for tvrecorder."""
+from bisect import bisect_left, bisect_right
+import sys
+
+from ccaerrors import errorNotify
+
+
+class IntervalIndex:
+    """Sorted index of half open [start, end) intervals.
+
+    Intervals are kept sorted by start time, an overlap query bisects
+    to the window of intervals that could overlap, which is bounded by
+    the longest interval held.
+    """
+
+    def __init__(self):
+        try:
+            self.starts = []
+            self.items = []
+            self.maxlen = 0
+        except Exception as e:
+            errorNotify(sys.exc_info()[2], e)
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, start, duration, item=None):
+        """Add the interval [start, start + duration) labelled with item."""
+        try:
+            i = bisect_right(self.starts, start)
+            self.starts.insert(i, start)
+            self.items.insert(i, (start, start + duration, item))
+            self.maxlen = max(self.maxlen, duration)
+        except Exception as e:
+            errorNotify(sys.exc_info()[2], e)
+
+    def remove(self, start, item):
+        """Remove the interval starting at start labelled with item.
+
+        returns True if it was found
+        """
+        try:
+            i = bisect_left(self.starts, start)
+            while i < len(self.starts) and self.starts[i] == start:
+                if self.items[i][2] == item:
+                    del self.starts[i]
+                    del self.items[i]
+                    return True
+                i += 1
+            return False
+        except Exception as e:
+            errorNotify(sys.exc_info()[2], e)
+
+    def overlaps(self, start, end):
+        """Returns the (start, end, item) tuples that overlap [start, end).
+
+        Intervals that only touch at an edge do not overlap.
+        """
+        try:
+            lo = bisect_right(self.starts, start - self.maxlen)
+            hi = bisect_left(self.starts, end)
+            return [x for x in self.items[lo:hi] if x[1] > start and x[0] < end]
+        except Exception as e:
+            errorNotify(sys.exc_info()[2], e)
@@ -0,0 +1,83 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Incremental JSON array parser for tvrecorder.
+
+Large Schedules Direct responses are JSON arrays, parsing them one
+element at a time means only one element needs to be held in memory.
+"""
+import codecs
+import json
+import sys
+
+from ccaerrors import errorRaise
+
+WHITESPACE = " \t\n\r"
+
+
+def iterJsonArray(chunks):
+    """Yields each element of a JSON array as it arrives.
+
+    args: chunks: iterable of bytes, ie. requests Response.iter_content()
+    """
+    try:
+        decoder = json.JSONDecoder()
+        utf8 = codecs.getincrementaldecoder("utf-8")()
+        chunks = iter(chunks)
+        buf = ""
+        pos = 0
+        started = finished = eof = False
+        while not finished:
+            # skip the separators between elements
+            while pos < len(buf) and (
+                buf[pos] in WHITESPACE or (started and buf[pos] == ",")
+            ):
+                pos += 1
+            if pos < len(buf):
+                if not started:
+                    if buf[pos] != "[":
+                        rest = buf[pos:] + "".join(utf8.decode(x) for x in chunks)
+                        raise Exception(f"expected a JSON array: {rest[:200]}")
+                    started = True
+                    pos += 1
+                    continue
+                if buf[pos] == "]":
+                    finished = True
+                    continue
+                try:
+                    item, end = decoder.raw_decode(buf, pos)
+                    # only a delimiter after the element shows that it is
+                    # complete, ie. "12" may be the start of "12.5"
+                    if eof or (end < len(buf) and buf[end] in WHITESPACE + ",]"):
+                        yield item
+                        pos = end
+                        continue
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+            if eof:
+                raise Exception("JSON array is not terminated")
+            chunk = next(chunks, None)
+            if chunk is None:
+                eof = True
+                buf = buf[pos:] + utf8.decode(b"", final=True)
+            else:
+                buf = buf[pos:] + utf8.decode(chunk)
+            pos = 0
+    except Exception as e:
+        errorRaise(sys.exc_info()[2], e)
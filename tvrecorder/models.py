@@ -20,7 +20,7 @@
 import sys
 
 from ccaerrors import errorNotify
-from sqlalchemy import Integer, String, Column, inspect
+from sqlalchemy import Integer, String, Column, Index, inspect
 from sqlalchemy.orm import declarative_base
 
 Base = declarative_base()
@@ -28,6 +28,7 @@ Base = declarative_base()
 
 class Schedulemd5(Base):
     __tablename__ = "schedulemd5"
+    __table_args__ = (Index("ix_schedulemd5_stationid", "stationid"),)
 
     md5 = Column(String(32), primary_key=True)
     stationid = Column(String(128), primary_key=True)
@@ -44,6 +45,12 @@ class Schedulemd5(Base):
 
 class Schedule(Base):
     __tablename__ = "schedule"
+    # the primary key leads with programid, the listings and overlap
+    # queries filter on stationid and / or airdate
+    __table_args__ = (
+        Index("ix_schedule_stationid_airdate", "stationid", "airdate"),
+        Index("ix_schedule_airdate", "airdate"),
+    )
 
     programid = Column(String(128), primary_key=True)
     stationid = Column(String(128), primary_key=True)
@@ -113,6 +120,7 @@ class Person(Base):
 
 class Personmap(Base):
     __tablename__ = "personmap"
+    __table_args__ = (Index("ix_personmap_programid", "programid"),)
 
     personid = Column(Integer(), primary_key=True)
     programid = Column(String(128), primary_key=True)
@@ -124,3 +132,65 @@ class Personmap(Base):
 
     def _todict_(self):
         return {c.key: getattr(self, c.key) for c in inspect(self).mapper.column_attrs}
+
+
+class Updaterun(Base):
+    __tablename__ = "updaterun"
+
+    runid = Column(Integer(), primary_key=True, autoincrement=True)
+    started = Column(Integer())
+    finished = Column(Integer(), nullable=True)
+
+    def __repr__(self):
+        return f"<Updaterun(runid={self.runid}, started={self.started}, finished={self.finished}>"
+
+    def _todict_(self):
+        return {c.key: getattr(self, c.key) for c in inspect(self).mapper.column_attrs}
+
+
+class Runjournal(Base):
+    """What an update run has finished storing.
+
+    kind "schedule": item is the stationid, datets the day of the schedule
+    kind "programs": item is the first programid of a committed batch
+    """
+
+    __tablename__ = "runjournal"
+
+    runid = Column(Integer(), primary_key=True)
+    kind = Column(String(32), primary_key=True)
+    item = Column(String(128), primary_key=True)
+    datets = Column(Integer(), primary_key=True)
+    count = Column(Integer())
+    doneat = Column(Integer())
+
+    def __repr__(self):
+        return f"<Runjournal(runid={self.runid}, kind={self.kind}, item={self.item}, datets={self.datets}>"
+
+    def _todict_(self):
+        return {c.key: getattr(self, c.key) for c in inspect(self).mapper.column_attrs}
+
+
+class Recording(Base):
+    """A programme airing booked for recording, channel is the name in the
+    dvb_channel.conf file."""
+
+    __tablename__ = "recording"
+    __table_args__ = (Index("ix_recording_airdate", "airdate"),)
+
+    programid = Column(String(128), primary_key=True)
+    stationid = Column(String(128), primary_key=True)
+    airdate = Column(Integer(), primary_key=True)
+    duration = Column(Integer())
+    title = Column(String(255))
+    channel = Column(String(128))
+    priority = Column(Integer(), default=0)
+    frontpadding = Column(Integer(), default=120)
+    endpadding = Column(Integer(), default=900)
+    status = Column(String(32), default="pending")
+
+    def __repr__(self):
+        return f"<Recording(title={self.title}, channel={self.channel}, airdate={self.airdate}, status={self.status}>"
+
+    def _todict_(self):
+        return {c.key: getattr(self, c.key) for c in inspect(self).mapper.column_attrs}
@@ -0,0 +1,175 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""MPEG transport stream packets and tables for tvrecorder.
+
+Just enough of ISO/IEC 13818-1 to find the streams of a service: the
+packet header, the PAT, which maps each service ID (program_number) to the
+PID of its PMT, and the PMT, which lists the PIDs of the service's
+elementary streams. Tables are assumed to fit in a single packet, as the
+PAT and PMTs of a broadcast mux do.
+"""
+PACKETSIZE = 188
+SYNCBYTE = 0x47
+PATPID = 0x0000
+NULLPID = 0x1FFF
+
+
+def findSync(buf, off, size):
+    """Returns the offset of the first packet in sync at or after off, one
+    whose sync byte is followed by another a packet later or that is too
+    near size to tell, or size if there is none."""
+    while off < size:
+        off = buf.find(bytes([SYNCBYTE]), off, size)
+        if off < 0:
+            return size
+        nxt = off + PACKETSIZE
+        if nxt >= size or buf[nxt] == SYNCBYTE:
+            return off
+        off += 1
+    return size
+
+
+def packetPid(buf, off=0):
+    return ((buf[off + 1] & 0x1F) << 8) | buf[off + 2]
+
+
+def transportError(buf, off=0):
+    """Has the demodulator flagged the packet as damaged."""
+    return bool(buf[off + 1] & 0x80)
+
+
+def payloadStart(buf, off=0):
+    """Does the packet start a new table section or PES packet."""
+    return bool(buf[off + 1] & 0x40)
+
+
+def continuityCounter(buf, off=0):
+    return buf[off + 3] & 0x0F
+
+
+def hasPayload(buf, off=0):
+    return bool(buf[off + 3] & 0x10)
+
+
+def hasAdaptation(buf, off=0):
+    return bool(buf[off + 3] & 0x20)
+
+
+def payloadOffset(buf, off=0):
+    """Offset of the packet's payload in buf, the adaptation field, if any,
+    is skipped."""
+    start = off + 4
+    if hasAdaptation(buf, off):
+        start += 1 + buf[off + 4]
+    return start
+
+
+def tableSection(buf, off=0):
+    """Returns the section starting in the packet at off, the payload
+    after the pointer field, or None if no section starts there."""
+    if not payloadStart(buf, off) or not hasPayload(buf, off):
+        return None
+    # a corrupt adaptation field length or pointer field can point past the
+    # end of the packet
+    end = off + PACKETSIZE
+    start = payloadOffset(buf, off)
+    if start >= end:
+        return None
+    start += 1 + buf[start]
+    if start + 3 > end:
+        return None
+    length = ((buf[start + 1] & 0x0F) << 8) | buf[start + 2]
+    return bytes(buf[start : min(end, start + 3 + length)])
+
+
+def parsePat(section):
+    """Returns {service id: PMT PID} from a PAT section, the network PID
+    entry (service 0) is left out."""
+    if section is None or len(section) < 12 or section[0] != 0x00:
+        return {}
+    length = ((section[1] & 0x0F) << 8) | section[2]
+    # the entries follow the 8 byte header and precede the 4 byte CRC
+    end = min(len(section), 3 + length - 4)
+    pmts = {}
+    for i in range(8, end - 3, 4):
+        sid = (section[i] << 8) | section[i + 1]
+        pid = ((section[i + 2] & 0x1F) << 8) | section[i + 3]
+        if sid != 0:
+            pmts[sid] = pid
+    return pmts
+
+
+def parsePmt(section):
+    """Returns (service id, PCR PID, [(stream type, PID)]) from a PMT
+    section, or None if it is not one."""
+    if section is None or len(section) < 16 or section[0] != 0x02:
+        return None
+    length = ((section[1] & 0x0F) << 8) | section[2]
+    end = min(len(section), 3 + length - 4)
+    sid = (section[3] << 8) | section[4]
+    pcrpid = ((section[8] & 0x1F) << 8) | section[9]
+    i = 12 + (((section[10] & 0x0F) << 8) | section[11])
+    streams = []
+    while i + 5 <= end:
+        stype = section[i]
+        pid = ((section[i + 1] & 0x1F) << 8) | section[i + 2]
+        i += 5 + (((section[i + 3] & 0x0F) << 8) | section[i + 4])
+        streams.append((stype, pid))
+    return sid, pcrpid, streams
+
+
+class ContinuityCounter:
+    """Counts the packets lost from a stream, from the gaps in each PID's
+    continuity counter.
+
+    A packet repeated once with the same counter is allowed, packets
+    without a payload and those flagged as a discontinuity do not count.
+    """
+
+    def __init__(self):
+        self.last = {}
+        self.errors = 0
+        self.lost = 0
+        self.transporterrors = 0
+
+    def check(self, buf, off=0):
+        """Checks the packet at off, returns the number of packets lost
+        before it."""
+        if transportError(buf, off):
+            self.transporterrors += 1
+            return 0
+        pid = packetPid(buf, off)
+        if pid == NULLPID or not hasPayload(buf, off):
+            return 0
+        flagged = hasAdaptation(buf, off) and buf[off + 4] > 0 and buf[off + 5] & 0x80
+        return self.count(pid, buf[off + 3] & 0x0F, flagged)
+
+    def count(self, pid, cc, discontinuity=False):
+        """Counts a packet with a payload and no transport error, for those
+        that have read its header already, returns the number of packets
+        lost before it."""
+        last = self.last.get(pid)
+        self.last[pid] = cc
+        if last is None or cc == last or discontinuity:
+            return 0
+        lost = (cc - last - 1) % 16
+        if lost:
+            self.errors += 1
+            self.lost += lost
+        return lost
@@ -0,0 +1,364 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Multiplex aware recording for tvrecorder.
+
+Channels in the dvb_channel.conf file that share a frequency are carried
+in the same multiplex, so one tuner receives all of them. Recordings on
+one multiplex that overlap are grouped and made with a single tuner: the
+whole multiplex is passed to the DVR device (dvbv5-zap -r -P) and split
+by service ID into a .ts file per recording.
+
+Each file gets the PAT, the service's PMT and the PIDs the PMT lists,
+written through a CaptureWriter. The PAT is passed through as broadcast,
+so still lists the other services of the multiplex, players pick the
+service whose PMT is present.
+"""
+import argparse
+import configparser
+import os
+import select
+import subprocess
+import sys
+import time
+
+from ccaerrors import errorNotify, errorRaise
+import ccalogging
+
+from tvrecorder.mpegts import (
+    PACKETSIZE,
+    PATPID,
+    SYNCBYTE,
+    findSync,
+    packetPid,
+    parsePat,
+    parsePmt,
+    tableSection,
+    transportError,
+)
+from tvrecorder.capture import BYTERATE, DVRPATH, CaptureWriter, stopOnTerm
+from tvrecorder.scheduler import recordingEnd, recordingStart
+from tvrecorder.tvr import ZAPCONF, recordingPath
+
+log = ccalogging.log
+
+
+def readZapConf(path=None):
+    """Returns the dvb_channel.conf file as a ConfigParser, a section per
+    channel."""
+    try:
+        zap = configparser.ConfigParser()
+        zap.read(path or ZAPCONF)
+        return zap
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+
+
+def multiplexKey(zap, channel):
+    """Returns what identifies the multiplex channel is carried on, or None
+    if the channel or its frequency is not in the zap config."""
+    if not zap.has_section(channel) or not zap.has_option(channel, "frequency"):
+        return None
+    sect = zap[channel]
+    return (
+        sect.get("delivery_system", ""),
+        sect.get("frequency"),
+        sect.get("stream_id", ""),
+    )
+
+
+def serviceId(zap, channel):
+    try:
+        return int(zap[channel]["service_id"])
+    except (KeyError, ValueError):
+        return None
+
+
+def groupByMultiplex(recs, zap):
+    """Groups the recordings that overlap on the same multiplex.
+
+    A recording that overlaps no other on its multiplex, or whose channel
+    is not in the zap config, is returned as it is. A group is a recording
+    dict spanning its members' padded times, with the highest of their
+    priorities, and the members, each with its "serviceid", in "members".
+
+    returns: list of recordings and groups in start time order
+    """
+    try:
+        units = []
+        groups = {}
+        for rec in sorted(recs, key=recordingStart):
+            key = multiplexKey(zap, rec["channel"])
+            sid = serviceId(zap, rec["channel"])
+            if key is None or sid is None:
+                units.append([rec])
+                continue
+            member = dict(rec)
+            member["serviceid"] = sid
+            group = groups.get(key)
+            if group is not None and recordingStart(rec) < group[0]:
+                group[0] = max(group[0], recordingEnd(rec))
+                group[1].append(member)
+            else:
+                groups[key] = [recordingEnd(rec), [member]]
+                units.append(groups[key][1])
+        return [makeGroup(x) for x in units]
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+
+
+def makeGroup(members):
+    if len(members) == 1:
+        return members[0]
+    first = members[0]
+    start = recordingStart(first)
+    end = max(recordingEnd(x) for x in members)
+    return {
+        "programid": first["programid"],
+        "stationid": first["stationid"],
+        "airdate": start,
+        "duration": end - start,
+        "frontpadding": 0,
+        "endpadding": 0,
+        "title": " + ".join(x["title"] for x in members),
+        "channel": first["channel"],
+        "priority": max(x.get("priority") or 0 for x in members),
+        "status": "pending",
+        "members": members,
+    }
+
+
+class ServiceDemux:
+    """Splits a transport stream into the packets of each service.
+
+    Feed it the stream in chunks of any size, it writes each service's
+    packets to the file objects listed for it in sinks, which can be
+    changed between feeds.
+    """
+
+    def __init__(self, sids):
+        self.sids = set(sids)
+        self.sinks = {sid: [] for sid in self.sids}
+        self.pmtpids = {}
+        self.streams = {}
+        self.routes = {}
+        self.pmtset = set()
+        self.route()
+        self.rest = b""
+        # rest starts with a sync byte that has not been confirmed yet
+        self.hunting = False
+        self.packets = 0
+        self.resyncs = 0
+
+    def route(self):
+        """Rebuilds the map of PID to the services it belongs to."""
+        routes = {PATPID: set(self.sids)}
+        self.pmtset = set(self.pmtpids.values())
+        for sid, pid in self.pmtpids.items():
+            routes.setdefault(pid, set()).add(sid)
+        for sid, pids in self.streams.items():
+            for pid in pids:
+                routes.setdefault(pid, set()).add(sid)
+        self.routes = routes
+
+    def readPat(self, buf, off):
+        try:
+            pmts = parsePat(tableSection(buf, off))
+            pmtpids = {sid: pmts[sid] for sid in self.sids if sid in pmts}
+            if pmtpids and pmtpids != self.pmtpids:
+                self.pmtpids = pmtpids
+                self.route()
+        except Exception as e:
+            # a malformed PAT is ignored, the next one will do
+            errorNotify(sys.exc_info()[2], e)
+
+    def readPmt(self, buf, off):
+        try:
+            pmt = parsePmt(tableSection(buf, off))
+            if pmt is None or pmt[0] not in self.sids:
+                return
+            sid, pcrpid, streams = pmt
+            pids = {pid for _, pid in streams} | {pcrpid}
+            if pids != self.streams.get(sid):
+                self.streams[sid] = pids
+                self.route()
+        except Exception as e:
+            errorNotify(sys.exc_info()[2], e)
+
+    def feed(self, data):
+        """Demultiplexes data, returns the number of whole packets read."""
+        buf = self.rest + data if self.rest else data
+        view = memoryview(buf)
+        out = {sid: bytearray() for sid in self.sids}
+        size = len(buf)
+        off = 0
+        count = 0
+        if self.hunting:
+            off = findSync(buf, 0, size)
+            self.hunting = off + PACKETSIZE >= size
+        end = size - PACKETSIZE
+        while not self.hunting and off <= end:
+            if buf[off] != SYNCBYTE:
+                # lost sync, skip to the next sync byte followed by another,
+                # as captureStream does
+                self.resyncs += 1
+                off = findSync(buf, off + 1, size)
+                self.hunting = off + PACKETSIZE >= size
+                continue
+            pid = packetPid(buf, off)
+            sids = self.routes.get(pid)
+            if sids is not None:
+                # the tables are only read from undamaged packets
+                if not transportError(buf, off):
+                    if pid == PATPID:
+                        self.readPat(buf, off)
+                    elif pid in self.pmtset:
+                        self.readPmt(buf, off)
+                for sid in sids:
+                    out[sid] += view[off : off + PACKETSIZE]
+            off += PACKETSIZE
+            count += 1
+        self.rest = bytes(buf[off:])
+        view.release()
+        self.packets += count
+        for sid, xbytes in out.items():
+            if xbytes:
+                for sink in self.sinks[sid]:
+                    sink.write(xbytes)
+        return count
+
+
+def captureServices(fd, records, clock=time.time, stop=None, chunk=PACKETSIZE * 512):
+    """Reads the transport stream from fd, writing each recording's
+    service to its file while the recording is on.
+
+    Args:
+        fd: int: file descriptor of the DVR device, or a pipe
+        records: list of (service id, start, end, path) tuples
+        clock: function returning the time now as an epoch
+        stop: function returning True to stop early
+        chunk: int: the most bytes to read at a time
+    returns: dict of path: bytes written
+    """
+    try:
+        demux = ServiceDemux([x[0] for x in records])
+        files = {}
+        written = {}
+        last = max(x[2] for x in records)
+        try:
+            while True:
+                now = clock()
+                for i, (sid, start, end, path) in enumerate(records):
+                    if i not in files and i not in written and start <= now < end:
+                        log.info(f"capturing service {sid} to {path}")
+                        size = int(end - max(now, start)) * BYTERATE
+                        files[i] = CaptureWriter(path, size=size)
+                        demux.sinks[sid].append(files[i])
+                    elif i in files and now >= end:
+                        demux.sinks[sid].remove(files[i])
+                        xfile = files.pop(i)
+                        written[i] = xfile.tell()
+                        xfile.close()
+                if now >= last or (stop is not None and stop()):
+                    break
+                if not select.select([fd], [], [], 1)[0]:
+                    continue
+                data = os.read(fd, chunk)
+                if not data:
+                    break
+                demux.feed(data)
+        finally:
+            for i, xfile in files.items():
+                written[i] = xfile.tell()
+                xfile.close()
+        log.info(f"read {demux.packets} packets, lost sync {demux.resyncs} times")
+        return {records[i][3]: n for i, n in written.items()}
+    except Exception as e:
+        errorRaise(sys.exc_info()[2], e)
+
+
+def multiplexCommand(rec, start, length, adaptor=0, basedir=".", conf=None):
+    """Returns the command list that records a group of recordings, made
+    by groupByMultiplex, from one tuner."""
+    try:
+        cmd = [sys.executable, "-m", "tvrecorder.multiplex", "-a", str(adaptor)]
+        cmd += ["-c", conf or ZAPCONF, "-t", str(int(length))]
+        for member in rec["members"]:
+            xstart = max(start, recordingStart(member))
+            fqfn = recordingPath(member["title"], member["channel"], xstart, basedir)
+            cmd += ["-s", str(member["serviceid"]), str(int(xstart))]
+            cmd += [str(int(recordingEnd(member))), str(fqfn)]
+        cmd.append(rec["channel"])
+        return cmd
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+
+
+def muxRecord(channel, records, length, adaptor=0, conf=None, stop=None):
+    """Tunes adaptor to channel's multiplex for length seconds, or until
+    stop() returns True, and captures the records, see captureServices,
+    returns True if every recording got some of its service."""
+    try:
+        cmd = ["dvbv5-zap", "-c", conf or ZAPCONF, "-a", str(adaptor), "-r", "-P"]
+        cmd += ["-t", str(int(length)), channel]
+        log.info(f"tuning adaptor {adaptor} to the multiplex of {channel}")
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+        fd = None
+        try:
+            fd = os.open(DVRPATH.format(adaptor), os.O_RDONLY)
+            done = lambda: proc.poll() is not None or (stop and stop())
+            written = captureServices(fd, records, stop=done)
+        finally:
+            if fd is not None:
+                os.close(fd)
+            if proc.poll() is None:
+                proc.terminate()
+            proc.wait()
+        for path, size in written.items():
+            log.info(f"{path}: {size} bytes")
+        return len(written) == len(records) and all(written.values())
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="record services of a multiplex")
+    parser.add_argument("-a", "--adaptor", type=int, default=0)
+    parser.add_argument("-c", "--conf", default=ZAPCONF)
+    parser.add_argument("-t", "--length", type=int, required=True)
+    parser.add_argument(
+        "-s",
+        "--service",
+        nargs=4,
+        action="append",
+        required=True,
+        metavar=("SID", "START", "END", "PATH"),
+    )
+    parser.add_argument("channel")
+    args = parser.parse_args()
+    records = [(int(s), int(b), int(e), p) for s, b, e, p in args.service]
+    stop = stopOnTerm()
+    ok = muxRecord(
+        args.channel, records, args.length, args.adaptor, args.conf, stop=stop
+    )
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
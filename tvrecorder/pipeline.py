@@ -0,0 +1,213 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Threaded pipeline of stages joined by bounded queues.
+
+The first stage iterates a source (the network fetch), each later stage
+applies a function to every item the stage before it produced. Each stage
+runs in its own thread, so a slow stage only holds up the others once the
+queue in front of it is full.
+"""
+import queue
+import sys
+import threading
+import time
+
+from ccaerrors import errorRaise
+import ccalogging
+
+log = ccalogging.log
+
+# marks the end of a stage's output
+DONE = object()
+
+
+class StageStats:
+    """Throughput and input queue depth of one pipeline stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.started = None
+        self.ended = None
+        self.depthsum = 0
+        self.depthmax = 0
+        self.gets = 0
+
+    def sample(self, depth):
+        self.depthsum += depth
+        self.depthmax = max(self.depthmax, depth)
+        self.gets += 1
+
+    def summary(self):
+        wall = (self.ended or time.perf_counter()) - (self.started or 0)
+        return {
+            "items": self.items,
+            "busy": round(self.busy, 3),
+            "wall": round(wall, 3),
+            "rate": round(self.items / wall, 1) if wall > 0 else 0,
+            "avgdepth": round(self.depthsum / self.gets, 1) if self.gets else 0,
+            "maxdepth": self.depthmax,
+        }
+
+
+class Pipeline:
+    def __init__(self, source, stages, maxsize=8, name="pipeline"):
+        """Initialise the pipeline.
+
+        Args:
+            source: iterable: the items to feed the first stage, iterated in
+                    a thread of its own, the "fetch" stage
+            stages: list of (name, func) tuples, func is called with each
+                    item in turn, what it returns is passed on, None is
+                    dropped
+            maxsize: int: the most items waiting between two stages
+            name: str: for the log
+        """
+        self.source = source
+        self.stages = stages
+        self.maxsize = maxsize
+        self.name = name
+        self.stats = [StageStats("fetch")] + [StageStats(x[0]) for x in stages]
+        self.queues = [queue.Queue(maxsize) for _ in stages]
+        self.results = []
+        self.error = None
+        self.failed = threading.Event()
+
+    def fail(self, e):
+        if not self.failed.is_set():
+            self.error = e
+            self.failed.set()
+
+    def fetch(self):
+        stats = self.stats[0]
+        stats.started = time.perf_counter()
+        out = self.queues[0] if self.queues else None
+        try:
+            it = iter(self.source)
+            while not self.failed.is_set():
+                start = time.perf_counter()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    break
+                stats.busy += time.perf_counter() - start
+                stats.items += 1
+                self.emit(out, item)
+        except BaseException as e:
+            self.fail(e)
+        finally:
+            stats.ended = time.perf_counter()
+            if out is not None:
+                out.put(DONE)
+
+    def work(self, n):
+        name, func = self.stages[n]
+        stats = self.stats[n + 1]
+        stats.started = time.perf_counter()
+        inq = self.queues[n]
+        out = self.queues[n + 1] if n + 1 < len(self.queues) else None
+        while True:
+            stats.sample(inq.qsize())
+            item = inq.get()
+            if item is DONE:
+                break
+            # after a failure keep draining, so the stages in front of
+            # this one are not left blocked on a full queue
+            if self.failed.is_set():
+                continue
+            try:
+                start = time.perf_counter()
+                result = func(item)
+                stats.busy += time.perf_counter() - start
+                stats.items += 1
+            except BaseException as e:
+                # errorExit in a stage raises SystemExit, stop the pipeline
+                # rather than just this thread
+                self.fail(e)
+                continue
+            if result is not None:
+                self.emit(out, result)
+        stats.ended = time.perf_counter()
+        if out is not None:
+            out.put(DONE)
+
+    def emit(self, out, item):
+        if out is None:
+            self.results.append(item)
+        else:
+            out.put(item)
+
+    def serial(self):
+        """Runs each item through every stage in turn, in this thread."""
+        for stats in self.stats:
+            stats.started = time.perf_counter()
+        try:
+            it = iter(self.source)
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    break
+                for stats, stage in zip(self.stats, [None] + self.stages):
+                    if stage is not None:
+                        start = time.perf_counter()
+                        item = stage[1](item)
+                    stats.busy += time.perf_counter() - start
+                    stats.items += 1
+                    if item is None:
+                        break
+                else:
+                    self.results.append(item)
+        except BaseException as e:
+            self.fail(e)
+        for stats in self.stats:
+            stats.ended = time.perf_counter()
+
+    def run(self, threaded=True):
+        """Runs every stage to completion, returns the list of what the last
+        stage produced.
+
+        threaded: False runs the stages one after the other in this thread
+        """
+        try:
+            start = time.perf_counter()
+            if threaded:
+                threads = [threading.Thread(target=self.fetch, daemon=True)]
+                for n in range(len(self.stages)):
+                    threads.append(
+                        threading.Thread(target=self.work, args=(n,), daemon=True)
+                    )
+                [thread.start() for thread in threads]
+                [thread.join() for thread in threads]
+            else:
+                self.serial()
+            took = time.perf_counter() - start
+            for stats in self.stats:
+                log.info(f"{self.name}: {stats.name}: {stats.summary()}")
+            log.info(f"{self.name}: {len(self.results)} results in {took:.3f}s")
+            if self.error is not None:
+                raise self.error
+            return self.results
+        except Exception as e:
+            errorRaise(sys.exc_info()[2], e)
+
+    def summary(self):
+        return {stats.name: stats.summary() for stats in self.stats}
@@ -0,0 +1,154 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Retry policy and rate limiter for the SD API requests."""
+from email.utils import parsedate_to_datetime
+import random
+import sys
+import threading
+import time
+
+from ccaerrors import errorNotify, errorRaise
+import ccalogging
+import requests
+
+log = ccalogging.log
+
+# responses that mean the request may succeed if sent again
+RETRYSTATUS = {429, 500, 502, 503, 504}
+
+# SD answers these POSTs without changing anything, so they are as safe to
+# repeat as a GET
+SAFEPOSTS = {"token", "programs", "schedules", "schedules/md5"}
+
+# failures of an idempotent request, including the connection dropping
+# while the body is read, that may not happen again
+TRANSIENT = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter.
+
+    The delay before attempt n + 1 is a random time between 0 and
+    min(maxdelay, backoff * 2 ** n) seconds, or the server's Retry-After if
+    that is longer.
+    """
+
+    def __init__(self, maxattempts=5, backoff=0.5, maxdelay=30, maxretryafter=300):
+        try:
+            self.maxattempts = max(1, maxattempts)
+            self.backoff = backoff
+            self.maxdelay = maxdelay
+            self.maxretryafter = maxretryafter
+        except Exception as e:
+            errorNotify(sys.exc_info()[2], e)
+
+    def idempotent(self, method, route):
+        try:
+            return method in ("GET", "PUT", "DELETE") or route in SAFEPOSTS
+        except Exception as e:
+            errorRaise(sys.exc_info()[2], e)
+
+    def retryable(self, method, route, res=None, exc=None):
+        """Should a request that got response res, or raised exc, be sent
+        again.
+
+        Requests that change things are only repeated when the server
+        cannot have acted on them: the connection was never made, or it
+        answered 429 (too many requests).
+        """
+        try:
+            if self.idempotent(method, route):
+                if exc is not None:
+                    return isinstance(exc, TRANSIENT)
+                return res.status_code in RETRYSTATUS
+            if exc is not None:
+                return isinstance(exc, requests.exceptions.ConnectTimeout)
+            return res.status_code == 429
+        except Exception as e:
+            errorRaise(sys.exc_info()[2], e)
+
+    def delay(self, attempt, res=None):
+        """Seconds to wait after the attempt numbered from 0 failed."""
+        try:
+            wait = random.uniform(0, min(self.maxdelay, self.backoff * 2**attempt))
+            if res is not None:
+                wait = max(wait, self.retryAfter(res.headers.get("Retry-After")))
+            return wait
+        except Exception as e:
+            errorRaise(sys.exc_info()[2], e)
+
+    def retryAfter(self, value):
+        """Seconds asked for by a Retry-After header, either a number of
+        seconds or an HTTP date."""
+        try:
+            if not value:
+                return 0
+            try:
+                secs = float(value)
+            except ValueError:
+                try:
+                    secs = parsedate_to_datetime(value).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    log.warning(f"ignoring unreadable Retry-After: {value}")
+                    return 0
+            return min(max(0, secs), self.maxretryafter)
+        except Exception as e:
+            errorRaise(sys.exc_info()[2], e)
+
+
+class TokenBucket:
+    """Client side rate limiter, allows bursts of up to burst requests and
+    rate requests per second on average."""
+
+    def __init__(self, rate, burst=10, clock=time.monotonic, sleep=time.sleep):
+        try:
+            self.rate = rate
+            self.burst = max(1, burst)
+            self.tokens = float(self.burst)
+            self.clock = clock
+            self.sleep = sleep
+            self.updated = clock()
+            self.lock = threading.Lock()
+            self.waited = 0.0
+        except Exception as e:
+            errorNotify(sys.exc_info()[2], e)
+
+    def acquire(self):
+        """Take a token, sleeping until one is available."""
+        try:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                # a negative balance reserves the token, later callers queue
+                # behind it
+                self.tokens -= 1
+                wait = -self.tokens / self.rate if self.tokens < 0 else 0
+                self.waited += wait
+            if wait > 0:
+                self.sleep(wait)
+            return wait
+        except Exception as e:
+            errorRaise(sys.exc_info()[2], e)
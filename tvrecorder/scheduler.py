@@ -0,0 +1,361 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Recording scheduler for tvrecorder.
+
+Upcoming recordings are kept in a heap ordered by their padded start
+time. The scheduler thread sleeps on a condition until the first of them
+is due, or until a recording is added, cancelled or the scheduler is
+stopped, so it does no work at all in between. Each recording is started
+as a dvbv5-zap process and watched by a thread of its own.
+
+Recordings are dicts with the columns of the Recording model.
+"""
+import heapq
+import itertools
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from ccaerrors import errorNotify, errorRaise
+import ccalogging
+
+from tvrecorder.capture import captureCommand
+from tvrecorder.tvr import buildRecordCommand, recordingPath
+
+log = ccalogging.log
+
+
+def recordingKey(rec):
+    return (rec["programid"], rec["stationid"], rec["airdate"])
+
+
+def recordingStart(rec):
+    """The padded start time."""
+    return rec["airdate"] - rec.get("frontpadding", 120)
+
+
+def recordingEnd(rec):
+    """The padded end time."""
+    return rec["airdate"] + rec["duration"] + rec.get("endpadding", 900)
+
+
+class RecordingScheduler:
+    def __init__(
+        self,
+        command=None,
+        basedir="/run/media/chris/seagate4/TV/tv/",
+        clock=time.time,
+        onchange=None,
+        capture=False,
+        postprocess=None,
+    ):
+        """Initialise the scheduler.
+
+        Args:
+            command: function(rec, start, length) returning the command list
+                     to record rec, default: the dvbv5-zap command from
+                     tvr.buildRecordCommand
+            basedir: str: recordings directory for the default command
+            clock: function returning the time now as an epoch
+            onchange: function(rec, status) called as a recording becomes
+                      "recording", "done", "failed" or "missed"
+            capture: bool: the default command reads the DVR stream and
+                     writes the file itself, see capture.py, rather than
+                     leave it to dvbv5-zap
+            postprocess: function(rec, paths) called, in the recording's
+                         watcher thread, with the files it was recorded to
+                         once its process has exited
+        """
+        self.command = command or self.zapCommand
+        self.basedir = basedir
+        self.clock = clock
+        self.onchange = onchange
+        self.capture = capture
+        self.postprocess = postprocess
+        self.heap = []
+        self.queued = {}
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.running = {}
+        self.watchers = []
+        self.finished = []
+        self.stopped = False
+        self.wakeups = 0
+
+    def zapCommand(self, rec, start, length):
+        if "members" in rec:
+            from tvrecorder.multiplex import multiplexCommand
+
+            adaptor = rec.get("adaptor", 0)
+            return multiplexCommand(rec, start, length, adaptor, self.basedir)
+        kwargs = {
+            "channel": rec["channel"],
+            "start": start,
+            "length": length,
+            "adaptor": rec.get("adaptor", 0),
+            "basedir": self.basedir,
+        }
+        if self.capture:
+            return captureCommand(rec["title"], **kwargs)
+        return buildRecordCommand(rec["title"], **kwargs)
+
+    def add(self, rec):
+        """Queues rec, replacing any queued recording of the same airing."""
+        with self.cond:
+            self.queued[recordingKey(rec)] = rec
+            heapq.heappush(self.heap, (recordingStart(rec), next(self.seq), rec))
+            self.cond.notify()
+
+    def cancel(self, key):
+        """Unqueues the recording with key, returns True if it was queued.
+
+        The heap entry is left where it is and skipped when it comes up.
+        """
+        with self.cond:
+            found = self.queued.pop(key, None) is not None
+            self.cond.notify()
+            return found
+
+    def replace(self, recs):
+        """Queues exactly recs, for when the bookings are reloaded, the
+        airings already recording are left alone."""
+        with self.cond:
+            recs = [x for x in recs if recordingKey(x) not in self.running]
+            self.queued = {recordingKey(x): x for x in recs}
+            self.heap = [(recordingStart(x), next(self.seq), x) for x in recs]
+            heapq.heapify(self.heap)
+            self.cond.notify()
+
+    def __len__(self):
+        return len(self.queued)
+
+    def current(self, entry):
+        """Is the heap entry still the queued version of its recording."""
+        return self.queued.get(recordingKey(entry[2])) is entry[2]
+
+    def step(self):
+        """Starts every recording that is due, returns the seconds until the
+        next one is, or None if nothing is queued."""
+        with self.cond:
+            if self.stopped:
+                return None
+            self.wakeups += 1
+            now = self.clock()
+            while self.heap and (
+                not self.current(self.heap[0]) or self.heap[0][0] <= now
+            ):
+                entry = heapq.heappop(self.heap)
+                if not self.current(entry):
+                    continue
+                rec = entry[2]
+                del self.queued[recordingKey(rec)]
+                if recordingEnd(rec) <= now:
+                    log.warning(f"missed recording {rec['title']}, it has finished")
+                    self.changed(rec, "missed")
+                    continue
+                self.start(rec, now)
+            if len(self.heap) == 0:
+                return None
+            return self.heap[0][0] - now
+
+    def start(self, rec, now):
+        """Starts the recorder process for rec and a thread to watch it, a
+        late start records what is left of the airing."""
+        try:
+            start = max(now, recordingStart(rec))
+            length = int(recordingEnd(rec) - start)
+            cmd = self.command(rec, start, length)
+            log.info(f"recording {rec['title']} on {rec['channel']} for {length}s")
+            proc = subprocess.Popen(
+                cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            self.running[recordingKey(rec)] = (rec, proc)
+            self.changed(rec, "recording")
+            paths = self.recordingPaths(rec, start) if self.postprocess else []
+            watcher = threading.Thread(
+                target=self.watch, args=(rec, proc, paths), daemon=True
+            )
+            self.watchers.append(watcher)
+            watcher.start()
+        except Exception as e:
+            errorNotify(sys.exc_info()[2], e)
+            self.changed(rec, "failed")
+
+    def recordingPaths(self, rec, start):
+        """The files the default commands record rec to."""
+        return [
+            recordingPath(
+                x["title"], x["channel"], max(start, recordingStart(x)), self.basedir
+            )
+            for x in rec.get("members", [rec])
+        ]
+
+    def watch(self, rec, proc, paths):
+        rc = proc.wait()
+        status = "done" if rc == 0 else "failed"
+        if rc != 0:
+            log.error(f"recording {rec['title']} failed, exit code {rc}")
+        with self.cond:
+            self.running.pop(recordingKey(rec), None)
+            self.finished.append((rec, rc))
+            self.cond.notify_all()
+        self.changed(rec, status)
+        if self.postprocess is not None:
+            try:
+                self.postprocess(rec, paths)
+            except Exception as e:
+                errorNotify(sys.exc_info()[2], e)
+
+    def changed(self, rec, status):
+        if self.onchange is not None:
+            try:
+                self.onchange(rec, status)
+            except Exception as e:
+                errorNotify(sys.exc_info()[2], e)
+
+    def run(self):
+        """Starts the recordings as they fall due until stop() is called."""
+        try:
+            # the step and the wait share one hold of the lock, so a notify
+            # from add, cancel, replace or stop cannot fall between them
+            with self.cond:
+                while not self.stopped:
+                    wait = self.step()
+                    if self.stopped:
+                        break
+                    self.cond.wait(wait)
+        except Exception as e:
+            errorRaise(sys.exc_info()[2], e)
+
+    def stop(self, terminate=True, timeout=10):
+        """Stops scheduling, and the recordings in progress if terminate."""
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+            running = list(self.running.values())
+        if terminate:
+            for rec, proc in running:
+                log.info(f"stopping recording {rec['title']}")
+                proc.terminate()
+        for watcher in list(self.watchers):
+            watcher.join(timeout)
+
+    def waitIdle(self, timeout=None):
+        """Waits until no recording is in progress."""
+        with self.cond:
+            return self.cond.wait_for(lambda: len(self.running) == 0, timeout)
+
+
+def daemon():
+    """Records the booked recordings as they fall due.
+
+    SIGHUP reloads the bookings from the database, groups those that
+    overlap on a multiplex and shares the "adaptors" configured between
+    them, SIGTERM and SIGINT stop the daemon and the recordings in
+    progress. Each file recorded is checked with tsinspect afterwards.
+    """
+    from tvrecorder.allocator import allocateAdaptors
+    from tvrecorder.config import Configuration
+    from tvrecorder.db import createTables, getEngine
+    from tvrecorder.multiplex import groupByMultiplex, readZapConf
+    from tvrecorder.tsinspect import inspectRecording
+    from tvrecorder.wrangler import pendingRecordings, setRecordingStatus
+
+    try:
+        cf = Configuration(appname="tvrecorder")
+        eng = getEngine(cf)
+        createTables(eng)
+        adaptors = int(cf.get("adaptors", 4))
+
+        def onchange(rec, status):
+            for member in rec.get("members", [rec]):
+                setRecordingStatus(eng, member, status)
+
+        def inspect(rec, paths):
+            for path in paths:
+                if os.path.exists(path):
+                    inspectRecording(path)
+
+        kwargs = {
+            "basedir": cf.get("recordingsdir", "/run/media/chris/seagate4/TV/tv/"),
+            "onchange": onchange,
+            "capture": cf.get("capture", False),
+            "postprocess": inspect if cf.get("inspect", True) else None,
+        }
+        sched = RecordingScheduler(**kwargs)
+
+        reloading = threading.Lock()
+
+        def reload():
+            try:
+                with reloading:
+                    loadBookings()
+            except Exception as e:
+                errorNotify(sys.exc_info()[2], e)
+
+        def loadBookings():
+            # what is recording keeps its adaptor, and its group as it was
+            with sched.cond:
+                running = [
+                    dict(x[0], status="recording") for x in sched.running.values()
+                ]
+            busy = set()
+            for rec in running:
+                busy.update(recordingKey(x) for x in rec.get("members", [rec]))
+            recs = [x for x in pendingRecordings(eng) if recordingKey(x) not in busy]
+            units = groupByMultiplex(recs, readZapConf())
+            booked, clashes = allocateAdaptors(running + units, adaptors)
+            for clash in clashes:
+                rec = clash["recording"]
+                others = ", ".join(x["title"] for x in clash["with"])
+                log.warning(
+                    f"cannot record {rec['title']} on {rec['channel']} at "
+                    f"{time.ctime(rec['airdate'])}, the adaptors are busy with {others}"
+                )
+            log.info(f"loaded {len(recs)} recordings, {len(clashes)} clash")
+            sched.replace(booked)
+
+        # the handlers run in the main thread, which may be inside step()
+        # holding the scheduler's lock, so they leave the work to a thread
+        def hangup(*args):
+            threading.Thread(target=reload, daemon=True).start()
+
+        stopping = []
+
+        def stop(*args):
+            stopper = threading.Thread(target=sched.stop)
+            stopping.append(stopper)
+            stopper.start()
+
+        signal.signal(signal.SIGHUP, hangup)
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        reload()
+        sched.run()
+        for stopper in stopping:
+            stopper.join()
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+
+
+if __name__ == "__main__":
+    daemon()
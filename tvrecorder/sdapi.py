@@ -22,20 +22,62 @@ re-written in my coding style, with added token caching/renewing
 Thankyou Steven T. Smith.
 """
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
+import hashlib
+from itertools import islice
 import json
+import re
 import sys
+import threading
 import time
 
 from ccaerrors import errorNotify
 import ccalogging
 import requests
+from requests.adapters import HTTPAdapter
 
 
 from tvrecorder import __version__
+from tvrecorder.jsonstream import iterJsonArray
+from tvrecorder.retry import RetryPolicy, TokenBucket
 
 log = ccalogging.log
 
+# Schedules Direct request size limits
+MAXPROGRAMS = 5000
+MAXSTATIONS = 5000
+
+
+def chunks(xlist, size):
+    """Yield successive lists of up to size items from the iterable xlist."""
+    it = iter(xlist)
+    while True:
+        chunk = list(islice(it, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+def routeName(route):
+    """The route without any trailing ids, ie. lineups/GBR-1000193-DEFAULT
+    is counted as lineups."""
+    parts = []
+    for part in route.split("/"):
+        if re.fullmatch("[a-z][a-z0-9]*", part) is None:
+            break
+        parts.append(part)
+    return "/".join(parts)
+
+
+def transferString(stats):
+    ratio = stats["decoded"] / stats["wire"] if stats["wire"] else 0
+    msg = f"{stats['requests']} requests, {stats['sent']} bytes sent, "
+    msg += f"{stats['wire']} bytes received, {stats['decoded']} decoded "
+    msg += f"({ratio:.1f}x)"
+    return msg
+
+
 # when the 20191022 api is out of beta the default url should be:
 # https://json.schedulesdirect.org/20191022
 # 20191022 fails at the get schedulesmd5 step, switching to
@@ -54,6 +96,17 @@ class SDApi:
         debug=False,
         token=None,
         tokenexpires=0,
+        poolsize=10,
+        keepalive=True,
+        timeout=(10, 120),
+        workers=4,
+        stream=False,
+        cache=None,
+        retries=5,
+        backoff=0.5,
+        maxbackoff=30,
+        rate=0,
+        burst=10,
     ):
         """Initialise the SDApi Class.
 
@@ -65,6 +118,23 @@ class SDApi:
             debug: bool: print api calls and responses
             token: str: cached token from previous runs, default: None
             tokenexpires: float: timestamp for when the cached token expires, default: 0
+            poolsize: int: number of connections kept open to SD, default: 10
+            keepalive: bool: re-use connections between requests, default: True
+            timeout: tuple: (connect, read) timeouts in seconds, default: (10, 120)
+            workers: int: concurrent requests for batched downloads, default: 4
+            stream: bool: parse program and schedule responses incrementally,
+                    getPrograms and getSchedules then return generators,
+                    default: False
+            cache: SDCache: check for programs and schedules here before
+                   downloading them, default: None
+            retries: int: attempts at each request before giving up, default: 5
+            backoff: float: seconds, the delay before a retry grows
+                     exponentially from this, with jitter, default: 0.5
+            maxbackoff: float: the most seconds to wait between attempts,
+                        unless the server asks for longer, default: 30
+            rate: float: requests per second allowed on average, 0 for no
+                  limit, default: 0
+            burst: int: requests allowed at once before rate applies, default: 10
         """
         try:
             self.username = username
@@ -72,12 +142,31 @@ class SDApi:
             self.appname = appname
             self.url = url
             self.debug = debug
-            self.headers = {"User-Agent": f"{appname} / {__version__}"}
+            self.headers = {
+                "User-Agent": f"{appname} / {__version__}",
+                "Accept-Encoding": "gzip, deflate",
+            }
             self.token = token
             self.tokenexpires = tokenexpires
             self.online = False
             self.statusmsg = "initialising"
             self.lineups = None
+            self.poolsize = poolsize
+            self.keepalive = keepalive
+            self.timeout = timeout
+            self.workers = workers
+            self.stream = stream
+            self.cache = cache
+            self.retry = RetryPolicy(retries, backoff, maxbackoff)
+            self.limiter = TokenBucket(rate, burst) if rate > 0 else None
+            self.retried = 0
+            self.session = self.makeSession()
+            # the token header is set per thread so batches can run concurrently
+            self.tls = threading.local()
+            self.tokenlock = threading.Lock()
+            # bytes sent, received on the wire and decoded, per route
+            self.transfer = {}
+            self.transferlock = threading.Lock()
             log.debug("SDApi initialising")
         except Exception as e:
             errorNotify(sys.exc_info()[2], e)
@@ -96,6 +185,8 @@ class SDApi:
             jresp = None
             try:
                 res.raise_for_status()
+                if getattr(res, "streamed", False):
+                    return self.streamJson(res)
                 jresp = res.json()
             except Exception as e:
                 log.error(
@@ -112,50 +203,195 @@ class SDApi:
         """Set the "token" header, call the api then remove the header."""
 
         def callFunc(*args, **kwargs):
-            if not self.token or self.tokenexpires < time.time():
-                self.apiToken()
-            self.headers["token"] = self.token
+            with self.tokenlock:
+                if not self.token or self.tokenexpires < time.time():
+                    self.apiToken()
+            self.tls.token = self.token
 
             @self.apiNoToken
             def callAPI():
                 return func(*args, **kwargs)
 
-            jresp = callAPI()
-            del self.headers["token"]
+            try:
+                jresp = callAPI()
+            finally:
+                self.tls.token = None
             return jresp
 
         return callFunc
 
-    def apiPost(self, route, postdict):
+    def makeSession(self):
+        """Create the pooled requests Session that all API calls share."""
+        try:
+            session = requests.Session()
+            adaptor = HTTPAdapter(
+                pool_connections=self.poolsize, pool_maxsize=self.poolsize
+            )
+            session.mount("https://", adaptor)
+            session.mount("http://", adaptor)
+            if not self.keepalive:
+                session.headers["Connection"] = "close"
+            return session
+        except Exception as e:
+            errorNotify(sys.exc_info()[2], e)
+
+    def close(self):
+        """Close the pooled connections to the SD API."""
+        try:
+            self.session.close()
+        except Exception as e:
+            errorNotify(sys.exc_info()[2], e)
+
+    def apiRequest(self, method, route, **kwargs):
+        """Send a request to the SD API over the shared session.
+
+        Failures that may be transient are retried as self.retry allows,
+        each attempt waits its turn with the rate limiter. A streamed
+        response to an idempotent request can be sent again by streamJson.
+        """
+        url = f"{self.url}/{route}"
+        headers = dict(self.headers)
+        token = getattr(self.tls, "token", None)
+        if token:
+            headers["token"] = token
+        log.debug(f"{method} request to {url}, headers: {headers}, {kwargs}")
+        res = self.sendRequest(method, route, url, headers, kwargs)
+        if res.streamed and self.retry.idempotent(method, route):
+            # the token header is kept, the stream may be read after
+            # apiTokenRequired has cleared it
+            res.resend = lambda: self.sendRequest(method, route, url, headers, kwargs)
+        return res
+
+    def sendRequest(self, method, route, url, headers, kwargs):
+        """Sends the request until it succeeds or may not be retried."""
+        attempt = 0
+        while True:
+            if self.limiter is not None:
+                self.limiter.acquire()
+            try:
+                res = self.session.request(
+                    method, url, headers=headers, timeout=self.timeout, **kwargs
+                )
+            except Exception as e:
+                if not self.retryAttempt(method, route, attempt, exc=e):
+                    raise
+                attempt += 1
+                continue
+            res.streamed = kwargs.get("stream", False)
+            res.route = routeName(route)
+            sent = len((kwargs.get("data") or "").encode())
+            if res.streamed:
+                self.countTransfer(res.route, sent, 0, 0)
+            else:
+                self.countTransfer(res.route, sent, res.raw.tell(), len(res.content))
+            if res.ok or not self.retryAttempt(method, route, attempt, res=res):
+                return res
+            res.close()
+            attempt += 1
+
+    def retryAttempt(self, method, route, attempt, res=None, exc=None):
+        """Waits before the next attempt and returns True if the failed
+        attempt should be retried."""
+        if attempt + 1 >= self.retry.maxattempts:
+            return False
+        if not self.retry.retryable(method, route, res=res, exc=exc):
+            return False
+        wait = self.retry.delay(attempt, res=res)
+        why = type(exc).__name__ if exc is not None else res.status_code
+        log.warning(
+            f"{method} {route}: attempt {attempt + 1} failed ({why}), retrying in {wait:.2f}s"
+        )
+        with self.transferlock:
+            self.retried += 1
+        time.sleep(wait)
+        return True
+
+    def streamJson(self, res, chunksize=65536):
+        """Yields each element of the JSON array in the response body as it
+        is read, the connection is released when the body is exhausted.
+
+        If the connection drops part way through the body of a request that
+        can be resent, it is sent again as self.retry allows and the
+        elements already yielded are skipped.
+        """
+        resend = getattr(res, "resend", None)
+        done = 0
+        attempt = 0
+        while True:
+            decoded = 0
+
+            def counted(xchunks):
+                nonlocal decoded
+                for chunk in xchunks:
+                    decoded += len(chunk)
+                    yield chunk
+
+            try:
+                xchunks = counted(res.iter_content(chunk_size=chunksize))
+                for cn, item in enumerate(iterJsonArray(xchunks)):
+                    if cn >= done:
+                        done += 1
+                        yield item
+                return
+            except Exception as e:
+                method = res.request.method
+                if resend is None or not self.retryAttempt(
+                    method, res.route, attempt, exc=e
+                ):
+                    raise
+            finally:
+                self.countTransfer(res.route, 0, res.raw.tell(), decoded, requests=0)
+                res.close()
+            attempt += 1
+            res = resend()
+            res.raise_for_status()
+
+    def countTransfer(self, route, sent, wire, decoded, requests=1):
+        """Add to the transfer counters for route."""
+        with self.transferlock:
+            stats = self.transfer.setdefault(
+                route, {"requests": 0, "sent": 0, "wire": 0, "decoded": 0}
+            )
+            stats["requests"] += requests
+            stats["sent"] += sent
+            stats["wire"] += wire
+            stats["decoded"] += decoded
+
+    def transferSummary(self):
+        """Log the bytes transferred per route, returns the totals."""
+        try:
+            totals = {"requests": 0, "sent": 0, "wire": 0, "decoded": 0}
+            with self.transferlock:
+                for route in sorted(self.transfer):
+                    stats = self.transfer[route]
+                    for key in totals:
+                        totals[key] += stats[key]
+                    log.info(f"SD transfer: {route}: {transferString(stats)}")
+            log.info(f"SD transfer: total: {transferString(totals)}")
+            return totals
+        except Exception as e:
+            errorNotify(sys.exc_info()[2], e)
+
+    def apiPost(self, route, postdict, stream=False):
         """Post data to the SD API."""
         try:
-            url = f"{self.url}/{route}"
-            log.debug(
-                f"POST request to {url}, headers: {self.headers}, params: {postdict}"
+            return self.apiRequest(
+                "POST", route, data=json.dumps(postdict), stream=stream
             )
-            return requests.post(url, headers=self.headers, data=json.dumps(postdict))
         except Exception as e:
             errorNotify(sys.exc_info()[2], e)
 
     def apiGet(self, route, querydict={}):
         """Get data from the SD API."""
         try:
-            url = f"{self.url}/{route}"
-            log.debug(
-                f"GET request to {url}, headers: {self.headers}, params: {querydict}"
-            )
-            return requests.get(url, headers=self.headers, params=querydict)
+            return self.apiRequest("GET", route, params=querydict)
         except Exception as e:
             errorNotify(sys.exc_info()[2], e)
 
     def apiPut(self, route, querydict={}):
         """Put data to the SD API."""
         try:
-            url = f"{self.url}/{route}"
-            log.debug(
-                f"PUT request to {url}, headers: {self.headers}, params: {querydict}"
-            )
-            return requests.put(url, headers=self.headers, params=querydict)
+            return self.apiRequest("PUT", route, params=querydict)
         except Exception as e:
             errorNotify(sys.exc_info()[2], e)
 
@@ -261,7 +497,12 @@ class SDApi:
             def sdgetlineup():
                 return self.apiGet(f"lineups/{lineupcode}")
 
-            return sdgetlineup()
+            lineup = sdgetlineup()
+            if self.cache is not None:
+                # lineups have no md5 of their own, address them by content
+                xjson = json.dumps(lineup, sort_keys=True).encode()
+                self.cache.put("lineups", hashlib.md5(xjson).hexdigest(), lineup)
+            return lineup
         except Exception as e:
             errorNotify(sys.exc_info()[2], e)
 
@@ -327,7 +568,7 @@ class SDApi:
 
             @self.apiTokenRequired
             def sdgetschedules():
-                return self.apiPost("schedules", chans)
+                return self.apiPost("schedules", chans, stream=self.stream)
 
             return sdgetschedules()
         except Exception as e:
@@ -338,12 +579,134 @@ class SDApi:
 
             @self.apiTokenRequired
             def sdgetprograms():
-                return self.apiPost("programs", progids)
+                return self.apiPost("programs", progids, stream=self.stream)
 
             return sdgetprograms()
         except Exception as e:
             errorNotify(sys.exc_info()[2], e)
 
+    def batchRequest(self, getfunc, items, chunksize):
+        """Split items into chunks and request them concurrently.
+
+        Yields the response for each chunk as soon as it arrives, which
+        is not necessarily the order that the chunks were sent in. No more
+        than self.workers chunks are in flight, or waiting to be consumed,
+        at once.
+        """
+        try:
+            workers = max(1, min(self.workers, self.poolsize))
+            todo = chunks(items, chunksize)
+            with ThreadPoolExecutor(max_workers=workers) as ex:
+                pending = set()
+                try:
+                    while True:
+                        for xl in islice(todo, workers - len(pending)):
+                            pending.add(ex.submit(getfunc, xl))
+                        if len(pending) == 0:
+                            break
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for fut in done:
+                            res = fut.result()
+                            if res is None:
+                                log.warning(f"{getfunc.__name__}: chunk request failed")
+                                continue
+                            yield res
+                finally:
+                    [fut.cancel() for fut in pending]
+        except Exception as e:
+            errorNotify(sys.exc_info()[2], e)
+
+    def programBatches(self, progids, chunksize=500, md5s=None):
+        """Retrieve programs in server-legal chunks, yielding each list of programs.
+
+        md5s: {programid: md5}: programs already in the cache with these
+              md5s are taken from there rather than downloaded
+        """
+        chunksize = max(1, min(chunksize, MAXPROGRAMS))
+        if self.cache is not None and md5s:
+            hits = []
+            fetch = []
+            for progid in progids:
+                md5 = md5s.get(progid)
+                if self.isCached("programs", md5):
+                    hits.append((progid, md5))
+                else:
+                    fetch.append(progid)
+            # programs whose cache entry cannot be read are downloaded instead
+            yield from self.cacheBatches("programs", hits, chunksize, fetch)
+            progids = fetch
+        for batch in self.batchRequest(self.getPrograms, progids, chunksize):
+            yield self.toCache("programs", batch, lambda x: x.get("md5"))
+
+    def scheduleBatches(self, chans, chunksize=100, md5s=None):
+        """Retrieve schedules in server-legal chunks, yielding each list of schedules.
+
+        chans is the list of dictionaries described in getSchedules.
+        md5s: {(stationID, date): md5}: schedules already in the cache with
+              these md5s are taken from there rather than downloaded
+        """
+        chunksize = max(1, min(chunksize, MAXSTATIONS))
+        if self.cache is not None and md5s:
+            hits = []
+            fetch = []
+            for chan in chans:
+                dates = []
+                for xdate in chan["date"]:
+                    md5 = md5s.get((chan["stationID"], xdate))
+                    if self.isCached("schedules", md5):
+                        hits.append(((chan["stationID"], xdate), md5))
+                    else:
+                        dates.append(xdate)
+                if len(dates) > 0:
+                    fetch.append({"stationID": chan["stationID"], "date": dates})
+            missed = []
+            yield from self.cacheBatches("schedules", hits, chunksize, missed)
+            for stationid, xdate in missed:
+                fetch.append({"stationID": stationid, "date": [xdate]})
+            chans = fetch
+        for batch in self.batchRequest(self.getSchedules, chans, chunksize):
+            yield self.toCache(
+                "schedules", batch, lambda x: x.get("metadata", {}).get("md5")
+            )
+
+    def isCached(self, kind, md5):
+        return md5 is not None and self.cache.has(kind, md5)
+
+    def cacheBatches(self, kind, hits, chunksize, missed):
+        """Yields lists of up to chunksize objects read from the cache.
+
+        hits: [(key, md5)], the key of each object that cannot be read from
+              the cache is appended to missed so it can be downloaded instead
+        """
+        if len(hits) > 0:
+            log.info(f"SD cache: {len(hits)} {kind} found in the cache")
+        unread = 0
+        for xl in chunks(hits, chunksize):
+            batch = []
+            for key, md5 in xl:
+                obj = self.cache.get(kind, md5)
+                if obj is None:
+                    missed.append(key)
+                    unread += 1
+                else:
+                    batch.append(obj)
+            yield batch
+        if unread > 0:
+            log.warning(f"SD cache: {unread} {kind} could not be read, fetching them")
+
+    def toCache(self, kind, batch, md5func):
+        """Stores each object in the cache as it is passed on."""
+        if self.cache is None:
+            return batch
+        return self.cachePassThrough(kind, batch, md5func)
+
+    def cachePassThrough(self, kind, batch, md5func):
+        for item in batch:
+            md5 = md5func(item)
+            if md5 is not None:
+                self.cache.put(kind, md5, item)
+            yield item
+
     def showResponse(self, jresp, force=False):
         """Pretty print json responses."""
         try:
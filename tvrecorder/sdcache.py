@@ -0,0 +1,139 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Content addressed cache of Schedules Direct responses for tvrecorder.
+
+Programs and schedules are versioned by their md5, so once downloaded
+an object never needs downloading again. Objects are stored gzipped,
+one file per md5, under a directory per kind ("programs", "schedules").
+The least recently used files are evicted when the cache grows past
+maxsize.
+"""
+import gzip
+import json
+import os
+from pathlib import Path
+import sys
+import threading
+
+from ccaerrors import errorNotify
+import ccalogging
+
+log = ccalogging.log
+
+
+class SDCache:
+    def __init__(self, cachedir="~/.cache/tvrecorder/sd", maxsize=1024 * 1024 * 1024):
+        """Initialise the cache.
+
+        Args:
+            cachedir: str: directory to keep the cache in
+            maxsize: int: bytes to keep on disk before evicting, default: 1GB
+        """
+        try:
+            self.cachedir = Path(os.path.expanduser(cachedir))
+            self.cachedir.mkdir(parents=True, exist_ok=True)
+            self.maxsize = maxsize
+            self.size = None
+            self.lock = threading.Lock()
+            self.hits = 0
+            self.misses = 0
+        except Exception as e:
+            errorNotify(sys.exc_info()[2], e)
+
+    def path(self, kind, md5):
+        return self.cachedir.joinpath(kind, md5[:2], f"{md5}.json.gz")
+
+    def has(self, kind, md5):
+        return self.path(kind, md5).exists()
+
+    def get(self, kind, md5):
+        """Returns the cached object, or None."""
+        try:
+            fn = self.path(kind, md5)
+            try:
+                with gzip.open(fn, "rb") as ifn:
+                    obj = json.loads(ifn.read())
+            except FileNotFoundError:
+                with self.lock:
+                    self.misses += 1
+                return None
+            # the modification time marks when the file was last used
+            os.utime(fn)
+            with self.lock:
+                self.hits += 1
+            return obj
+        except Exception as e:
+            errorNotify(sys.exc_info()[2], e)
+
+    def put(self, kind, md5, obj):
+        """Stores obj under its md5, evicting old objects if need be."""
+        try:
+            fn = self.path(kind, md5)
+            if fn.exists():
+                os.utime(fn)
+                return
+            fn.parent.mkdir(parents=True, exist_ok=True)
+            tmp = fn.with_name(f"{fn.name}.{threading.get_ident()}.tmp")
+            tmp.write_bytes(gzip.compress(json.dumps(obj).encode(), compresslevel=6))
+            os.replace(tmp, fn)
+            with self.lock:
+                if self.size is None:
+                    self.size = self.diskSize()
+                else:
+                    self.size += fn.stat().st_size
+                if self.size > self.maxsize:
+                    self.evict()
+        except Exception as e:
+            errorNotify(sys.exc_info()[2], e)
+
+    def files(self):
+        return self.cachedir.glob("*/*/*.json.gz")
+
+    def diskSize(self):
+        return sum(fn.stat().st_size for fn in self.files())
+
+    def evict(self, target=0.9):
+        """Deletes the least recently used files until the cache is below
+        target * maxsize, must be called holding self.lock."""
+        try:
+            xfiles = []
+            for fn in self.files():
+                st = fn.stat()
+                xfiles.append((st.st_mtime, st.st_size, fn))
+            xfiles.sort()
+            self.size = sum(x[1] for x in xfiles)
+            evicted = 0
+            for _, size, fn in xfiles:
+                if self.size <= self.maxsize * target:
+                    break
+                fn.unlink(missing_ok=True)
+                self.size -= size
+                evicted += 1
+            log.info(f"SD cache: evicted {evicted} files, {self.size} bytes in use")
+        except Exception as e:
+            errorNotify(sys.exc_info()[2], e)
+
+    def items(self, kind):
+        """Yields every cached object of kind."""
+        try:
+            for fn in self.cachedir.glob(f"{kind}/*/*.json.gz"):
+                with gzip.open(fn, "rb") as ifn:
+                    yield json.loads(ifn.read())
+        except Exception as e:
+            errorNotify(sys.exc_info()[2], e)
@@ -0,0 +1,114 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Programme JSON to table rows for tvrecorder.
+
+These are pure functions of the SD programme dicts, they touch neither the
+database nor the log, so can be run in worker processes. Rows are plain
+tuples in the column order given by PROGRAMCOLS, PERSONCOLS and
+PERSONMAPCOLS.
+
+see
+https://github.com/SchedulesDirect/JSON-Service/wiki/API-20141201#download-program-information
+"""
+
+PROGRAMCOLS = (
+    "programid",
+    "md5",
+    "title",
+    "originalairdate",
+    "episodetitle",
+    "shortdesc",
+    "longdesc",
+    "series",
+    "episode",
+)
+PERSONCOLS = ("personid", "name", "nameid")
+PERSONMAPCOLS = ("personid", "programid", "role", "billingorder")
+
+
+def extractString(xlist, key):
+    """Returns the value of key from the first dict in xlist that has it."""
+    for item in xlist:
+        if key in item:
+            return item[key]
+    return None
+
+
+def extractSeries(mdata):
+    """Returns the (series, episode) numbers from a programme's metadata."""
+    series = episode = 0
+    for item in mdata:
+        if "Gracenote" in item:
+            series = int(item["Gracenote"].get("season", 0))
+            episode = int(item["Gracenote"].get("episode", 0))
+    return (series, episode)
+
+
+def programRow(prog):
+    """Returns the Program row for one programme."""
+    descs = prog.get("descriptions", {})
+    shortdesc = longdesc = None
+    if "description100" in descs:
+        shortdesc = extractString(descs["description100"], "description")
+    if "description1000" in descs:
+        longdesc = extractString(descs["description1000"], "description")
+    series = episode = None
+    if "metadata" in prog:
+        series, episode = extractSeries(prog["metadata"])
+    return (
+        prog["programID"],
+        prog["md5"],
+        extractString(prog["titles"], "title120"),
+        prog.get("originalAirDate"),
+        prog.get("episodeTitle150", ""),
+        shortdesc,
+        longdesc,
+        series,
+        episode,
+    )
+
+
+def creditRows(prog):
+    """Returns the Person and Personmap rows for a programme's cast and crew,
+    a person credited more than once is only mapped once."""
+    progid = prog["programID"]
+    persons = []
+    maps = {}
+    for person in prog.get("cast", []) + prog.get("crew", []):
+        personid = int(person["personId"])
+        persons.append((personid, person["name"], person["nameId"]))
+        if personid not in maps:
+            role = person.get("role", "")
+            maps[personid] = (personid, progid, role, person.get("billingorder", "0"))
+    return persons, list(maps.values())
+
+
+def transformPrograms(progs):
+    """Returns a tuple of the Program, Person and Personmap rows for a list
+    of programmes, each person is only listed once."""
+    programs = []
+    persons = {}
+    maps = []
+    for prog in progs:
+        programs.append(programRow(prog))
+        xpersons, xmaps = creditRows(prog)
+        for row in xpersons:
+            persons.setdefault(row[0], row)
+        maps.extend(xmaps)
+    return programs, list(persons.values()), maps
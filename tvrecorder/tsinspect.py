@@ -0,0 +1,239 @@
+#
+# Copyright (c) 2022, Chris Allison
+#
+#     This file is part of tvrecorder.
+#
+#     tvrecorder is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     tvrecorder is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Transport stream health check for tvrecorder.
+
+Scans a recording's 188 byte packets through a read only memory map and
+counts, per PID, the packets, the continuity counter errors and the gaps
+between PCRs. A summary is written next to the recording, foo.ts gets
+foo.health.json.
+
+The packet header bytes are pulled out of each window of the map with
+strided slices, which copy in C, so the per packet work left to Python
+is a dictionary lookup or two.
+"""
+import argparse
+from array import array
+from collections import Counter
+import json
+import mmap
+import os
+from pathlib import Path
+import sys
+import time
+
+from ccaerrors import errorNotify
+import ccalogging
+
+from tvrecorder.mpegts import (
+    NULLPID,
+    PACKETSIZE,
+    SYNCBYTE,
+    ContinuityCounter,
+    findSync,
+)
+
+log = ccalogging.log
+
+# PCRs are 33 bit 90kHz bases times 300 plus a 9 bit 27MHz extension
+PCRWRAP = (1 << 33) * 300
+PCRHZ = 27_000_000
+
+# byte 1 of the header to the top five bits of the PID
+PIDHIGH = bytes(x & 0x1F for x in range(256))
+# byte 1 to 1 if the transport error indicator is set
+TEIFLAG = bytes(x >> 7 for x in range(256))
+
+
+def healthPath(path):
+    path = Path(path)
+    return path.with_name(f"{path.stem}.health.json")
+
+
+class TSInspector:
+    def __init__(self, maxpcrgap=0.1, window=32 * 1024 * 1024):
+        """Set up an inspection.
+
+        Args:
+            maxpcrgap: float: seconds between PCRs, on a PID, that count
+                       as a gap, the standard allows 0.1
+            window: int: bytes of the map to scan at a time
+        """
+        self.maxpcrgap = int(maxpcrgap * PCRHZ)
+        self.window = max(1, window // PACKETSIZE) * PACKETSIZE
+        self.pids = Counter()
+        # the capture path counts with a ContinuityCounter too, so the two
+        # agree on what is an error
+        self.cc = ContinuityCounter()
+        self.ccerrors = Counter()
+        self.transporterrors = 0
+        self.resyncs = 0
+        self.skipped = 0
+        self.packets = 0
+        self.pcrgaps = Counter()
+        self.maxgap = 0
+        self.firstpcr = {}
+        self.lastpcr = {}
+
+    def scan(self, mm, start, end):
+        """Scans the whole packets in mm[start:end], which are all in
+        sync."""
+        n = (end - start) // PACKETSIZE
+        end = start + n * PACKETSIZE
+        b1 = mm[start + 1 : end : PACKETSIZE]
+        b3 = mm[start + 3 : end : PACKETSIZE]
+        self.transporterrors += b1.translate(TEIFLAG).count(1)
+        # two byte big endian PIDs, unpacked in C
+        pidbytes = bytearray(2 * n)
+        pidbytes[0::2] = b1.translate(PIDHIGH)
+        pidbytes[1::2] = mm[start + 2 : end : PACKETSIZE]
+        pids = array("H")
+        pids.frombytes(pidbytes)
+        if sys.byteorder == "little":
+            pids.byteswap()
+        self.pids.update(pids)
+        self.packets += n
+        count = self.cc.count
+        off = start
+        for pid, tei, flags in zip(pids, b1, b3):
+            flagged = flags & 0x20 and self.adaptation(mm, off, pid)
+            # the packets ContinuityCounter.check leaves out
+            if flags & 0x10 and pid != NULLPID and not tei & 0x80:
+                if count(pid, flags & 0x0F, flagged):
+                    self.ccerrors[pid] += 1
+            off += PACKETSIZE
+
+    def adaptation(self, mm, off, pid):
+        """Reads the PCR, if any, from the adaptation field of the packet at
+        off, returns True if it has the discontinuity indicator set."""
+        if mm[off + 4] == 0:
+            return False
+        flags = mm[off + 5]
+        if flags & 0x80:
+            # discontinuity indicator, the PCRs start again
+            self.lastpcr.pop(pid, None)
+        if flags & 0x10 and mm[off + 4] >= 7:
+            raw = int.from_bytes(mm[off + 6 : off + 12], "big")
+            pcr = (raw >> 15) * 300 + (raw & 0x1FF)
+            self.firstpcr.setdefault(pid, pcr)
+            last = self.lastpcr.get(pid)
+            if last is not None:
+                gap = (pcr - last) % PCRWRAP
+                self.maxgap = max(self.maxgap, gap)
+                if gap > self.maxpcrgap:
+                    self.pcrgaps[pid] += 1
+            self.lastpcr[pid] = pcr
+        return bool(flags & 0x80)
+
+    def resync(self, mm, off, size):
+        """Returns the offset of the next packet in sync at or after off,
+        one whose sync byte is followed by another a packet later."""
+        return findSync(mm, off, size)
+
+    def inspect(self, path):
+        """Scans the file at path, returns the summary."""
+        started = time.perf_counter()
+        size = os.path.getsize(path)
+        if size >= PACKETSIZE:
+            with open(path, "rb") as xfile:
+                with mmap.mmap(xfile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    if hasattr(mm, "madvise"):
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
+                    self.walk(mm, size)
+        return self.summary(path, size, time.perf_counter() - started)
+
+    def walk(self, mm, size):
+        off = self.resync(mm, 0, size)
+        self.skipped += off
+        while off + PACKETSIZE <= size:
+            end = min(size, off + self.window)
+            end -= (end - off) % PACKETSIZE
+            syncs = mm[off:end:PACKETSIZE]
+            if syncs.count(SYNCBYTE) == len(syncs):
+                self.scan(mm, off, end)
+                off = end
+                continue
+            # scan up to the packet that lost sync, then find it again
+            bad = next(i for i, x in enumerate(syncs) if x != SYNCBYTE)
+            self.scan(mm, off, off + bad * PACKETSIZE)
+            lost = off + bad * PACKETSIZE
+            off = self.resync(mm, lost, size)
+            self.resyncs += 1
+            self.skipped += off - lost
+        self.skipped += size - off if off < size else 0
+
+    def summary(self, path, size, secs):
+        duration = 0
+        for pid, first in self.firstpcr.items():
+            duration = max(duration, ((self.lastpcr.get(pid, first) - first) % PCRWRAP))
+        errors = sum(self.ccerrors.values())
+        gaps = sum(self.pcrgaps.values())
+        return {
+            "file": str(path),
+            "bytes": size,
+            "packets": self.packets,
+            "duration": round(duration / PCRHZ, 3),
+            "pids": {str(pid): n for pid, n in sorted(self.pids.items())},
+            "ccerrors": errors,
+            "ccerrorpids": {str(pid): n for pid, n in sorted(self.ccerrors.items())},
+            "lost": self.cc.lost,
+            "transporterrors": self.transporterrors,
+            "resyncs": self.resyncs,
+            "skipped": self.skipped,
+            "pcrgaps": gaps,
+            "maxpcrgap": round(self.maxgap / PCRHZ, 3),
+            "healthy": errors == 0
+            and gaps == 0
+            and self.transporterrors == 0
+            and self.resyncs == 0,
+            "seconds": round(secs, 3),
+            "mbps": round(size / secs / 1e6, 1) if secs > 0 else 0,
+        }
+
+
+def inspectRecording(path, write=True, **kwargs):
+    """Inspects the recording at path and writes the summary next to it,
+    returns the summary, or None if it could not be read."""
+    try:
+        summary = TSInspector(**kwargs).inspect(path)
+        if write:
+            with open(healthPath(path), "w") as xfile:
+                json.dump(summary, xfile, indent=2)
+        state = "healthy" if summary["healthy"] else "damaged"
+        log.info(
+            f"{path} is {state}: {summary['ccerrors']} continuity errors, "
+            f"{summary['pcrgaps']} PCR gaps, {summary['resyncs']} lost syncs"
+        )
+        return summary
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="check recordings are intact")
+    parser.add_argument("-n", "--no-write", action="store_true")
+    parser.add_argument("paths", nargs="+")
+    args = parser.parse_args()
+    for path in args.paths:
+        summary = inspectRecording(path, write=not args.no_write)
+        if summary is not None:
+            print(json.dumps(summary))
+
+
+if __name__ == "__main__":
+    main()
@@ -18,6 +18,7 @@
 #
 """recorder module for tvrecorder."""
 from datetime import datetime
+import os
 from pathlib import Path
 import subprocess
 import sys
@@ -26,6 +27,8 @@ from ccaerrors import errorNotify
 
 from tvrecorder.strings import cleanString
 
+ZAPCONF = os.path.expanduser("~/.tzap/dvb_channel.conf")
+
 
 def dtToTs(sdate):
     """Convert a date/time string into a timestamp
@@ -71,6 +74,21 @@ def recordProgram(
         errorNotify(sys.exc_info()[2], e)
 
 
+def recordingPath(title, channel, start, basedir):
+    """Returns the Path of the file to record title to, making its
+    directory."""
+    try:
+        then = datetime.fromtimestamp(start)
+        schan = cleanString(channel)
+        stitle = cleanString(title)
+        rdir = Path(f"{basedir}/{stitle}")
+        rdir.mkdir(parents=True, exist_ok=True)
+        tstamp = then.strftime("%Y%m%dT%H%M")
+        return Path(f"{basedir}/{stitle}/{tstamp}-{schan}-{stitle}.ts")
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+
+
 def buildRecordCommand(
     title,
     channel="BBC TWO",
@@ -90,17 +108,11 @@ def buildRecordCommand(
     returns: the command list as required by subprocess.run()
     """
     try:
-        then = datetime.fromtimestamp(start)
-        schan = cleanString(channel)
-        stitle = cleanString(title)
-        rdir = Path(f"{basedir}/{stitle}")
-        rdir.mkdir(parents=True, exist_ok=True)
-        tstamp = then.strftime("%Y%m%dT%H%M")
-        fqfn = Path(f"{basedir}/{stitle}/{tstamp}-{schan}-{stitle}.ts")
+        fqfn = recordingPath(title, channel, start, basedir)
         # length = int(end - start)
         # padding = 120 + 900
         # actualstart = start - 120
-        cmd = f"dvbv5-zap -c /home/chris/.tzap/dvb_channel.conf -a {adaptor} -p -r "
+        cmd = f"dvbv5-zap -c {ZAPCONF} -a {adaptor} -p -r "
         cmd += f"-t {int(length)}"
         lcmd = cmd.split(" ")
         lcmd.append("-o")
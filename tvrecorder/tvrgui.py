@@ -21,7 +21,7 @@ import sys
 from ccaerrors import errorNotify
 
 from tvrecorder.config import Configuration
-from tvrecorder.db import makeDBEngine
+from tvrecorder.db import getEngine
 from tvrecorder.windows import chanWindow, mainWindow
 from tvrecorder.wrangler import whatsOnNow
 
@@ -33,7 +33,7 @@ def begin():
         # debug = True
         debug = False
         cf = Configuration(appname=appname)
-        eng = makeDBEngine(cf, echo=debug)
+        eng = getEngine(cf, echo=debug)
         # chanWindow(eng)
         # scheds = whatsOnNow(eng)
         # print(f"{scheds=}")
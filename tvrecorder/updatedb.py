@@ -26,9 +26,17 @@ import ccalogging
 from tvrecorder import __version__, __appname__
 from tvrecorder.credential import getSDCreds
 from tvrecorder.config import Configuration
-from tvrecorder.db import makeDBEngine
+from tvrecorder.db import createTables, getEngine
 from tvrecorder.sdapi import SDApi
-from tvrecorder.wrangler import updateChannels, schedules
+from tvrecorder.sdcache import SDCache
+from tvrecorder.wrangler import (
+    finishRun,
+    rebuildFromCache,
+    runProgress,
+    schedules,
+    startRun,
+    updateChannels,
+)
 
 home = os.path.expanduser("~/")
 logd = os.path.join(home, "log")
@@ -51,10 +59,26 @@ def linupRefresh(sd, cf, eng, force=False):
         errorNotify(sys.exc_info()[2], e)
 
 
+def makeCache(cf):
+    """Returns the SDCache described by the configuration, or None.
+
+    settings: sdcache: keep downloaded programs and schedules, default True
+              sdcachedir: where to keep them
+              sdcachesize: MB to keep before evicting, default 1024
+    """
+    try:
+        if not cf.get("sdcache", True):
+            return None
+        cachedir = cf.get("sdcachedir", "~/.cache/tvrecorder/sd")
+        return SDCache(cachedir, maxsize=int(cf.get("sdcachesize", 1024)) * 1024 * 1024)
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+
+
 def begin(appname, debug=False):
     try:
         cf = Configuration(appname=appname)
-        mysqleng = makeDBEngine(cf, echo=debug)
+        mysqleng = getEngine(cf, echo=debug)
         uname, pword, token, tokenexpires = getSDCreds(cf)
         if tokenexpires is None:
             tokenexpires = 0
@@ -65,6 +89,17 @@ def begin(appname, debug=False):
             "token": token,
             "tokenexpires": tokenexpires,
             "debug": debug,
+            "poolsize": cf.get("sdpoolsize", 10),
+            "keepalive": cf.get("sdkeepalive", True),
+            "timeout": tuple(cf.get("sdtimeout", [10, 120])),
+            "workers": cf.get("sdworkers", 4),
+            "stream": cf.get("sdstream", False),
+            "cache": makeCache(cf),
+            "retries": cf.get("sdretries", 5),
+            "backoff": cf.get("sdbackoff", 0.5),
+            "maxbackoff": cf.get("sdmaxbackoff", 30),
+            "rate": cf.get("sdrate", 0),
+            "burst": cf.get("sdburst", 10),
         }
         sd = SDApi(**kwargs)
         sd.apiOnline()
@@ -80,6 +115,25 @@ def close(cf, sd):
         cf.set("token", sd.token)
         cf.set("tokenexpires", sd.tokenexpires)
         cf.writeConfig()
+        sd.close()
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+
+
+def fromCache(debug=False):
+    """Rebuilds the database from the SD cache, offline."""
+    try:
+        cf = Configuration(appname=__appname__)
+        eng = getEngine(cf, echo=debug)
+        createTables(eng)
+        sd = SDApi(appname=__appname__, debug=debug, cache=makeCache(cf))
+        kwargs = {
+            "bulk": cf.get("bulkschedule", True),
+            "retention": cf.get("retentiondays", 7),
+        }
+        nscheds, nprogs = rebuildFromCache(sd, eng, **kwargs)
+        log.info(f"Rebuilt {nscheds} schedules and {nprogs} programs from the cache")
+        sd.close()
     except Exception as e:
         errorNotify(sys.exc_info()[2], e)
 
@@ -87,10 +141,29 @@ def close(cf, sd):
 def updatedb():
     try:
         debug = False
+        if "--from-cache" in sys.argv[1:]:
+            fromCache(debug=debug)
+            return
         cf, sd, mysqleng = begin(__appname__, debug=debug)
+        createTables(mysqleng)
+        runid, resumed = startRun(mysqleng)
+        if resumed:
+            log.info(f"Resuming update run {runid}: {runProgress(mysqleng, runid)}")
         linupRefresh(sd, cf, mysqleng)
-        schedules(sd, mysqleng)
+        kwargs = {
+            "bulk": cf.get("bulkschedule", True),
+            "retention": cf.get("retentiondays", 7),
+            "runid": runid,
+            "threaded": cf.get("pipeline", True),
+            "workers": cf.get("transformworkers", 0),
+        }
+        if schedules(sd, mysqleng, **kwargs):
+            finishRun(mysqleng, runid)
+        else:
+            log.warning(f"Update run {runid} is incomplete, it will be resumed")
+        sd.transferSummary()
         close(cf, sd)
+        log.info(f"DB pool: {mysqleng.poolstats.summary()}")
     except Exception as e:
         errorNotify(sys.exc_info()[2], e)
 
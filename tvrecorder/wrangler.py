@@ -17,43 +17,81 @@
 #     along with tvrecorder.  If not, see <http://www.gnu.org/licenses/>.
 #
 """Data wrangler module for tvrecorder."""
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import sys
 import time
 
-from ccaerrors import errorNotify, errorExit
+from ccaerrors import errorNotify, errorExit, errorRaise
 import ccalogging
+from sqlalchemy import and_, exists, func, insert
 from sqlalchemy.orm import Session
 
 from tvrecorder import searchZap, chooseName, chooseGetData
-from tvrecorder.models import Channel, Schedulemd5, Schedule, Person, Personmap, Program
+from tvrecorder.db import upsert
+from tvrecorder.intervals import IntervalIndex
+from tvrecorder.models import (
+    Channel,
+    Person,
+    Personmap,
+    Program,
+    Recording,
+    Runjournal,
+    Schedule,
+    Schedulemd5,
+    Updaterun,
+)
+from tvrecorder.pipeline import Pipeline
+from tvrecorder.sdapi import chunks
+from tvrecorder.transform import (
+    PERSONCOLS,
+    PERSONMAPCOLS,
+    PROGRAMCOLS,
+    transformPrograms,
+)
 
 log = ccalogging.log
 
+# the longest airing allowed for when looking for those on air in a span,
+# a lower bound on airdate lets the query range scan the airdate indexes
+MAXAIRING = 86400
 
-def addUpdateSMD5(sd, smd5, chanid, xdate, session):
+
+def onAir(start, end):
+    """The filter clauses for the Schedule rows on air in [start, end)."""
+    return (
+        Schedule.airdate < end,
+        Schedule.airdate > start - MAXAIRING,
+        (Schedule.airdate + Schedule.duration) > start,
+    )
+
+
+def makeSMD5(sd, smd5, chanid, xdate):
+    """Returns the Schedulemd5 row for one station/date as a dict."""
     try:
-        md5 = session.query(Schedulemd5).filter_by(md5=smd5["md5"]).first()
-        if md5:
-            return False
         sdate = f"{xdate}T00:00:00Z"
-        datets = sd.getTimeStamp(sdate)
-        kwargs = {
+        return {
             "md5": smd5["md5"],
             "stationid": chanid,
             "datestr": sdate,
-            "datets": datets,
+            "datets": sd.getTimeStamp(sdate),
             "modified": sd.getTimeStamp(smd5["lastModified"]),
         }
-        md5 = Schedulemd5(**kwargs)
-        session.add(md5)
-        return True
     except Exception as e:
-        # msg = f"{e}\n{smd5=}, {chanid=}, {xdate=}\n"
-        # msg += f"{kwargs=}"
         errorExit(sys.exc_info()[2], e)
 
 
-def schedulesMd5(sd, eng):
+def schedulesMd5(sd, eng, md5s=None, pending=None):
+    """Returns a map of stationid to the list of dates whose schedules have
+    changed.
+
+    The known md5s for the stations are loaded in one query, the new ones
+    are stored with one executemany insert. If md5s is a dict the md5 of
+    each changed schedule is added to it, keyed by (stationid, date).
+
+    If pending is a dict the new rows are not stored but added to it, keyed
+    by (stationid, date), for addSchedule to store with the schedule itself.
+    """
     try:
         retrieve = {}
         with Session(eng) as session, session.begin():
@@ -69,14 +107,32 @@ def schedulesMd5(sd, eng):
             # print([x.name for x in xsome])
             slist = [x.stationid for x in xsome]
             smd5 = sd.getScheduleMd5(slist)
+            known = {
+                (str(row.stationid), row.md5)
+                for row in session.query(Schedulemd5.stationid, Schedulemd5.md5).filter(
+                    Schedulemd5.stationid.in_(slist)
+                )
+            }
+            rows = []
             for chan in smd5:
                 log.debug(f"scheduleMd5: {chan=}")
                 for xdate in smd5[chan]:
                     log.debug(f"scheduleMd5: {xdate=}")
-                    if addUpdateSMD5(sd, smd5[chan][xdate], chan, xdate, session):
-                        if chan not in retrieve:
-                            retrieve[chan] = []
-                        retrieve[chan].append(xdate)
+                    if (str(chan), smd5[chan][xdate]["md5"]) in known:
+                        continue
+                    rows.append(makeSMD5(sd, smd5[chan][xdate], chan, xdate))
+                    known.add((str(chan), smd5[chan][xdate]["md5"]))
+                    if md5s is not None:
+                        md5s[(str(chan), xdate)] = smd5[chan][xdate]["md5"]
+                    if chan not in retrieve:
+                        retrieve[chan] = []
+                    retrieve[chan].append(xdate)
+            if pending is not None:
+                pending.update(
+                    {(row["stationid"], row["datestr"][:10]): row for row in rows}
+                )
+            elif len(rows) > 0:
+                session.execute(insert(Schedulemd5.__table__), rows)
         log.debug(f"sheduleMd5 returns: {retrieve=}")
         return retrieve
     except Exception as e:
@@ -99,63 +155,359 @@ def favourites(eng, favs=True):
         errorNotify(sys.exc_info()[2], e)
 
 
-def schedules(sd, eng):
+def schedules(sd, eng, bulk=True, retention=7, runid=None, threaded=True, workers=0):
+    """Downloads and stores the changed schedules and their programs.
+
+    Each schedule's md5 is only stored along with the schedule, so a day
+    is not marked current until its listings have landed. With a runid the
+    stored schedules and program batches are journalled, the programs of
+    schedules journalled by an earlier, interrupted, attempt at the run are
+    fetched as well.
+
+    The schedules and then the programs each go through a Pipeline, so
+    downloading, transforming and storing them overlap, threaded=False runs
+    each step in turn. workers > 0 transforms the programs to rows in that
+    many processes.
+
+    returns True if every scheduled program was stored
+    """
     try:
-        cleanSchedule(eng)
+        cleanSchedule(eng, days=retention)
         log.info("Retrieving schedule hashes")
-        xdat = schedulesMd5(sd, eng)
+        md5s = {}
+        pending = {}
+        xdat = schedulesMd5(sd, eng, md5s=md5s, pending=pending)
         log.info(f"require schedules for {len(xdat)} channels")
+        wanted = {}
         if len(xdat) > 0:
             chans = [
                 {"stationID": str(chanid), "date": xdat[chanid]} for chanid in xdat
             ]
-            scheds = sd.getSchedules(chans)
             log.info("Updating new schedules")
-            for sched in scheds:
-                addSchedule(sd, sched, eng)
+
+            def smd5(sched):
+                startdate = sched.get("metadata", {}).get("startDate")
+                return pending.get((str(sched["stationID"]), startdate))
+
+            def listed(sched):
+                # SD returns an error object, with no metadata or programs,
+                # for a schedule it cannot supply yet
+                if "programs" in sched and "startDate" in sched.get("metadata", {}):
+                    return True
+                log.warning(
+                    f"skipping schedule for {sched.get('stationID')}: {sched.get('response', sched.get('message', 'no listings'))}"
+                )
+                return False
+
+            def transform(sched):
+                return scheduleRows(sd, sched, smd5(sched))
+
+            def write(rows):
+                return storeSchedule(eng, rows, runid=runid)
+
+            def addOne(sched):
+                return addSchedule(
+                    sd, sched, eng, bulk=False, smd5=smd5(sched), runid=runid
+                )
+
+            source = (
+                x
+                for xl in sd.scheduleBatches(chans, md5s=md5s)
+                for x in xl
+                if listed(x)
+            )
+            stages = [("transform", transform), ("write", write)]
+            if not bulk:
+                stages = [("write", addOne)]
+            pipe = Pipeline(source, stages, name="schedules")
+            for xwanted in pipe.run(threaded=threaded):
+                wanted.update(xwanted)
+        if runid is not None:
+            wanted.update(runPrograms(eng, runid))
+        plist = missingPrograms(eng, wanted)
+        log.info(
+            f"require downloading of {len(plist)} of {len(wanted)} scheduled programs"
+        )
+        if len(plist) > 0:
+            kwargs = {
+                "md5s": wanted,
+                "runid": runid,
+                "threaded": threaded,
+                "workers": workers,
+            }
+            updatePrograms(sd, plist, eng, **kwargs)
+            plist = missingPrograms(eng, {x: wanted[x] for x in plist})
+            if len(plist) > 0:
+                log.warning(f"{len(plist)} scheduled programs were not stored")
+        return len(plist) == 0
     except Exception as e:
         errorNotify(sys.exc_info()[2], e)
 
 
-def removeOverlaps(chanid, start, duration, session):
+def startRun(eng, maxage=86400):
+    """Returns (runid, resumed), resuming the last run if it did not finish
+    and started less than maxage seconds ago."""
     try:
-        removed = False
-        end = start + duration
+        now = int(time.time())
+        with Session(eng) as session, session.begin():
+            last = session.query(Updaterun).order_by(Updaterun.runid.desc()).first()
+            if last is not None and last.finished is None:
+                if last.started > now - maxage:
+                    return last.runid, True
+                log.warning(f"abandoning update run {last.runid}, it is too old")
+                last.finished = 0
+            run = Updaterun(started=now)
+            session.add(run)
+            session.flush()
+            return run.runid, False
+    except Exception as e:
+        errorExit(sys.exc_info()[2], e)
+
+
+def finishRun(eng, runid):
+    try:
+        with Session(eng) as session, session.begin():
+            session.query(Updaterun).filter_by(runid=runid).update(
+                {"finished": int(time.time())}
+            )
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+
+
+def runProgress(eng, runid):
+    """Returns {kind: (entries, count)} of the run's journal."""
+    try:
+        with Session(eng) as session, session.begin():
+            rows = (
+                session.query(
+                    Runjournal.kind,
+                    func.count(),
+                    func.coalesce(func.sum(Runjournal.count), 0),
+                )
+                .filter(Runjournal.runid == runid)
+                .group_by(Runjournal.kind)
+                .all()
+            )
+        return {kind: (entries, count) for kind, entries, count in rows}
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+
+
+def journal(session, runid, kind, item, datets=0, count=0):
+    """Records, in the caller's transaction, that item has been stored."""
+    row = {
+        "runid": runid,
+        "kind": kind,
+        "item": str(item),
+        "datets": datets,
+        "count": count,
+        "doneat": int(time.time()),
+    }
+    upsert(session, Runjournal, [row])
+
+
+def runPrograms(eng, runid):
+    """Returns the {programid: md5} map of the programs that air in the
+    schedules journalled for the run."""
+    try:
+        with Session(eng) as session, session.begin():
+            rows = (
+                session.query(Schedule.programid, Schedule.md5)
+                .join(
+                    Runjournal,
+                    and_(
+                        Runjournal.item == Schedule.stationid,
+                        Schedule.airdate >= Runjournal.datets,
+                        Schedule.airdate < Runjournal.datets + 86400,
+                    ),
+                )
+                .filter(Runjournal.runid == runid, Runjournal.kind == "schedule")
+                .distinct()
+                .all()
+            )
+        return {row.programid: row.md5 for row in rows}
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+
+
+def rebuildFromCache(sd, eng, bulk=True, retention=7):
+    """Rebuilds the channels and listings from sd.cache without going online.
+
+    The newest cached lineup of each lineup and the newest cached schedule
+    for each station and day are stored, then their programs.
+
+    returns a tuple of the number of schedules and programs taken from the
+    cache
+    """
+    try:
+        if sd.cache is None:
+            raise Exception("rebuildFromCache: the SDApi object has no cache")
+        cleanSchedule(eng, days=retention)
+        lineups = {}
+        for lineup in sd.cache.items("lineups"):
+            meta = lineup.get("metadata", {})
+            key = meta.get("lineup")
+            if key not in lineups or meta.get("modified", "") > lineups[key][0]:
+                lineups[key] = (meta.get("modified", ""), lineup)
+        log.info(f"SD cache: rebuilding channels from {len(lineups)} lineups")
+        for _, lineup in lineups.values():
+            updateChannels(lineup, eng)
+        cutoff = int(time.time()) - (86400 * (retention + 1))
+        latest = {}
+        for sched in sd.cache.items("schedules"):
+            meta = sched.get("metadata", {})
+            key = (str(sched["stationID"]), meta.get("startDate"))
+            if sd.getTimeStamp(f"{key[1]}T00:00:00Z") < cutoff:
+                continue
+            if (
+                key not in latest
+                or meta["modified"] > latest[key]["metadata"]["modified"]
+            ):
+                latest[key] = sched
+        log.info(f"SD cache: rebuilding {len(latest)} schedules")
+        wanted = {}
+        for (chanid, xdate), sched in sorted(latest.items()):
+            smd5 = {
+                "md5": sched["metadata"]["md5"],
+                "lastModified": sched["metadata"]["modified"],
+            }
+            smd5 = makeSMD5(sd, smd5, chanid, xdate)
+            wanted.update(addSchedule(sd, sched, eng, bulk=bulk, smd5=smd5))
+        plist = missingPrograms(eng, wanted)
+        hits = [(x, wanted[x]) for x in plist if sd.isCached("programs", wanted[x])]
+        if len(hits) < len(plist):
+            log.warning(
+                f"SD cache: {len(plist) - len(hits)} scheduled programs are not cached"
+            )
+        missed = []
+        if len(hits) > 0:
+            storePrograms(sd.cacheBatches("programs", hits, 500, missed), eng)
+        return len(latest), len(hits) - len(missed)
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+
+
+def missingPrograms(eng, wanted, chunksize=5000):
+    """Returns the programids from the wanted {programid: md5} map that are not
+    already stored with that md5."""
+    try:
+        have = set()
+        with Session(eng) as session, session.begin():
+            for xids in chunks(list(wanted), chunksize):
+                rows = (
+                    session.query(Program.programid, Program.md5)
+                    .filter(Program.programid.in_(xids))
+                    .all()
+                )
+                have.update((row.programid, row.md5) for row in rows)
+        return [progid for progid, md5 in wanted.items() if (progid, md5) not in have]
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+
+
+def stationIndex(chanid, start, end, session):
+    """Loads the Schedule rows for chanid that overlap [start, end) into an
+    IntervalIndex in one query."""
+    try:
+        index = IntervalIndex()
         xs = (
             session.query(Schedule)
-            .filter(
-                Schedule.stationid == chanid,
-                (Schedule.airdate + Schedule.duration) > start,
-                Schedule.airdate < end,
-            )
+            .filter(Schedule.stationid == chanid, *onAir(start, end))
             .all()
         )
+        for x in xs:
+            index.add(x.airdate, x.duration, x)
+        return index
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+
+
+def removeOverlaps(index, start, duration, session):
+    try:
+        removed = False
+        xs = index.overlaps(start, start + duration)
         if len(xs) > 0:
             removed = True
-            [session.delete(x) for x in xs]
-            # db.session.commit()
+            for xstart, _, x in xs:
+                index.remove(xstart, x)
+                session.delete(x)
         return removed
     except Exception as e:
         errorNotify(sys.exc_info()[2], e)
 
 
-def cleanSchedule(eng):
+def cleanSchedule(eng, days=7, chunk=0):
+    """Deletes schedules that aired more than days ago, server side.
+
+    Programs, their person maps, and the schedule md5s that no remaining
+    schedule refers to are pruned as well.
+
+    chunk: int: if > 0 delete in airdate ranges of chunk seconds, each in
+           its own transaction
+
+    returns the number of schedule rows deleted
+    """
     try:
-        # 7 days old schedules now, to facilitate catch up
-        yesterday = int(time.time()) - (86400 * 7)
+        # 7 days old schedules by default, to facilitate catch up
+        cutoff = int(time.time()) - (86400 * days)
+        dn = 0
+        with Session(eng) as session, session.begin():
+            oldest = session.query(func.min(Schedule.airdate)).scalar()
+        if oldest is not None and oldest < cutoff:
+            step = chunk if chunk > 0 else cutoff - oldest
+            for lo in range(oldest, cutoff, step):
+                hi = min(lo + step, cutoff)
+                with Session(eng) as session, session.begin():
+                    dn += (
+                        session.query(Schedule)
+                        .filter(Schedule.airdate >= lo, Schedule.airdate < hi)
+                        .delete(synchronize_session=False)
+                    )
         with Session(eng) as session, session.begin():
-            n = session.query(Schedule).count()
-            old = session.query(Schedule).filter(Schedule.airdate < yesterday).all()
-            dn = len(old)
-            [session.delete(x) for x in old]
-        log.info(f"Cleaned {dn} rows from {n} Schedules.")
+            pn = (
+                session.query(Program)
+                .filter(~exists().where(Schedule.programid == Program.programid))
+                .delete(synchronize_session=False)
+            )
+            mn = (
+                session.query(Personmap)
+                .filter(~exists().where(Program.programid == Personmap.programid))
+                .delete(synchronize_session=False)
+            )
+            # a days md5 is only stale once the whole day is before the cutoff
+            sn = (
+                session.query(Schedulemd5)
+                .filter(Schedulemd5.datets < cutoff - 86400)
+                .delete(synchronize_session=False)
+            )
+            session.query(Runjournal).filter(Runjournal.doneat < cutoff).delete(
+                synchronize_session=False
+            )
+            session.query(Updaterun).filter(Updaterun.finished < cutoff).delete(
+                synchronize_session=False
+            )
+        log.info(
+            f"Cleaned {dn} Schedules, {pn} Programs, {mn} Personmaps, {sn} Schedulemd5s."
+        )
+        return dn
     except Exception as e:
         errorExit(sys.exc_info()[2], e)
 
 
-def addSchedule(sd, sched, eng):
+def addSchedule(sd, sched, eng, bulk=True, smd5=None, runid=None):
+    """Stores the schedule, returns a {programid: md5} map of its programs.
+
+    bulk mode works out the changes for the whole schedule in memory and
+    writes them with one DELETE and one executemany upsert.
+
+    smd5: the Schedulemd5 row for the schedule, stored in the same
+          transaction so the day is only marked current once it is stored
+    runid: journal the schedule against this update run
+    """
     try:
-        plist = []
+        if bulk:
+            return storeSchedule(eng, scheduleRows(sd, sched, smd5), runid=runid)
+        wanted = {}
         chanid = sched["stationID"]
         startdate = "unknown date"
         if "metadata" in sched and "startDate" in sched["metadata"]:
@@ -165,7 +517,16 @@ def addSchedule(sd, sched, eng):
             log.info(
                 f"Updating schedule for channel {c.name} with {len(sched['programs'])} programs on {startdate}"
             )
+            if len(sched["programs"]) > 0:
+                airdates = [
+                    sd.getTimeStamp(x["airDateTime"]) for x in sched["programs"]
+                ]
+                durations = [int(x["duration"]) for x in sched["programs"]]
+                end = max(a + d for a, d in zip(airdates, durations))
+                index = stationIndex(chanid, min(airdates), end, session)
+                known = {(x.programid, x.airdate): x for _, _, x in index.items}
             for prog in sched["programs"]:
+                wanted[prog["programID"]] = prog["md5"]
                 kwargs = {
                     "programid": prog["programID"],
                     "stationid": chanid,
@@ -173,8 +534,8 @@ def addSchedule(sd, sched, eng):
                 }
 
                 duration = int(prog["duration"])
-                removed = removeOverlaps(chanid, kwargs["airdate"], duration, session)
-                s = session.query(Schedule).filter_by(**kwargs).first()
+                removed = removeOverlaps(index, kwargs["airdate"], duration, session)
+                s = known.get((kwargs["programid"], kwargs["airdate"]))
                 if s and not removed:
                     s.md5 = prog["md5"]
                     s.duration = duration
@@ -185,178 +546,264 @@ def addSchedule(sd, sched, eng):
                     log.debug(f"addSchedule: {kwargs=}")
                     s = Schedule(**kwargs)
                     session.add(s)
+                    index.add(s.airdate, s.duration, s)
+                    known[(s.programid, s.airdate)] = s
+            if smd5 is not None:
+                upsert(session, Schedulemd5, [smd5])
+            if runid is not None and startdate != "unknown date":
+                datets = sd.getTimeStamp(f"{startdate}T00:00:00Z")
+                journal(session, runid, "schedule", chanid, datets, len(wanted))
             # db.session.commit()
-            for prog in sched["programs"]:
-                p = (
-                    session.query(Program)
-                    .filter_by(programid=prog["programID"], md5=prog["md5"])
-                    .first()
-                )
-                if not p:
-                    plist.append(prog["programID"])
-            cn = len(plist)
-            if cn > 0:
-                log.info(
-                    f"require downloading of {cn} programs for {c.name} on {startdate}"
-                )
-                updatePrograms(sd, plist, session)
+        return wanted
     except Exception as e:
         errorExit(sys.exc_info()[2], e)
 
 
-def updatePrograms(sd, plist, session):
-    """Retrieves information for each program in the list"""
+def scheduleRows(sd, sched, smd5=None):
+    """Returns what storeSchedule needs to store one schedule, this does not
+    touch the database so can run away from the writer."""
     try:
-        if len(plist) == 0:
-            raise Exception("updatePrograms: received empty list")
-        progs = sd.getPrograms(plist)
-        [addUpdateProgram(prog, session) for prog in progs]
+        chanid = sched["stationID"]
+        meta = sched.get("metadata", {})
+        startdate = meta.get("startDate")
+        airings = [
+            {
+                "programid": prog["programID"],
+                "stationid": chanid,
+                "airdate": sd.getTimeStamp(prog["airDateTime"]),
+                "duration": int(prog["duration"]),
+                "md5": prog["md5"],
+            }
+            for prog in sched["programs"]
+        ]
+        return {
+            "stationid": chanid,
+            "startdate": startdate,
+            "datets": sd.getTimeStamp(f"{startdate}T00:00:00Z") if startdate else None,
+            "airings": airings,
+            "smd5": smd5,
+            "wanted": {x["programid"]: x["md5"] for x in airings},
+        }
     except Exception as e:
-        errorNotify(sys.exc_info()[2], e)
+        errorRaise(sys.exc_info()[2], e)
+
+
+def storeSchedule(eng, rows, runid=None):
+    """Stores the output of scheduleRows in one transaction with one
+    DELETE and one executemany upsert, returns its {programid: md5} map."""
+    try:
+        chanid = rows["stationid"]
+        with Session(eng) as session, session.begin():
+            name = session.query(Channel.name).filter_by(stationid=chanid).scalar()
+            start = time.perf_counter()
+            ins, upd, dele = bulkSchedule(chanid, rows["airings"], session)
+            if rows["smd5"] is not None:
+                upsert(session, Schedulemd5, [rows["smd5"]])
+            if runid is not None and rows["datets"] is not None:
+                kwargs = {"datets": rows["datets"], "count": len(rows["wanted"])}
+                journal(session, runid, "schedule", chanid, **kwargs)
+            took = (time.perf_counter() - start) * 1000
+        log.info(
+            f"{name} {rows['startdate']}: {ins} inserted, {upd} updated, {dele} removed in {took:.1f}ms"
+        )
+        return rows["wanted"]
+    except Exception as e:
+        errorExit(sys.exc_info()[2], e)
 
 
-def addUpdateProgram(prog, session):
-    """Updates/Creates one program information
+def spanQuery(session, chanid, start, end):
+    """Query for the Schedule rows of chanid on air in [start, end)."""
+    return session.query(
+        Schedule.programid, Schedule.airdate, Schedule.duration
+    ).filter(Schedule.stationid == chanid, *onAir(start, end))
 
-    see
-    https://github.com/SchedulesDirect/JSON-Service/wiki/API-20141201#download-program-information
 
-    """
+def bulkSchedule(chanid, airings, session):
+    """Replaces the schedule for chanid over the time span of airings,
+    returns the (inserted, updated, removed) row counts."""
     try:
-        progid = prog["programID"]
-        log.debug(f"addUpdateProg: {progid}")
-        eprog = session.query(Program).filter_by(programid=progid).first()
-        if eprog:
-            log.debug(f"{progid} already exists")
-            if eprog.md5 == prog["md5"]:
-                log.debug("md5 match")
-                return None
-            else:
-                log.debug(f"md5 mismatch: storing {progid}")
-                eprog = setProgData(eprog, prog)
-                # db.session.commit()
-        else:
-            log.debug(f"new program: {progid}")
-            kwargs = {"programid": progid, "md5": prog["md5"]}
-            kwargs["title"] = extractString(prog["titles"], "title120")
-            log.debug(f"title: {kwargs['title']}")
-            kwargs["episodetitle"] = (
-                "" if "episodeTitle150" not in prog else prog["episodeTitle150"]
-            )
-            if "descriptions" in prog and "description100" in prog["descriptions"]:
-                kwargs["shortdesc"] = extractString(
-                    prog["descriptions"]["description100"], "description"
-                )
-            if "descriptions" in prog and "description1000" in prog["descriptions"]:
-                kwargs["longdesc"] = extractString(
-                    prog["descriptions"]["description1000"], "description"
-                )
-            if "originalAirDate" in prog:
-                kwargs["originalairdate"] = prog["originalAirDate"]
-            else:
-                log.debug(f"originalAirDate not in {prog=}")
-            if "metadata" in prog:
-                kwargs["series"], kwargs["episode"] = extractSeries(prog["metadata"])
-            eprog = Program(**kwargs)
-            session.add(eprog)
-            # db.session.commit()
-        if "cast" in prog:
-            [addUpdatePerson(item, progid, session) for item in prog["cast"]]
-        if "crew" in prog:
-            [addUpdatePerson(item, progid, session) for item in prog["crew"]]
+        if len(airings) == 0:
+            return (0, 0, 0)
+        start = min(x["airdate"] for x in airings)
+        end = max(x["airdate"] + x["duration"] for x in airings)
+        existing = spanQuery(session, chanid, start, end).all()
+        newkeys = {(x["programid"], x["airdate"]) for x in airings}
+        index = IntervalIndex()
+        for x in airings:
+            index.add(x["airdate"], x["duration"])
+        kept = set()
+        doomed = set()
+        for row in existing:
+            if (row.programid, row.airdate) in newkeys:
+                kept.add((row.programid, row.airdate))
+            elif index.overlaps(row.airdate, row.airdate + row.duration):
+                doomed.add((row.programid, row.airdate))
+        if len(doomed) > 0:
+            # rows that share an airdate with a doomed row are re-inserted
+            # by the upsert below
+            session.query(Schedule).filter(
+                Schedule.stationid == chanid,
+                Schedule.airdate.in_({airdate for _, airdate in doomed}),
+            ).delete(synchronize_session=False)
+        upsert(session, Schedule, airings)
+        return (len(airings) - len(kept), len(kept), len(doomed))
     except Exception as e:
-        errorExit(sys.exc_info()[2], e)
+        errorRaise(sys.exc_info()[2], e)
+
 
+def updatePrograms(sd, plist, eng, md5s=None, runid=None, threaded=True, workers=0):
+    """Retrieves information for each program in the list
 
-def setProgData(eprog, prog):
+    each batch of programs is committed as it arrives
+    md5s: {programid: md5}: passed on so that cached programs are not
+          downloaded again
+    runid: journal each committed batch against this update run
+    threaded, workers: see storePrograms
+    """
     try:
-        eprog.md5 = prog["md5"]
-        eprog.title = extractString(prog["titles"], "title120")
-        eprog.episodetitle = (
-            "" if "episodeTitle150" not in prog else prog["episodeTitle150"]
-        )
-        if "descriptions" in prog and "description1000" in prog["descriptions"]:
-            eprog.longdesc = extractString(
-                prog["descriptions"]["description1000"], "description"
-            )
-        if "descriptions" in prog and "description100" in prog["descriptions"]:
-            eprog.shortdesc = extractString(
-                prog["descriptions"]["description100"], "description"
-            )
-        if "originalAirDate" in prog:
-            eprog.originalairdate = prog["originalAirDate"]
-        if "metadata" in prog:
-            eprog.series, eprog.episode = extractSeries(prog["metadata"])
-        return eprog
+        if len(plist) == 0:
+            raise Exception("updatePrograms: received empty list")
+        batches = sd.programBatches(plist, md5s=md5s)
+        kwargs = {"runid": runid, "threaded": threaded, "workers": workers}
+        storePrograms(batches, eng, **kwargs)
     except Exception as e:
         errorNotify(sys.exc_info()[2], e)
 
 
-def extractString(xlist, key):
+def storePrograms(batches, eng, runid=None, threaded=True, workers=0, chunksize=500):
+    """Stores each batch of programs, committing them chunksize at a time.
+
+    Downloading and parsing, transforming to rows and storing are Pipeline
+    stages, so the next chunk downloads while this one is written,
+    threaded=False runs them in turn. A streamed batch is parsed as it is
+    split into chunks, so the queues between the stages hold a few chunks
+    rather than whole responses.
+
+    workers: int: > 0 transforms the programs in this many processes
+    """
     try:
-        log.debug(f"extractString: {xlist=}, {key=}")
-        for item in xlist:
-            if key in item:
-                return item[key]
-        log.warning(f"{key} not found in {xlist}")
-        return None
+        persons = knownPersons(eng)
+        pool = None
+        if workers > 0:
+            # the pipeline and SD session threads are running, a forked
+            # worker could inherit one of their locks held
+            context = multiprocessing.get_context("forkserver")
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+
+        def transform(chunk):
+            if pool is None:
+                return transformPrograms(chunk)
+            # spread the chunk over the workers
+            size = max(50, len(chunk) // workers + 1)
+            return mergeRows(pool.map(transformPrograms, chunks(chunk, size)))
+
+        def write(rows):
+            with Session(eng) as session, session.begin():
+                stored, added = storeProgramRows(rows, persons, session)
+                if runid is not None:
+                    first = rows[0][0][0]
+                    kwargs = {"count": len(rows[0])}
+                    journal(session, runid, "programs", first, **kwargs)
+            # only cache the new people once they are committed
+            persons.update(added)
+            return len(rows[0])
+
+        source = (xl for batch in batches for xl in chunks(batch, chunksize))
+        stages = [("transform", transform), ("write", write)]
+        pipe = Pipeline(source, stages, name="programs")
+        try:
+            return sum(pipe.run(threaded=threaded))
+        finally:
+            if pool is not None:
+                pool.shutdown()
     except Exception as e:
         errorNotify(sys.exc_info()[2], e)
 
 
-def extractSeries(mdata):
+def mergeRows(rowsets):
+    """Joins the outputs of several transformPrograms calls."""
+    programs, persons, maps = [], {}, []
+    for xprograms, xpersons, xmaps in rowsets:
+        programs.extend(xprograms)
+        persons.update((row[0], row) for row in xpersons)
+        maps.extend(xmaps)
+    return programs, list(persons.values()), maps
+
+
+def knownPersons(eng):
+    """Returns the set of personids already stored, this is the run-wide
+    person cache that storeCredits keeps up to date."""
     try:
-        series = episode = 0
-        for item in mdata:
-            series = int(item["Gracenote"]["season"])
-            episode = int(item["Gracenote"]["episode"])
-        return (series, episode)
+        with Session(eng) as session, session.begin():
+            return {row.personid for row in session.query(Person.personid)}
     except Exception as e:
         errorNotify(sys.exc_info()[2], e)
 
 
-def addUpdatePerson(person, programid, session):
+def storeCredits(personrows, maprows, persons, session):
+    """Inserts the Person rows not in the persons set, and the Personmap
+    rows not already stored, returns the set of personids added."""
     try:
-        log.debug(f"addUpdatePerson: {person['name']}")
-        per = session.query(Person).filter_by(personid=person["personId"]).first()
-        if not per:
-            log.debug(f"storing person: {person['name']}")
-            kwargs = {
-                "personid": person["personId"],
-                "name": person["name"],
-                "nameid": person["nameId"],
-            }
-            per = Person(**kwargs)
-            session.add(per)
-            # db.session.commit()
-        billingorder = "0" if "billingorder" not in person else person["billingorder"]
-        role = "" if "role" not in person else person["role"]
-        addUpdatePersonMap(per.personid, programid, role, billingorder, session)
+        maps = {(row[0], row[1]): row for row in maprows}
+        if len(maps) == 0:
+            return set()
+        newpersons = {}
+        for row in personrows:
+            if row[0] not in persons and row[0] not in newpersons:
+                newpersons[row[0]] = row
+        progids = list({progid for _, progid in maps})
+        existing = (
+            session.query(Personmap.personid, Personmap.programid)
+            .filter(Personmap.programid.in_(progids))
+            .all()
+        )
+        for row in existing:
+            maps.pop((row.personid, row.programid), None)
+        if len(newpersons) > 0:
+            rows = [dict(zip(PERSONCOLS, row)) for row in newpersons.values()]
+            session.execute(insert(Person.__table__), rows)
+        if len(maps) > 0:
+            rows = [dict(zip(PERSONMAPCOLS, row)) for row in maps.values()]
+            session.execute(insert(Personmap.__table__), rows)
+        log.debug(f"stored {len(newpersons)} people, {len(maps)} credits")
+        return set(newpersons)
     except Exception as e:
-        msg = f"{person=}, {programid=}"
-        errorExit(sys.exc_info()[2], e, msg)
+        errorRaise(sys.exc_info()[2], e)
 
 
-def addUpdatePersonMap(personid, programid, role, billingorder, session):
+def storeProgramRows(rows, persons, session):
+    """Stores the output of transformPrograms with executemany inserts.
+
+    Programs whose stored md5 matches are skipped, as are their credits,
+    a program with a new md5 replaces the stored one.
+
+    returns a tuple of the number of programs stored and the set of
+    personids added
+    """
     try:
-        cm = (
-            session.query(Personmap)
-            .filter_by(programid=programid, personid=personid)
-            .first()
+        programs, personrows, maprows = rows
+        ids = list({row[0] for row in programs})
+        have = dict(
+            session.query(Program.programid, Program.md5).filter(
+                Program.programid.in_(ids)
+            )
         )
-        if not cm:
-            kwargs = {
-                "programid": programid,
-                "personid": personid,
-                "role": role,
-                "billingorder": billingorder,
-            }
-            cm = Personmap(**kwargs)
-            session.add(cm)
-            # db.session.commit()
+        # the last copy of a program repeated in the batch wins
+        fresh = {row[0]: row for row in programs if have.get(row[0]) != row[1]}
+        changed = [progid for progid in fresh if progid in have]
+        if len(changed) > 0:
+            session.query(Program).filter(Program.programid.in_(changed)).delete(
+                synchronize_session=False
+            )
+        if len(fresh) > 0:
+            xrows = [dict(zip(PROGRAMCOLS, row)) for row in fresh.values()]
+            session.execute(insert(Program.__table__), xrows)
+        maprows = [row for row in maprows if row[1] in fresh]
+        credited = {row[0] for row in maprows}
+        personrows = [row for row in personrows if row[0] in credited]
+        return len(fresh), storeCredits(personrows, maprows, persons, session)
     except Exception as e:
-        msg = f"{personid=}, {programid=}, {role=}, {billingorder=}"
-        errorNotify(sys.exc_info()[2], e, msg)
+        errorRaise(sys.exc_info()[2], e)
 
 
 def updateChannels(linupdata, eng):
@@ -440,79 +887,115 @@ def getRMap(xmap):
         errorNotify(sys.exc_info()[2], e)
 
 
-def whatsOnNow(eng, now=int(time.time()), favs=True, limit=40):
-    """
-    programid = Column(String(128), primary_key=True)
-    stationid = Column(String(128), primary_key=True)
-    airdate = Column(Integer(), primary_key=True)
-    duration = Column(Integer())
-    md5 = Column(String(32))
-    """
+def scheduleQuery(session):
+    """Query joining each Schedule to its Program and Channel, selecting
+    only the columns that the program listings show."""
     try:
-        xscheds = []
-        xfavs = favourites(eng, favs=favs)
-        chanids = [x["stationid"] for x in xfavs]
-        with Session(eng) as session, session.begin():
-            scheds = (
-                session.query(Schedule)
-                .filter(
-                    Schedule.airdate < (now + 3600),
-                    (Schedule.airdate + Schedule.duration) > now,
-                    Schedule.stationid.in_(chanids),
-                )
-                .order_by(Schedule.airdate)
-                .limit(limit)
+        return (
+            session.query(
+                Schedule.programid,
+                Schedule.stationid,
+                Schedule.airdate,
+                Schedule.duration,
+                Schedule.md5,
+                Program.title,
+                Program.shortdesc,
+                Channel.name,
             )
-            for x in scheds:
-                dsched = x._todict_()
-                dsched["dchan"], dsched["dprog"] = progDetailsFromSchedule(session, x)
-                xscheds.append(dsched)
-        return xscheds
+            .join(Program, Program.programid == Schedule.programid)
+            .join(Channel, Channel.stationid == Schedule.stationid)
+        )
     except Exception as e:
         errorNotify(sys.exc_info()[2], e)
 
 
-def chanDetails(session, chanid):
+def scheduleDict(row):
+    """Shapes a scheduleQuery row as the schedule dict with its "dchan" and
+    "dprog" dicts."""
     try:
-        chan = session.query(Channel).filter_by(stationid=chanid).first()
-        dchan = chan._todict_()
-        return dchan
+        keys = ["programid", "stationid", "airdate", "duration", "md5"]
+        dsched = {key: getattr(row, key) for key in keys}
+        dsched["dchan"] = {"stationid": row.stationid, "name": row.name}
+        dsched["dprog"] = {
+            "programid": row.programid,
+            "title": row.title,
+            "shortdesc": row.shortdesc,
+        }
+        return dsched
     except Exception as e:
         errorNotify(sys.exc_info()[2], e)
 
 
-def progDetailsFromSchedule(session, schedule, withchan=True):
+def nowQuery(session, now, favs=True, limit=40):
+    gd = 1 if favs else 0
+    return (
+        scheduleQuery(session)
+        .filter(*onAir(now, now + 3600), Channel.getdata > gd)
+        .order_by(Schedule.airdate)
+        .limit(limit)
+    )
+
+
+def whatsOnNow(eng, now=int(time.time()), favs=True, limit=40):
+    """Returns what is on the favourite channels in the next hour, in one
+    joined query."""
     try:
-        # there should only be one program
-        prog = session.query(Program).filter_by(programid=schedule.programid).first()
-        dprog = prog._todict_()
-        dchan = chanDetails(session, schedule.stationid) if withchan else None
-        return (dchan, dprog)
+        with Session(eng) as session, session.begin():
+            scheds = nowQuery(session, now, favs, limit)
+            xscheds = [scheduleDict(x) for x in scheds]
+        return xscheds
     except Exception as e:
         errorNotify(sys.exc_info()[2], e)
 
 
+def chanQuery(session, chanid, now, limit=40):
+    return (
+        scheduleQuery(session)
+        .filter(Schedule.stationid == chanid, *onAir(now, now + 86400))
+        .order_by(Schedule.airdate)
+        .limit(limit)
+    )
+
+
 def chanProgs(eng, chanid, now=int(time.time()), limit=40):
+    """Returns the next day of programs for chanid, in one joined query."""
+    try:
+        with Session(eng) as session, session.begin():
+            scheds = chanQuery(session, chanid, now, limit)
+            xscheds = [scheduleDict(x) for x in scheds]
+        return xscheds
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+
+
+def pendingRecordings(eng, now=None):
+    """Returns the recordings, as dicts, that have not finished airing and
+    are not yet recorded."""
     try:
-        xscheds = []
+        now = int(time.time()) if now is None else now
         with Session(eng) as session, session.begin():
-            dchan = chanDetails(session, chanid)
-            scheds = (
-                session.query(Schedule)
+            recs = (
+                session.query(Recording)
                 .filter(
-                    Schedule.stationid == chanid,
-                    Schedule.airdate < (now + 86400),
-                    (Schedule.airdate + Schedule.duration) > now,
+                    Recording.status.in_(["pending", "recording"]),
+                    (Recording.airdate + Recording.duration + Recording.endpadding)
+                    > now,
                 )
-                .order_by(Schedule.airdate)
-                .limit(limit)
-                # .all()
+                .order_by(Recording.airdate)
+                .all()
             )
-            for x in scheds:
-                dsched = x._todict_()
-                _, dsched["dprog"] = progDetailsFromSchedule(session, x, withchan=False)
-                dsched["dchan"] = dchan
-                xscheds.append(dsched)
-        return xscheds
+            return [x._todict_() for x in recs]
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+
+
+def setRecordingStatus(eng, rec, status):
+    try:
+        with Session(eng) as session, session.begin():
+            session.query(Recording).filter_by(
+                programid=rec["programid"],
+                stationid=rec["stationid"],
+                airdate=rec["airdate"],
+            ).update({"status": status})
     except Exception as e:
         errorNotify(sys.exc_info()[2], e)